@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import numpy as np
+import librosa
+import soundfile as sf
+from feature_cache import file_content_hash
+
+SAMPLE_RATE = 22050
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DECODE_CACHE_PATH = os.path.join(BASE_DIR, "decode_cache")
+DECODE_CACHE_EXTENSION = ".npy"
+
+
+def read_audio(file_path, sr=SAMPLE_RATE, offset=0.0, duration=None):
+    """Decodes a mono float32 signal, giving the same samples as librosa.load(file_path, sr=sr, offset=offset, duration=duration).
+
+        Files soundfile can read (wav, flac, ogg, mp3) are read from offset without decoding what comes before,
+        and only the requested frames are decoded. No resampling is done when the file is already at sr.
+        Other formats (mp4, webm, ...) go through librosa.load.
+
+        :param file_path (str): Path to audio file
+        :param sr (int): Target sample rate, None for the native sample rate
+        :param offset (float): Start of the read in seconds
+        :param duration (float): Duration of the read in seconds, None to read until the end
+        :return signal (ndarray), sample_rate (int): Signal and its sample rate
+        """
+
+    try:
+        sf_desc = sf.SoundFile(file_path)
+    except RuntimeError:
+        return librosa.load(file_path, sr=sr, offset=offset, duration=duration)
+
+    with sf_desc:
+        sr_native = sf_desc.samplerate
+        if offset:
+            sf_desc.seek(int(offset * sr_native))
+        frames = int(duration * sr_native) if duration is not None else -1
+        signal = sf_desc.read(frames=frames, dtype=np.float32, always_2d=False).T
+
+    signal = librosa.to_mono(signal)
+    if sr is not None and sr != sr_native:
+        signal = librosa.resample(signal, orig_sr=sr_native, target_sr=sr)
+        return signal, sr
+    return signal, sr_native
+
+
+def needs_resampling(file_path, sr=SAMPLE_RATE):
+    """Tells whether decoding a file at sr takes more than a native read (resampling, or a format soundfile cannot read).
+        """
+
+    try:
+        return sf.info(file_path).samplerate != sr
+    except RuntimeError:
+        return True
+
+
+class DecodeCache:
+    """Persistent cache of decoded signals, resampled to a fixed sample rate and saved as float32 .npy files.
+
+        Entries are keyed by file content and sample rate, and returned as read-only memory maps, so a source
+        decoded once by a stage (cleaning, cropping, feature extraction) is not decoded again by the others.
+        Several processes may share a cache directory. When the cache grows beyond max_bytes the least recently
+        used entries are evicted.
+        """
+
+    def __init__(self, cache_dir=DECODE_CACHE_PATH, max_bytes=4 << 30):
+        """
+            :param cache_dir (str): Directory the entries are stored in
+            :param max_bytes (int): Maximum total size of the entries
+            """
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self, file_path, sr=SAMPLE_RATE):
+        """Returns the whole signal of a file at sr as a read-only memory map, decoding it on a miss.
+            """
+
+        path = os.path.join(self.cache_dir, "{}_{}{}".format(file_content_hash(file_path), sr, DECODE_CACHE_EXTENSION))
+        try:
+            signal = np.load(path, mmap_mode="r")
+            # mark the entry as recently used
+            os.utime(path)
+            self.hits += 1
+            return signal
+        except (OSError, ValueError):
+            self.misses += 1
+
+        signal, _ = read_audio(file_path, sr)
+        # a unique temporary file, as other processes may be writing the same entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fp:
+            np.save(fp, signal.astype(np.float32, copy=False))
+        os.replace(tmp_path, path)
+        self.evict()
+        return np.load(path, mmap_mode="r")
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes.
+            """
+
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(DECODE_CACHE_EXTENSION):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+                except OSError:
+                    pass
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+
+def load_audio(file_path, sr=SAMPLE_RATE, offset=0.0, duration=None, cache=None):
+    """Drop-in replacement of librosa.load(file_path, sr=sr, offset=offset, duration=duration) for mono signals.
+
+        Files already at sr are read natively (see read_audio). Files that need resampling or a decoder other
+        than soundfile are taken from the decode cache if one is given: the whole file is decoded once and
+        offset/duration slice the memory-mapped signal. Such slices are read-only, and their first and last
+        samples can differ slightly from resampling only the requested part.
+
+        :param cache (DecodeCache): Decode cache, None to always decode
+        :return signal (ndarray), sample_rate (int): Signal and its sample rate
+        """
+
+    if cache is None or sr is None or not needs_resampling(file_path, sr):
+        return read_audio(file_path, sr, offset, duration)
+
+    signal = cache.load(file_path, sr)
+    start = int(offset * sr)
+    end = start + int(duration * sr) if duration is not None else len(signal)
+    return signal[start:end], sr
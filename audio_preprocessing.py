@@ -1,23 +1,196 @@
 # -*- coding: utf-8 -*-
 
+import argparse
 import json
 import csv
 import os
 import math
+import hashlib
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import librosa
+from features import extract_features, pool_features, features_to_row, features_to_matrix, feature_layout
+from feature_store import FeatureStoreWriter
+from feature_cache import FeatureCache
+from audio_decode import read_audio
+from instrumentation import LEVELS, NULL_INSTRUMENTATION, Instrumentation
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 DETECTION_DATASET_PATHS = [os.path.join(BASE_DIR, "clean_detection_dataset")]
 DETECTION_JSON_PATH = "detection_data.json"
 DETECTION_CSV_PATH = "detection_data.csv"
+DETECTION_STORE_PATH = "detection_data"
 CLASSIFICATION_DATASET_PATHS = [os.path.join(BASE_DIR, "yt_dataset"), os.path.join(BASE_DIR, "clean_classification_dataset")]
 CLASSIFICATION_JSON_PATH = "classification_data.json"
 CLASSIFICATION_CSV_PATH = "classification_data.csv"
+CLASSIFICATION_STORE_PATH = "classification_data"
+FEATURE_CACHE_PATH = os.path.join(BASE_DIR, "feature_cache")
 SAMPLE_RATE = 22050
+# extensions of the audio files looked for in directories, the mp4 and webm yt_dataset downloads included
+AUDIO_EXTENSIONS = (".wav", ".flac", ".ogg", ".mp3", ".m4a", ".mp4", ".webm")
 
 
-def save_features_in_JSON(dataset_paths, json_path, num_mfcc=13, n_fft=2048, hop_length=512, num_segments=5):
+def list_dataset_files(dataset_paths):
+    """Lists the audio files of the datasets along with their labels, in a deterministic order.
+
+        Sub-folders and files are visited in sorted order and labels are numbered in order of first appearance.
+
+        :param dataset_paths (list): Paths to datasets
+        :return label_map (dict), files (list): Label -> label index, [(label index, file path)]
+        """
+
+    label_map = {}
+    files = []
+    # loop through all the dataset paths
+    for dataset_path in dataset_paths:
+        # loop through all sub-folder
+        for dirpath, dirnames, filenames in os.walk(dataset_path):
+            dirnames.sort()
+            # ensure we're processing a sub-folder level
+            if dirpath != dataset_path:
+                # save label mapping
+                semantic_label = dirpath.split("/")[-1]
+                if semantic_label not in label_map:
+                    label_map[semantic_label] = len(label_map)
+                for f in sorted(filenames):
+                    files.append((label_map[semantic_label], os.path.join(dirpath, f)))
+    return label_map, files
+
+
+def extract_file_features(file_path, num_mfcc=13, n_fft=2048, hop_length=512, num_segments=5):
+    """Loads an audio file, divides it into segments and extracts the features of every segment.
+
+        Runs in the worker processes, so the metrics of the file are returned instead of being recorded.
+
+        :param file_path (str): Path to audio file
+        :param num_mfcc (int): Number of coefficients to extract
+        :param n_fft (int): Interval we consider to apply FFT. Measured in # of samples
+        :param hop_length (int): Sliding window for FFT. Measured in # of samples
+        :param num_segments (int): Number of segments we want to divide sample tracks into
+        :return segments (list), num_mfcc_vectors_per_segment (int), metrics (dict):
+            Features of every segment (see features.extract_features), expected number of mfcc vectors,
+            decode and featurize time, duration and number of segments of the file (see Instrumentation.record_file)
+        """
+
+    started = time.perf_counter()
+    signal, sample_rate = read_audio(file_path, sr=SAMPLE_RATE)
+    decode_seconds = time.perf_counter() - started
+
+    track_duration = librosa.get_duration(y=signal, sr=sample_rate)
+    samples_per_track = sample_rate * track_duration
+
+    samples_per_segment = int(samples_per_track / num_segments)
+    num_mfcc_vectors_per_segment = math.ceil(samples_per_segment / hop_length)
+
+    # process all segments of file
+    started = time.perf_counter()
+    segments = []
+    for d in range(num_segments):
+        # calculate start and finish sample for current segment
+        start = samples_per_segment * d
+        finish = start + samples_per_segment
+
+        segments.append(extract_features(signal[start:finish], sample_rate, num_mfcc, n_fft, hop_length))
+
+    metrics = {
+        "decode_seconds": decode_seconds,
+        "featurize_seconds": time.perf_counter() - started,
+        "audio_seconds": track_duration,
+        "segments": num_segments,
+    }
+    return segments, num_mfcc_vectors_per_segment, metrics
+
+
+def _extract_file_features_args(args):
+    return extract_file_features(*args)
+
+
+def bounded_map(executor, fn, iterable, max_pending):
+    """Like executor.map, but with at most max_pending tasks submitted and not consumed yet.
+
+        executor.map submits everything up front, so results pile up in memory when the consumer is slower.
+        Results are yielded in the order of the iterable, and the exception of a failed task is raised when
+        its result is reached.
+
+        :param executor (Executor): Pool the tasks are submitted to
+        :param fn (callable): Task, called with every item of the iterable
+        :param iterable: Arguments of the tasks, consumed as the results are
+        :param max_pending (int): Maximum number of tasks submitted and not consumed yet, e.g. twice the workers
+        :return: Iterator of the results of fn
+        """
+
+    pending = deque()
+    for arg in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, arg))
+    while pending:
+        yield pending.popleft().result()
+
+
+def extract_dataset_features(files, num_mfcc=13, n_fft=2048, hop_length=512, num_segments=5, workers=1, cache=None):
+    """Extracts the features of every file, using a pool of worker processes if workers > 1.
+
+        Results are yielded in the order of files, whatever the number of workers. Files found in the
+        cache are not decoded again, the others are added to it.
+
+        :param files (list): [(label index, file path)] as returned by list_dataset_files
+        :param workers (int): Number of worker processes
+        :param cache (FeatureCache): Feature cache, None to always extract
+        :return: Iterator of (label index, file path, segments, num_mfcc_vectors_per_segment, metrics),
+            the metrics of cached files only holding their duration and number of segments
+        """
+
+    params = dict(num_mfcc=num_mfcc, n_fft=n_fft, hop_length=hop_length, num_segments=num_segments, sample_rate=SAMPLE_RATE)
+    keys = [cache.key(file_path, **params) for _, file_path in files] if cache else [None] * len(files)
+    is_cached = [cache.probe(key) for key in keys] if cache else [False] * len(files)
+    args = [(file_path, num_mfcc, n_fft, hop_length, num_segments) for (_, file_path), hit in zip(files, is_cached) if not hit]
+
+    def yield_results(extracted):
+        # extracted results come in the order of the files missing from the cache
+        for (label_index, file_path), key, hit in zip(files, keys, is_cached):
+            result = cache.get(key) if hit else next(extracted)
+            if hit and result is None:
+                # evicted or unreadable since it was probed, extract it again and repair the entry
+                hit = False
+                result = extract_file_features(file_path, num_mfcc, n_fft, hop_length, num_segments)
+            if cache and not hit:
+                cache.put(key, result)
+            if hit:
+                segments, num_mfcc_vectors_per_segment, metrics = result
+                # nothing was decoded nor featurized in this run
+                metrics = {name: value for name, value in metrics.items() if name in ("audio_seconds", "segments")}
+                result = segments, num_mfcc_vectors_per_segment, dict(metrics, cache_hit=True)
+            yield (label_index, file_path) + result
+
+    if workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield from yield_results(bounded_map(executor, _extract_file_features_args, args, workers * 2))
+    else:
+        yield from yield_results(map(_extract_file_features_args, args))
+
+
+def iter_feature_records(files, num_mfcc=13, n_fft=2048, hop_length=512, num_segments=5, workers=1, cache=None, instrumentation=NULL_INSTRUMENTATION):
+    """Yields the features of the dataset one segment at a time, see extract_dataset_features.
+
+        At most a few files are held in memory at once, whatever the size of the dataset.
+
+        :param instrumentation (Instrumentation): Records the metrics of every file
+        :return: Iterator of (label index, file path, segment index, features, num_mfcc_vectors_per_segment)
+        """
+
+    for label_index, file_path, segments, num_mfcc_vectors_per_segment, metrics in extract_dataset_features(files, num_mfcc, n_fft, hop_length, num_segments, workers, cache):
+        instrumentation.record_file(file_path, metrics)
+        for d, features in enumerate(segments):
+            yield label_index, file_path, d, features, num_mfcc_vectors_per_segment
+
+
+def save_features_in_JSON(dataset_paths, json_path, num_mfcc=13, n_fft=2048, hop_length=512, num_segments=5, workers=1, instrumentation=NULL_INSTRUMENTATION, cache=None):
     """Extracts MFCCs from dataset and saves them into a json file along with labels.
 
         :param dataset_path (str): Path to dataset
@@ -26,148 +199,112 @@ def save_features_in_JSON(dataset_paths, json_path, num_mfcc=13, n_fft=2048, hop
         :param n_fft (int): Interval we consider to apply FFT. Measured in # of samples
         :param hop_length (int): Sliding window for FFT. Measured in # of samples
         :param: num_segments (int): Number of segments we want to divide sample tracks into
+        :param workers (int): Number of worker processes
+        :param instrumentation (Instrumentation): Records the decode, featurize and write times
+        :param cache (FeatureCache): Feature cache, None to always extract
         :return:
         """
 
-    # dictionary to store mapping, labels, and MFCCs
-    data = {
-        "mapping": [],
-        "labels": [],
-        "mfccs": [],
-        "spectral_centroids": [],
-        "spectral_rolloffs": [],
-        "spectral_bandwidth_2": [],
-        "spectral_bandwidth_3": [],
-        "spectral_bandwidth_4": [],
-        "zero_crossing_rates": [],
-        "chroma_features": [],
-    }
+    # keys of the json file, every list is streamed to its own part file as segments are processed
+    keys = [
+        "labels",
+        "mfccs",
+        "spectral_centroids",
+        "spectral_rolloffs",
+        "spectral_bandwidth_2",
+        "spectral_bandwidth_3",
+        "spectral_bandwidth_4",
+        "zero_crossing_rates",
+        "chroma_features",
+    ]
 
-    # loop through all the dataset paths
-    for dataset_path in dataset_paths:
-        # loop through all sub-folder
-        for i, (dirpath, dirnames, filenames) in enumerate(os.walk(dataset_path)):
+    label_map, files = list_dataset_files(dataset_paths)
+    # save label (i.e., sub-folder name) in the mapping
+    mapping = sorted(label_map, key=label_map.get)
 
-            # ensure we're processing a sub-folder level
-            if dirpath is not dataset_path:
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(json_path))) as parts_dir:
+        parts = {key: open(os.path.join(parts_dir, key), "w+") for key in keys}
+        counts = dict.fromkeys(keys, 0)
 
-                # save label (i.e., sub-folder name) in the mapping
-                semantic_label = dirpath.split("/")[-1]
-                data["mapping"].append(semantic_label)
-                log_file.write("\nProcessing: {}\n".format(semantic_label))
-
-                # process all audio files in sub-dir
-                for f in filenames:
-
-                    # audio file
-                    file_path = os.path.join(dirpath, f)
-                    signal, sample_rate = librosa.load(file_path, sr=SAMPLE_RATE)
-                    log_file.write("\nSignal shape: {}, Sample rate: {}".format(signal.shape, sample_rate))
-                    
-                    track_duration = librosa.get_duration(y=signal, sr=sample_rate)
-                    samples_per_track = sample_rate * track_duration
-                    log_file.write("\nTrack Duration: {}s, Samples per track: {}".format(track_duration, samples_per_track))
-                    
-                    samples_per_segment = int(samples_per_track / num_segments)
-                    num_mfcc_vectors_per_segment = math.ceil(samples_per_segment / hop_length)
-                    log_file.write("\nSamples per segment: {}, No. of mfcc vectors per segment: {}".format(samples_per_segment, num_mfcc_vectors_per_segment))
-
-                    # process all segments of file
-                    for d in range(num_segments):
-                        log_file.write("\n{}, segment:{}".format(file_path, d+1))
-
-                        # calculate start and finish sample for current segment
-                        start = samples_per_segment * d
-                        finish = start + samples_per_segment
-
-                        # extract mfcc
-                        mfcc = librosa.feature.mfcc(signal[start:finish], sample_rate, n_mfcc=num_mfcc, n_fft=n_fft, hop_length=hop_length)
-                        mfcc = mfcc.T
-                        log_file.write("\nShape of mfcc: {}".format(mfcc.shape))
-                        # store only mfcc feature with expected number of vectors
-                        if len(mfcc) == num_mfcc_vectors_per_segment:
-                            data["mfccs"].append(mfcc.tolist())
-                            data["labels"].append(i-1) 
-                            
-                        ##################################
-                        # ADD IF CHECKS ON EVERY FEATURE #  
-                        ##################################
-                        
-                        # extract spectral centeroid
-                        spectral_centroids = librosa.feature.spectral_centroid(signal[start:finish], sr=sample_rate)[0]
-                        log_file.write("\nShape of spectral centroids: {}".format(spectral_centroids.shape))
-                        data["spectral_centroids"].append(spectral_centroids.tolist())
-                        
-                        # extract spectral rolloff
-                        spectral_rolloffs = librosa.feature.spectral_rolloff(signal[start:finish]+0.01, sr=sample_rate)[0]
-                        log_file.write("\nShape of spectral rolloffs: {}".format(spectral_rolloffs.shape))
-                        data["spectral_rolloffs"].append(spectral_rolloffs.tolist())
-                        
-                        # extract spectral bandwidth
-                        spectral_bandwidth_2 = librosa.feature.spectral_bandwidth(signal[start:finish]+0.01, sr=sample_rate)[0]
-                        log_file.write("\nShape of spectral bandwidth 2: {}".format(spectral_bandwidth_2.shape))
-                        data["spectral_bandwidth_2"].append(spectral_bandwidth_2.tolist())
-                        spectral_bandwidth_3 = librosa.feature.spectral_bandwidth(signal[start:finish]+0.01, sr=sample_rate, p=3)[0]
-                        log_file.write("\nShape of spectral bandwidth 3: {}".format(spectral_bandwidth_3.shape))
-                        data["spectral_bandwidth_3"].append(spectral_bandwidth_3.tolist())
-                        spectral_bandwidth_4 = librosa.feature.spectral_bandwidth(signal[start:finish]+0.01, sr=sample_rate, p=4)[0]
-                        log_file.write("\nShape of spectral bandwidth 4: {}".format(spectral_bandwidth_4.shape))
-                        data["spectral_bandwidth_4"].append(spectral_bandwidth_4.tolist())
-                        
-                        # extract zero-crossing rate                    
-                        zero_crossing_rates = librosa.feature.zero_crossing_rate(signal[start:finish], pad=False)[0]
-                        log_file.write("\nShape of zero crossing rates: {}".format(zero_crossing_rates.shape))
-                        data["zero_crossing_rates"].append(zero_crossing_rates.tolist())
-                        
-                        # extract croma features
-                        chroma_features = librosa.feature.chroma_stft(signal[start:finish], sr=sample_rate, hop_length=hop_length)
-                        chroma_features = chroma_features.T
-                        log_file.write("\nShape of chroma features: {}".format(chroma_features.shape))
-                        data["chroma_features"].append(chroma_features.tolist())
-                        
-                    log_file.write("\n")
-
-    # save MFCCs to json file
-    with open(json_path, "w") as fp:
-        json.dump(data, fp, indent=4)
-
-def get_features_csv_row(signal, sample_rate, num_mfcc=13, n_fft=2048, hop_length=512):
-
-    csv_row = []
-
-    # extract mfcc
-    mfcc = librosa.feature.mfcc(signal, sample_rate, n_mfcc=num_mfcc, n_fft=n_fft, hop_length=hop_length)
-    mfcc = mfcc.T
-    csv_row += sum(mfcc.tolist(), [])
-        
-    # extract spectral centeroid
-    spectral_centroids = librosa.feature.spectral_centroid(signal, sr=sample_rate)[0]
-    csv_row += spectral_centroids.tolist()
-    
-    # extract spectral rolloff
-    spectral_rolloffs = librosa.feature.spectral_rolloff(signal+0.01, sr=sample_rate)[0]
-    csv_row += spectral_rolloffs.tolist()
-    
-    # extract spectral bandwidth
-    spectral_bandwidth_2 = librosa.feature.spectral_bandwidth(signal+0.01, sr=sample_rate)[0]
-    csv_row += spectral_bandwidth_2.tolist()
-    spectral_bandwidth_3 = librosa.feature.spectral_bandwidth(signal+0.01, sr=sample_rate, p=3)[0]
-    csv_row += spectral_bandwidth_3.tolist()
-    spectral_bandwidth_4 = librosa.feature.spectral_bandwidth(signal+0.01, sr=sample_rate, p=4)[0]
-    csv_row += spectral_bandwidth_4.tolist()
-    
-    # extract zero-crossing rate                    
-    zero_crossing_rates = librosa.feature.zero_crossing_rate(signal, pad=False)[0]
-    csv_row += zero_crossing_rates.tolist()
-    
-    # extract croma features
-    chroma_features = librosa.feature.chroma_stft(signal, sr=sample_rate, hop_length=hop_length)
-    chroma_features = chroma_features.T
-    csv_row += sum(chroma_features.tolist(), [])
-
-    return csv_row
-        
-def save_features_in_CSV(dataset_paths, csv_path, num_mfcc=13, n_fft=2048, hop_length=512, num_segments=5):
+        def append(key, value):
+            parts[key].write(("," if counts[key] else "") + json.dumps(value))
+            counts[key] += 1
+
+        records = iter_feature_records(files, num_mfcc, n_fft, hop_length, num_segments, workers, cache, instrumentation)
+        for label_index, file_path, d, features, num_mfcc_vectors_per_segment in records:
+            with instrumentation.timer("write"):
+                # store only mfcc feature with expected number of vectors
+                mfcc = features["mfcc"]
+                if len(mfcc) == num_mfcc_vectors_per_segment:
+                    append("mfccs", mfcc.tolist())
+                    append("labels", label_index)
+
+                ##################################
+                # ADD IF CHECKS ON EVERY FEATURE #
+                ##################################
+
+                append("spectral_centroids", features["spectral_centroid"].tolist())
+                append("spectral_rolloffs", features["spectral_rolloff"].tolist())
+                for p in (2, 3, 4):
+                    append("spectral_bandwidth_{}".format(p), features["spectral_bandwidth_{}".format(p)].tolist())
+                append("zero_crossing_rates", features["zero_crossing_rate"].tolist())
+                append("chroma_features", features["chroma"].tolist())
+
+        # assemble the json file from the parts
+        with instrumentation.timer("write"), open(json_path, "w") as fp:
+            fp.write('{"mapping": ' + json.dumps(mapping))
+            for key in keys:
+                fp.write(', "{}": ['.format(key))
+                parts[key].seek(0)
+                shutil.copyfileobj(parts[key], fp)
+                fp.write("]")
+            fp.write("}")
+        for part in parts.values():
+            part.close()
+
+def get_features_csv_row(signal, sample_rate, num_mfcc=13, n_fft=2048, hop_length=512, feature_mode="frames"):
+    """Extracts the feature vector of a segment, all features being derived from one shared STFT.
+
+        :param signal (ndarray): Audio time series of the segment
+        :param sample_rate (int): Sample rate of the signal
+        :param num_mfcc (int): Number of coefficients to extract
+        :param n_fft (int): Interval we consider to apply FFT. Measured in # of samples
+        :param hop_length (int): Sliding window for FFT. Measured in # of samples
+        :param feature_mode (str): "frames" for every frame of every feature, "pooled" for a fixed number of
+            statistics of every feature over time, whatever the duration of the segment (see features.pool_features)
+        :return csv_row (list): mfcc, spectral centroid, rolloff, bandwidth (p=2,3,4), zcr and chroma frames (or statistics)
+        """
+
+    features = extract_features(signal, sample_rate, num_mfcc, n_fft, hop_length)
+    if feature_mode == "pooled":
+        features = pool_features(features)
+    return features_to_row(features).tolist()
+
+def get_features_batch(signals, sample_rate, num_mfcc=13, n_fft=2048, hop_length=512, feature_mode="frames", augmenter=None, random_state=None):
+    """Extracts the feature vectors of a batch of equal-length segments in one vectorized pass.
+
+        The STFTs, mel projection, DCT and spectral statistics each run once over the whole batch.
+
+        :param signals (ndarray): Stacked segments of shape (batch, samples), e.g. DATASET_AUDIO_DURATION clips
+        :param sample_rate (int): Sample rate of the signals
+        :param num_mfcc (int): Number of coefficients to extract
+        :param n_fft (int): Interval we consider to apply FFT. Measured in # of samples
+        :param hop_length (int): Sliding window for FFT. Measured in # of samples
+        :param feature_mode (str): "frames" or "pooled", see get_features_csv_row
+        :param augmenter (Augmenter): Extracts the features of random variants of the segments instead, see augmentation
+        :param random_state (RandomState): Random state of the variants of the batch
+        :return features (ndarray): float32 matrix of shape (batch, n_features), rows as in get_features_csv_row
+        """
+
+    if augmenter is not None:
+        features = augmenter.extract(np.asarray(signals), sample_rate, num_mfcc, n_fft, hop_length, random_state)
+    else:
+        features = extract_features(np.asarray(signals), sample_rate, num_mfcc, n_fft, hop_length)
+    if feature_mode == "pooled":
+        features = pool_features(features)
+    return features_to_matrix(features).astype(np.float32)
+
+def save_features_in_CSV(dataset_paths, csv_path, num_mfcc=13, n_fft=2048, hop_length=512, num_segments=5, workers=1, instrumentation=NULL_INSTRUMENTATION, mapping_file=None, cache=None, feature_mode="frames"):
     """Extracts MFCCs from dataset and saves them into a csv file along with labels.
 
         :param dataset_path (str): Path to dataset
@@ -176,78 +313,130 @@ def save_features_in_CSV(dataset_paths, csv_path, num_mfcc=13, n_fft=2048, hop_l
         :param n_fft (int): Interval we consider to apply FFT. Measured in # of samples
         :param hop_length (int): Sliding window for FFT. Measured in # of samples
         :param: num_segments (int): Number of segments we want to divide sample tracks into
-        :return:
+        :param workers (int): Number of worker processes
+        :param instrumentation (Instrumentation): Records the decode, featurize and write times
+        :param mapping_file (file): File to write the label mapping to
+        :param cache (FeatureCache): Feature cache, None to always extract
+        :param feature_mode (str): "frames" or "pooled", see get_features_csv_row
+        :return label_map (dict): Label -> label index
         """
 
+    label_map, files = list_dataset_files(dataset_paths)
+    if mapping_file:
+        for semantic_label, label_index in label_map.items():
+            mapping_file.write("\n{}: \"{}\"".format(label_index, semantic_label))
+
     with open(csv_path, 'w', newline='') as myfile:
         wr = csv.writer(myfile, quoting=csv.QUOTE_ALL)
-        # loop through all the dataset paths
-        label_map = {}
-        curr_label_number = 0
-        for dataset_path in dataset_paths:
-            # loop through all sub-folder
-            for i, (dirpath, dirnames, filenames) in enumerate(os.walk(dataset_path)):
-                # ensure we're processing a sub-folder level
-                if dirpath is not dataset_path:
-                    # save label  mapping
-                    semantic_label = dirpath.split("/")[-1]
-                    label_index = label_map.get(semantic_label)
-                    if label_index == None:
-                        label_index = curr_label_number
-                        label_map[semantic_label] = label_index
-                        mapping_file.write("\n{}: \"{}\"".format(curr_label_number, semantic_label))
-                        curr_label_number += 1
-                    # process all audio files in sub-dir
-                    for f in filenames:
-                        # audio file
-                        file_path = os.path.join(dirpath, f)
-                        signal, sample_rate = librosa.load(file_path, sr=SAMPLE_RATE)
-                        log_file.write("\nSignal shape: {}, Sample rate: {}".format(signal.shape, sample_rate))
-                        
-                        track_duration = librosa.get_duration(y=signal, sr=sample_rate)
-                        samples_per_track = sample_rate * track_duration
-                        log_file.write("\nTrack Duration: {}s, Samples per track: {}".format(track_duration, samples_per_track))
-                        
-                        samples_per_segment = int(samples_per_track / num_segments)
-                        num_mfcc_vectors_per_segment = math.ceil(samples_per_segment / hop_length)
-                        log_file.write("\nSamples per segment: {}, No. of mfcc vectors per segment: {}".format(samples_per_segment, num_mfcc_vectors_per_segment))
-
-                        # process all segments of file
-                        for d in range(num_segments):
-                            log_file.write("\n{}, segment:{}".format(file_path, d+1))
-
-                            # calculate start and finish sample for current segment
-                            start = samples_per_segment * d
-                            finish = start + samples_per_segment
-
-                            csv_row = get_features_csv_row(signal[start:finish], sample_rate, num_mfcc, n_fft, hop_length)
-                            # label
-                            csv_row += [label_index]
-                            wr.writerow(csv_row)
-                            
-                        log_file.write("\n")
-        
+        for label_index, file_path, d, features, _ in iter_feature_records(files, num_mfcc, n_fft, hop_length, num_segments, workers, cache, instrumentation):
+            if feature_mode == "pooled":
+                with instrumentation.timer("pool"):
+                    features = pool_features(features)
+            with instrumentation.timer("write"):
+                csv_row = features_to_row(features).tolist()
+                # label
+                csv_row += [label_index]
+                wr.writerow(csv_row)
+
+    return label_map
+
+def save_features_in_store(dataset_paths, store_path, num_mfcc=13, n_fft=2048, hop_length=512, num_segments=5, workers=1, instrumentation=NULL_INSTRUMENTATION, mapping_file=None, cache=None, chunk_size=256, resume=True, feature_mode="frames"):
+    """Extracts features from dataset and saves them into a binary feature store (see feature_store) along with labels.
+
+        Rows are the same as in save_features_in_CSV, committed to disk every chunk_size rows. An interrupted run
+        over the same files and parameters resumes after the last committed chunk. Load with feature_store.load_feature_store.
+
+        :param dataset_path (str): Path to dataset
+        :param store_path (str): Path to feature store directory
+        :param num_mfcc (int): Number of coefficients to extract
+        :param n_fft (int): Interval we consider to apply FFT. Measured in # of samples
+        :param hop_length (int): Sliding window for FFT. Measured in # of samples
+        :param: num_segments (int): Number of segments we want to divide sample tracks into
+        :param workers (int): Number of worker processes
+        :param instrumentation (Instrumentation): Records the decode, featurize and write times
+        :param mapping_file (file): File to write the label mapping to
+        :param cache (FeatureCache): Feature cache, None to always extract
+        :param chunk_size (int): Number of rows committed at a time
+        :param resume (bool): Resume an interrupted run instead of starting over
+        :param feature_mode (str): "frames" or "pooled", see get_features_csv_row
+        :return label_map (dict): Label -> label index
+        """
+
+    label_map, files = list_dataset_files(dataset_paths)
+    if mapping_file:
+        for semantic_label, label_index in label_map.items():
+            mapping_file.write("\n{}: \"{}\"".format(label_index, semantic_label))
+
+    metadata = {
+        # a run is only resumed over the same list of files
+        "files_digest": hashlib.blake2b(json.dumps(files).encode(), digest_size=20).hexdigest(),
+        "label_map": label_map,
+        "sample_rate": SAMPLE_RATE,
+        "num_mfcc": num_mfcc,
+        "n_fft": n_fft,
+        "hop_length": hop_length,
+        "num_segments": num_segments,
+        "feature_mode": feature_mode,
+    }
+    with FeatureStoreWriter(store_path, metadata, chunk_size=chunk_size, resume=resume) as writer:
+        # skip the files already committed by an interrupted run
+        remaining_files = files[writer.num_files:]
+        for label_index, file_path, d, features, _ in iter_feature_records(remaining_files, num_mfcc, n_fft, hop_length, num_segments, workers, cache, instrumentation):
+            if feature_mode == "pooled":
+                with instrumentation.timer("pool"):
+                    features = pool_features(features)
+            if "layout" not in writer.metadata:
+                writer.metadata["layout"] = feature_layout(features)
+            with instrumentation.timer("write"):
+                writer.write(features_to_row(features), label_index)
+                if d == num_segments - 1:
+                    writer.end_file()
+
+    return label_map
+
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Extracts the features of the clean datasets.")
+    parser.add_argument("--format", choices=["store", "csv"], default="store", help="output format of the feature datasets")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to extract features")
+    parser.add_argument("--cache-dir", default=FEATURE_CACHE_PATH, help="directory of the feature cache")
+    parser.add_argument("--cache-size", type=int, default=1024, help="maximum size of the feature cache in MB")
+    parser.add_argument("--no-cache", action="store_true", help="extract the features of every file again")
+    parser.add_argument("--chunk-size", type=int, default=256, help="number of rows committed to the feature store at a time")
+    parser.add_argument("--restart", action="store_true", help="rebuild the feature stores instead of resuming an interrupted run")
+    parser.add_argument("--feature-mode", choices=["frames", "pooled"], default="frames", help="every frame of the features, or their statistics over time")
+    parser.add_argument("--instrument-level", choices=LEVELS, default="summary", help="metrics recorded and saved as detection_metrics.json / classification_metrics.json")
+    args = parser.parse_args()
+    cache = None if args.no_cache else FeatureCache(args.cache_dir, max_bytes=args.cache_size * 2**20)
 
     mapping_file = open(os.path.join(BASE_DIR, "mapping.txt"), 'w')
     print("Creating detection feature dataset.")
     mapping_file.write("\nDetection:")
-    # log_file = open(os.path.join(BASE_DIR, "detection_log.txt"), 'w')
-    # save_features_in_JSON(DETECTION_DATASET_PATHS, DETECTION_JSON_PATH, num_segments=1)
-    # log_file.close()
-    log_file = open(os.path.join(BASE_DIR, "detection_log.txt"), 'w')
-    save_features_in_CSV(DETECTION_DATASET_PATHS, DETECTION_CSV_PATH, num_segments=1)
-    log_file.close()
+    # with Instrumentation(args.instrument_level) as instrumentation:
+    #     save_features_in_JSON(DETECTION_DATASET_PATHS, DETECTION_JSON_PATH, num_segments=1, workers=args.workers, instrumentation=instrumentation, cache=cache)
+    with Instrumentation(args.instrument_level) as instrumentation:
+        if args.format == "csv":
+            save_features_in_CSV(DETECTION_DATASET_PATHS, DETECTION_CSV_PATH, num_segments=1, workers=args.workers, instrumentation=instrumentation, mapping_file=mapping_file, cache=cache, feature_mode=args.feature_mode)
+        else:
+            save_features_in_store(DETECTION_DATASET_PATHS, DETECTION_STORE_PATH, num_segments=1, workers=args.workers, instrumentation=instrumentation, mapping_file=mapping_file, cache=cache, chunk_size=args.chunk_size, resume=not args.restart, feature_mode=args.feature_mode)
+    if instrumentation.enabled:
+        with open(os.path.join(BASE_DIR, "detection_metrics.json"), 'w') as fp:
+            instrumentation.write(fp)
     print("Detection feature dataset created successuflly.")
 
     print("Creating classification feature dataset.")
     mapping_file.write("\nClassification:")
-    # log_file = open(os.path.join(BASE_DIR, "classification_log.txt"), 'w')
-    # save_features_in_JSON(CLASSIFICATION_DATASET_PATHS, CLASSIFICATION_JSON_PATH, num_segments=1)
-    # log_file.close()
-    log_file = open(os.path.join(BASE_DIR, "classification_log.txt"), 'w')
-    save_features_in_CSV(CLASSIFICATION_DATASET_PATHS, CLASSIFICATION_CSV_PATH, num_segments=1)
-    log_file.close()
+    # with Instrumentation(args.instrument_level) as instrumentation:
+    #     save_features_in_JSON(CLASSIFICATION_DATASET_PATHS, CLASSIFICATION_JSON_PATH, num_segments=1, workers=args.workers, instrumentation=instrumentation, cache=cache)
+    with Instrumentation(args.instrument_level) as instrumentation:
+        if args.format == "csv":
+            save_features_in_CSV(CLASSIFICATION_DATASET_PATHS, CLASSIFICATION_CSV_PATH, num_segments=1, workers=args.workers, instrumentation=instrumentation, mapping_file=mapping_file, cache=cache, feature_mode=args.feature_mode)
+        else:
+            save_features_in_store(CLASSIFICATION_DATASET_PATHS, CLASSIFICATION_STORE_PATH, num_segments=1, workers=args.workers, instrumentation=instrumentation, mapping_file=mapping_file, cache=cache, chunk_size=args.chunk_size, resume=not args.restart, feature_mode=args.feature_mode)
+    if instrumentation.enabled:
+        with open(os.path.join(BASE_DIR, "classification_metrics.json"), 'w') as fp:
+            instrumentation.write(fp)
     print("Classification feature dataset created successuflly.")
-    mapping_file.close()
\ No newline at end of file
+    mapping_file.close()
+    if cache:
+        print("Feature cache: {}".format(json.dumps(cache.stats())))
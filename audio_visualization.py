@@ -1,125 +1,40 @@
 # -*- coding: utf-8 -*-
 
+import argparse
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import librosa, librosa.display
-import matplotlib.pyplot as plt
-import sklearn
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+import sklearn.preprocessing
+from audio_decode import read_audio
+from audio_preprocessing import AUDIO_EXTENSIONS
+from features import SIGNAL_OFFSET, chroma_stft, log_mel_spectrogram, spectral_bandwidths
 
 FIG_SIZE = (15,10)
-
-# file = "detection_dataset/cough/1745-9974-2-1-S1.mp3"
-file = "detection_dataset/cough/1745-9974-2-1-S9.mp3"
-
-# load audio file with Librosa
-signal, sample_rate = librosa.load(file, sr=22050)
-librosa.get_duration(y=signal, sr=sample_rate)
-
-# WAVEFORM
-# display waveform
-plt.figure(figsize=FIG_SIZE)
-librosa.display.waveplot(signal, sample_rate, alpha=0.4)
-plt.xlabel("Time (s)")
-plt.ylabel("Amplitude")
-plt.title("Waveform")
-
-
-# FFT -> power spectrum
-# perform Fourier transform
-fft = np.fft.fft(signal)
-
-# calculate abs values on complex numbers to get magnitude
-# magnitude
-spectrum = np.abs(fft)
-
-# create frequency variable
-# creates len(spectrum) number of equally spaced numbers from 0 to sample_rate (inclusive)
-frequency = np.linspace(0, sample_rate, len(spectrum))
-
-# plot spectrum
-plt.figure(figsize=FIG_SIZE)
-plt.plot(frequency, spectrum, alpha=0.4)
-plt.xlabel("Frequency")
-plt.ylabel("Magnitude")
-plt.title("Full Power spectrum")
-
-# take half of the spectrum and frequency
-# since the plot is symetric
-left_spectrum = spectrum[:int(len(spectrum)/2)]
-left_frequency = frequency[:int(len(spectrum)/2)]
-
-# plot spectrum
-plt.figure(figsize=FIG_SIZE)
-plt.plot(left_frequency, left_spectrum, alpha=0.4)
-plt.xlabel("Frequency")
-plt.ylabel("Magnitude")
-plt.title("Half Power spectrum")
-
-
-# STFT -> spectrogram
-hop_length = 512 # in num. of samples
-
-# setting n_ftt as a power of 2 optimizes the speed of fft
-n_fft = 2048 # window in num. of samples
-
-# the intervals created using hop_length and n_fft may overlap
-# which is desirable in certain cases
-
-
-# calculate duration hop length and window in seconds
-hop_length_duration = float(hop_length)/sample_rate
-n_fft_duration = float(n_fft)/sample_rate
-
-print("STFT hop length duration is: {}s".format(hop_length_duration))
-print("STFT window duration is: {}s".format(n_fft_duration))
-print("STFT window overlap duration is: {}s".format(n_fft_duration-hop_length_duration))
-
-# perform stft
-stft = librosa.stft(signal, n_fft=n_fft, hop_length=hop_length)
-
-# calculate abs values on complex numbers to get magnitude
-spectrogram = np.abs(stft)
-
-# display spectrogram
-plt.figure(figsize=FIG_SIZE)
-librosa.display.specshow(spectrogram, sr=sample_rate, hop_length=hop_length)
-plt.xlabel("Time")
-plt.ylabel("Frequency")
-plt.colorbar()
-plt.title("Spectrogram")
-
-# apply logarithm to cast amplitude to Decibels
-log_spectrogram = librosa.amplitude_to_db(spectrogram)
-
-plt.figure(figsize=FIG_SIZE)
-librosa.display.specshow(log_spectrogram, sr=sample_rate, hop_length=hop_length)
-plt.xlabel("Time")
-plt.ylabel("Frequency")
-plt.colorbar(format="%+2.0f dB")
-plt.title("Spectrogram (dB)")
-
-
-
-
-
-
-# MFCCs
-# extract 13 MFCCs
-MFCCs = librosa.feature.mfcc(signal, sample_rate, n_fft=n_fft, hop_length=hop_length, n_mfcc=13)
-print("Shape of the MFCCs is {}".format(MFCCs.shape))
-# display MFCCs
-plt.figure(figsize=FIG_SIZE)
-librosa.display.specshow(MFCCs, sr=sample_rate, hop_length=hop_length)
-plt.xlabel("Time")
-plt.ylabel("MFCC coefficients")
-plt.colorbar()
-plt.title("MFCCs")
-
-# show plots
-plt.show()
-
-
-
-
+SAMPLE_RATE = 22050
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PLOTS_PATH = os.path.join(BASE_DIR, "plots")
+# samples shown by the zero-crossing panel
+ZERO_CROSSING_WINDOW = (9000, 9100)
+# panels of a collage, in row order on a grid of COLLAGE_SHAPE
+PANELS = [
+    "waveform",
+    "full_power_spectrum",
+    "half_power_spectrum",
+    "spectrogram",
+    "spectrogram_db",
+    "mfcc",
+    "spectral_centroid",
+    "spectral_rolloff",
+    "spectral_bandwidth",
+    "zero_crossing_rate",
+    "chroma",
+]
+COLLAGE_SHAPE = (4, 3)
 
 
 # Normalising function for data visualisation
@@ -127,71 +42,195 @@ def normalize(x, axis=0):
     return sklearn.preprocessing.minmax_scale(x, axis=axis)
 
 
-
-
-
-# Spectral Centeriod
-spectral_centroids = librosa.feature.spectral_centroid(signal, sr=sample_rate)[0]
-# Computing the time variable for visualization
-plt.figure(figsize=FIG_SIZE)
-frames = range(len(spectral_centroids))
-t = librosa.frames_to_time(frames)
-# Plotting the Spectral Centroid along the waveform
-librosa.display.waveplot(signal, sr=sample_rate, alpha=0.4)
-plt.plot(t, normalize(spectral_centroids), color='b')
-plt.title("Spectral Centeriod")
-
-
-
-
-
-# Spectral Rolloff
-spectral_rolloff = librosa.feature.spectral_rolloff(signal+0.01, sr=sample_rate)[0]
-plt.figure(figsize=FIG_SIZE)
-librosa.display.waveplot(signal, sr=sample_rate, alpha=0.4)
-plt.plot(t, normalize(spectral_rolloff), color='r')
-plt.title("Spectral Rolloff")
-
-
-
-
-
-# Spectral Bandwidth
-spectral_bandwidth_2 = librosa.feature.spectral_bandwidth(signal+0.01, sr=sample_rate)[0]
-spectral_bandwidth_3 = librosa.feature.spectral_bandwidth(signal+0.01, sr=sample_rate, p=3)[0]
-spectral_bandwidth_4 = librosa.feature.spectral_bandwidth(signal+0.01, sr=sample_rate, p=4)[0]
-plt.figure(figsize=FIG_SIZE)
-librosa.display.waveplot(signal, sr=sample_rate, alpha=0.4)
-plt.plot(t, normalize(spectral_bandwidth_2), color='r')
-plt.plot(t, normalize(spectral_bandwidth_3), color='g')
-plt.plot(t, normalize(spectral_bandwidth_4), color='y')
-plt.legend(('p = 2', 'p = 3', 'p = 4'))
-plt.title("Spectral Bandwidth")
-
-
-
-
-
-# Zero-Crossing Rate
-#Plot the signal:
-plt.figure(figsize=FIG_SIZE)
-librosa.display.waveplot(signal, sr=sample_rate)
-# Zooming in
-n0 = 9000
-n1 = 9100
-plt.figure(figsize=FIG_SIZE)
-plt.plot(signal[n0:n1])
-plt.grid()
-zero_crossings = librosa.zero_crossings(signal[n0:n1], pad=False)
-print("Zero crossings in the interval [{},{}] is {}".format(n0, n1, sum(zero_crossings)))
-plt.title("Zero-Crossing Rate")
-
-
-
-
-
-# Chroma Features
-chromagram = librosa.feature.chroma_stft(signal, sr=sample_rate, hop_length=hop_length)
-plt.figure(figsize=FIG_SIZE)
-librosa.display.specshow(chromagram, x_axis='time', y_axis='chroma', hop_length=hop_length, cmap='coolwarm')
-plt.title("Chroma Features")
\ No newline at end of file
+@functools.lru_cache(maxsize=16)
+def _offset_stft(length, n_fft, hop_length):
+    # STFT of a constant signal of ones, the same for every clip of a given length
+    return librosa.stft(np.ones(length, dtype=np.float32), n_fft=n_fft, hop_length=hop_length)
+
+
+def compute_panels(signal, sample_rate=SAMPLE_RATE, n_fft=2048, hop_length=512, num_mfcc=13):
+    """Computes the data of every panel of a collage from one rfft and one STFT of the signal.
+
+        The rolloff and bandwidth of signal+SIGNAL_OFFSET, as in the feature datasets, are derived from the same
+        STFT by linearity, adding the STFT of the constant offset.
+
+        :param signal (ndarray): Audio time series
+        :return panels (dict): Arrays of every panel
+        """
+
+    spectrum = np.abs(np.fft.rfft(signal))
+    # the spectrum of a real signal is symmetric, the second half mirrors the first
+    full_spectrum = np.concatenate([spectrum, spectrum[1:len(signal) - len(spectrum) + 1][::-1]])
+
+    stft = librosa.stft(signal, n_fft=n_fft, hop_length=hop_length)
+    spectrogram = np.abs(stft)
+    power_spectrogram = spectrogram**2
+    offset_spectrogram = np.abs(stft + SIGNAL_OFFSET * _offset_stft(len(signal), n_fft, hop_length))
+
+    return {
+        "signal": signal,
+        "full_spectrum": full_spectrum,
+        "full_frequency": np.linspace(0, sample_rate, len(full_spectrum)),
+        "half_spectrum": spectrum[:len(signal) // 2],
+        "half_frequency": np.linspace(0, sample_rate, len(full_spectrum))[:len(signal) // 2],
+        "spectrogram": spectrogram,
+        "log_spectrogram": librosa.amplitude_to_db(spectrogram),
+        "mfcc": librosa.feature.mfcc(S=log_mel_spectrogram(power_spectrogram, sample_rate), n_mfcc=num_mfcc),
+        "spectral_centroid": librosa.feature.spectral_centroid(S=spectrogram, sr=sample_rate, n_fft=n_fft)[0],
+        "spectral_rolloff": librosa.feature.spectral_rolloff(S=offset_spectrogram, sr=sample_rate, n_fft=n_fft)[0],
+        "spectral_bandwidth": dict(spectral_bandwidths(offset_spectrogram, sample_rate, (2, 3, 4), n_fft=n_fft)),
+        "chroma": chroma_stft(power_spectrogram, sample_rate),
+    }
+
+
+def _waveform(ax, signal, sample_rate, **kwargs):
+    librosa.display.waveshow(signal, sr=sample_rate, ax=ax, **kwargs)
+
+
+def render_collage(signal, sample_rate=SAMPLE_RATE, n_fft=2048, hop_length=512, title=None):
+    """Renders all the panels of a clip into a single figure, without any display.
+
+        :param signal (ndarray): Audio time series
+        :param title (str): Title of the figure, e.g. the file name
+        :return figure (Figure): Figure of PANELS on a COLLAGE_SHAPE grid
+        """
+
+    data = compute_panels(signal, sample_rate, n_fft, hop_length)
+    rows, columns = COLLAGE_SHAPE
+    figure = Figure(figsize=(FIG_SIZE[0] * columns / 2, FIG_SIZE[1] * rows / 2))
+    axes = figure.subplots(rows, columns).ravel()
+    for ax in axes[len(PANELS):]:
+        ax.axis("off")
+    ax = dict(zip(PANELS, axes))
+    t = librosa.frames_to_time(np.arange(len(data["spectral_centroid"])), sr=sample_rate, hop_length=hop_length)
+
+    # WAVEFORM
+    _waveform(ax["waveform"], signal, sample_rate, alpha=0.4)
+    ax["waveform"].set(xlabel="Time (s)", ylabel="Amplitude", title="Waveform")
+
+    # FFT -> power spectrum
+    ax["full_power_spectrum"].plot(data["full_frequency"], data["full_spectrum"], alpha=0.4)
+    ax["full_power_spectrum"].set(xlabel="Frequency", ylabel="Magnitude", title="Full Power spectrum")
+    ax["half_power_spectrum"].plot(data["half_frequency"], data["half_spectrum"], alpha=0.4)
+    ax["half_power_spectrum"].set(xlabel="Frequency", ylabel="Magnitude", title="Half Power spectrum")
+
+    # STFT -> spectrogram
+    image = librosa.display.specshow(data["spectrogram"], sr=sample_rate, hop_length=hop_length, ax=ax["spectrogram"])
+    figure.colorbar(image, ax=ax["spectrogram"])
+    ax["spectrogram"].set(xlabel="Time", ylabel="Frequency", title="Spectrogram")
+    image = librosa.display.specshow(data["log_spectrogram"], sr=sample_rate, hop_length=hop_length, ax=ax["spectrogram_db"])
+    figure.colorbar(image, ax=ax["spectrogram_db"], format="%+2.0f dB")
+    ax["spectrogram_db"].set(xlabel="Time", ylabel="Frequency", title="Spectrogram (dB)")
+
+    # MFCCs
+    image = librosa.display.specshow(data["mfcc"], sr=sample_rate, hop_length=hop_length, ax=ax["mfcc"])
+    figure.colorbar(image, ax=ax["mfcc"])
+    ax["mfcc"].set(xlabel="Time", ylabel="MFCC coefficients", title="MFCCs")
+
+    # Spectral Centeriod
+    _waveform(ax["spectral_centroid"], signal, sample_rate, alpha=0.4)
+    ax["spectral_centroid"].plot(t, normalize(data["spectral_centroid"]), color='b')
+    ax["spectral_centroid"].set(title="Spectral Centeriod")
+
+    # Spectral Rolloff
+    _waveform(ax["spectral_rolloff"], signal, sample_rate, alpha=0.4)
+    ax["spectral_rolloff"].plot(t, normalize(data["spectral_rolloff"]), color='r')
+    ax["spectral_rolloff"].set(title="Spectral Rolloff")
+
+    # Spectral Bandwidth
+    _waveform(ax["spectral_bandwidth"], signal, sample_rate, alpha=0.4)
+    lines = [ax["spectral_bandwidth"].plot(t, normalize(data["spectral_bandwidth"][p]), color=color)[0] for p, color in ((2, 'r'), (3, 'g'), (4, 'y'))]
+    ax["spectral_bandwidth"].legend(lines, ('p = 2', 'p = 3', 'p = 4'))
+    ax["spectral_bandwidth"].set(title="Spectral Bandwidth")
+
+    # Zero-Crossing Rate, zoomed in
+    n0, n1 = ZERO_CROSSING_WINDOW
+    if n1 > len(signal):
+        n0, n1 = max(0, len(signal) - (n1 - n0)), len(signal)
+    ax["zero_crossing_rate"].plot(signal[n0:n1])
+    ax["zero_crossing_rate"].grid()
+    zero_crossings = librosa.zero_crossings(signal[n0:n1], pad=False)
+    ax["zero_crossing_rate"].set(title="Zero-Crossing Rate ({} in [{},{}])".format(int(np.sum(zero_crossings)), n0, n1))
+
+    # Chroma Features
+    librosa.display.specshow(data["chroma"], x_axis='time', y_axis='chroma', sr=sample_rate, hop_length=hop_length, cmap='coolwarm', ax=ax["chroma"])
+    ax["chroma"].set(title="Chroma Features")
+
+    if title:
+        figure.suptitle(title)
+    # fixed margins, tight_layout would draw the whole figure once more
+    figure.subplots_adjust(left=0.04, right=0.97, bottom=0.04, top=0.94, wspace=0.25, hspace=0.35)
+    return figure
+
+
+def render_file(file_path, output_path, sample_rate=SAMPLE_RATE, dpi=50):
+    """Renders the collage of an audio file into an image file.
+
+        Runs in the worker processes, errors are returned instead of raised.
+
+        :param file_path (str): Path to audio file
+        :param output_path (str): Path to the image, its format given by the extension
+        :param dpi (int): Resolution of the image
+        :return error (str): None if the collage was saved
+        """
+
+    try:
+        signal, sample_rate = read_audio(file_path, sr=sample_rate)
+        figure = render_collage(signal, sample_rate, title=os.path.basename(file_path))
+        figure.savefig(output_path, dpi=dpi)
+    except Exception as e:
+        return "{}: {}".format(type(e).__name__, e)
+    return None
+
+
+def _render_file_args(args):
+    return render_file(*args)
+
+
+def render_collages(paths, output_dir=PLOTS_PATH, workers=1, image_format="png", dpi=50):
+    """Renders the collage of every audio file of paths (files or directories, searched recursively) in parallel.
+
+        Collages are saved in output_dir under the path of the file relative to its directory, with '/' replaced by '_'.
+
+        :param paths (list): Audio files and directories
+        :param output_dir (str): Directory the images are saved in
+        :param workers (int): Number of worker processes
+        :return failures (dict): File path -> error of the files that could not be rendered
+        """
+
+    tasks = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for f in sorted(filenames):
+                    if f.lower().endswith(AUDIO_EXTENSIONS):
+                        file_path = os.path.join(dirpath, f)
+                        tasks.append((file_path, os.path.relpath(file_path, path)))
+        else:
+            tasks.append((path, os.path.basename(path)))
+
+    os.makedirs(output_dir, exist_ok=True)
+    args = [(file_path, os.path.join(output_dir, "{}.{}".format(os.path.splitext(name)[0].replace(os.sep, "_"), image_format)), SAMPLE_RATE, dpi)
+            for file_path, name in tasks]
+    if workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            errors = list(executor.map(_render_file_args, args, chunksize=4))
+    else:
+        errors = list(map(_render_file_args, args))
+    return {file_path: error for (file_path, _), error in zip(tasks, errors) if error}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Renders a collage of the waveform, spectra and features of audio clips.")
+    parser.add_argument("paths", nargs="*", default=["detection_dataset/cough/1745-9974-2-1-S9.mp3"], help="audio files and directories")
+    parser.add_argument("--output-dir", default=PLOTS_PATH, help="directory the collages are saved in")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes used to render")
+    parser.add_argument("--format", default="png", help="image format of the collages")
+    parser.add_argument("--dpi", type=int, default=50, help="resolution of the collages")
+    args = parser.parse_args()
+
+    failures = render_collages(args.paths, args.output_dir, args.workers, args.format, args.dpi)
+    for file_path, error in failures.items():
+        print("{}: {}".format(file_path, error))
@@ -0,0 +1,405 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import functools
+import json
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import librosa
+from audio_decode import load_audio
+from audio_preprocessing import DETECTION_DATASET_PATHS, SAMPLE_RATE, get_features_batch, list_dataset_files, bounded_map
+from features import FEATURE_NDIM, extract_features, feature_layout, pool_features
+
+# duration of the clips of the clean datasets, shorter clips are padded with zeros and longer ones cut
+CLIP_DURATION = 5
+# noise signals mixed into the clips, drawn once per clip length with NOISE_SEED
+NOISE_BANK_SIZE = 32
+NOISE_SEED = 7
+# clips featurized together, bounding the memory of the STFTs of a batch
+CHUNK_SIZE = 32
+# features whose bins are masked by the frequency masks, the others only have a frames axis
+MASKED_BINS_FEATURES = [name for name, ndim in FEATURE_NDIM.items() if ndim == 2]
+
+
+class Augmenter:
+    """Random variants of a batch of clips, featurized by the same extract_features pass as the clips themselves.
+
+        Every augmentation is applied to a clip with probability p, with random parameters drawn from the
+        random state of the batch, so a (seed, epoch, batch) gives the same variants in any process:
+
+        - time stretch (phase vocoder) and pitch shift (magnitudes moved along the frequency axis) of the STFT,
+          keeping the number of frames
+        - gain and additive noise at a random SNR, from a bank of noise signals drawn once
+        - circular time shift
+        - SpecAugment time and frequency masks on the features, filled with the mean of the feature
+
+        Only the clips that are stretched or pitch shifted go through an STFT of their own, and are synthesized
+        back. The features of every variant are then computed from its signal, as get_features_batch does, since
+        the bandwidths of signal+SIGNAL_OFFSET depend on the float32 rounding of its quiet frames and cannot be
+        derived from another STFT. With p=0 and no masks the features are exactly the ones of get_features_batch.
+        """
+
+    def __init__(self, p=0.5, time_shift=0.2, gain_db=6.0, snr_db=(10.0, 30.0), time_stretch=0.15, pitch_shift=2.0,
+                 time_masks=2, time_mask_width=0.1, freq_masks=2, freq_mask_width=0.2):
+        """
+            :param p (float): Probability of every augmentation, the masks included, being applied to a clip
+            :param time_shift (float): Maximum shift, as a share of the clip duration
+            :param gain_db (float): Maximum gain, in dB either way
+            :param snr_db (tuple): Range of the signal to noise ratio of the added noise, in dB
+            :param time_stretch (float): Maximum change of speed, rates being drawn in [1 - time_stretch, 1 + time_stretch]
+            :param pitch_shift (float): Maximum pitch shift, in semitones either way
+            :param time_masks (int): Number of time masks of every clip
+            :param time_mask_width (float): Maximum width of a time mask, as a share of the frames
+            :param freq_masks (int): Number of frequency masks of every 2-D feature
+            :param freq_mask_width (float): Maximum width of a frequency mask, as a share of the bins
+            """
+
+        self.p = p
+        self.time_shift = time_shift
+        self.gain_db = gain_db
+        self.snr_db = snr_db
+        self.time_stretch = time_stretch
+        self.pitch_shift = pitch_shift
+        self.time_masks = time_masks
+        self.time_mask_width = time_mask_width
+        self.freq_masks = freq_masks
+        self.freq_mask_width = freq_mask_width
+
+    def sample(self, batch_size, num_samples, random_state):
+        """Draws the parameters of the augmentations of a batch, the identity for the clips they are not applied to.
+
+            :param batch_size (int): Number of clips
+            :param num_samples (int): Number of samples of every clip
+            :param random_state (RandomState): Random state of the batch
+            :return params (dict): Parameter name -> ndarray of shape (batch,)
+            """
+
+        def applied():
+            return random_state.random_sample(batch_size) < self.p
+
+        max_shift = int(self.time_shift * num_samples)
+        return {
+            "shift": np.where(applied(), random_state.randint(-max_shift, max_shift + 1, batch_size), 0),
+            "gain": np.where(applied(), 10.0 ** (random_state.uniform(-self.gain_db, self.gain_db, batch_size) / 20), 1.0),
+            "snr": np.where(applied(), random_state.uniform(self.snr_db[0], self.snr_db[1], batch_size), np.inf),
+            "noise": random_state.randint(NOISE_BANK_SIZE, size=batch_size),
+            "rate": np.where(applied(), random_state.uniform(1 - self.time_stretch, 1 + self.time_stretch, batch_size), 1.0),
+            "pitch": np.where(applied(), 2.0 ** (random_state.uniform(-self.pitch_shift, self.pitch_shift, batch_size) / 12), 1.0),
+            "masked": applied(),
+        }
+
+    @functools.lru_cache(maxsize=4)
+    def _noise(self, num_samples):
+        # white noise of unit variance, the same in every process
+        return np.random.RandomState(NOISE_SEED).standard_normal((NOISE_BANK_SIZE, num_samples)).astype(np.float32)
+
+    def _noise_scales(self, signals, params):
+        # noise amplitude giving the drawn SNR relative to the gained signal, 0 where no noise is added
+        rms = np.sqrt(np.mean(np.square(signals, dtype=np.float64), axis=-1))
+        return params["gain"] * rms * 10.0 ** (-params["snr"] / 20)
+
+    def warp_stft(self, stft, params, n_fft, hop_length):
+        """Applies the time stretch and pitch shift of the batch to its STFT.
+
+            :param stft (ndarray): Complex STFT of the batch, of shape (batch, freqs, frames)
+            :param params (dict): Parameters returned by sample
+            :return stft (ndarray): Complex STFT of the variants, of the same shape
+            """
+
+        stft = stft.copy()
+        num_frames = stft.shape[-1]
+        for i in np.flatnonzero(params["rate"] != 1.0):
+            stretched = librosa.phase_vocoder(stft[i], rate=params["rate"][i], hop_length=hop_length, n_fft=n_fft)
+            # faster clips end with silence, slower ones are cut
+            stft[i] = librosa.util.fix_length(stretched, size=num_frames, axis=-1)
+
+        shifted = np.flatnonzero(params["pitch"] != 1.0)
+        if len(shifted):
+            # the magnitude at bin f is read at f / ratio by linear interpolation, the phase from the nearest bin
+            num_bins = stft.shape[-2]
+            positions = np.arange(num_bins) / params["pitch"][shifted, np.newaxis]
+            lower = np.minimum(positions.astype(np.int64), num_bins - 2)
+            weights = (positions - lower)[..., np.newaxis]
+            magnitudes = np.abs(stft[shifted])
+            pitched = ((1 - weights) * np.take_along_axis(magnitudes, lower[..., np.newaxis], axis=1)
+                       + weights * np.take_along_axis(magnitudes, lower[..., np.newaxis] + 1, axis=1))
+            # bins read above the Nyquist frequency are empty
+            pitched[positions > num_bins - 1] = 0
+            nearest = np.minimum(np.rint(positions).astype(np.int64), num_bins - 1)
+            phases = np.angle(np.take_along_axis(stft[shifted], nearest[..., np.newaxis], axis=1))
+            stft[shifted] = pitched * np.exp(1j * phases)
+        return stft
+
+    def warp_signals(self, signals, params, n_fft, hop_length):
+        """Stretches and pitch shifts the clips of the batch drawn for it, in the spectral domain, see warp_stft.
+
+            :param signals (ndarray): float32 signals of the batch, of shape (batch, samples)
+            :param params (dict): Parameters returned by sample
+            :return signals (ndarray): float32 signals of the same shape, the other clips left as they are
+            """
+
+        warped = np.flatnonzero((params["rate"] != 1.0) | (params["pitch"] != 1.0))
+        if not len(warped):
+            return signals
+        warped_params = {name: values[warped] for name, values in params.items()}
+        stft = self.warp_stft(librosa.stft(signals[warped], n_fft=n_fft, hop_length=hop_length), warped_params, n_fft, hop_length)
+        signals = signals.copy()
+        signals[warped] = librosa.istft(stft, n_fft=n_fft, hop_length=hop_length, length=signals.shape[-1])
+        return signals
+
+    def augment_signals(self, signals, params, noise_scales):
+        """Applies the gain, noise and shift of the batch to its signals.
+
+            :param signals (ndarray): Signals of the batch, of shape (batch, samples)
+            :param params (dict): Parameters returned by sample
+            :param noise_scales (ndarray): Amplitude of the noise of every clip
+            :return signals (ndarray): float32 variants of the same shape
+            """
+
+        noise = self._noise(signals.shape[-1])[params["noise"]]
+        signals = (params["gain"][:, np.newaxis] * signals + noise_scales[:, np.newaxis] * noise).astype(np.float32)
+        for i in np.flatnonzero(params["shift"]):
+            signals[i] = np.roll(signals[i], params["shift"][i])
+        return signals
+
+    def mask(self, features, random_state, applied=None):
+        """Applies SpecAugment masks to the features of a batch, in place.
+
+            The time masks cover the same share of the clip in every feature, the frequency masks cover bins of the
+            2-D features. Masked values are replaced by the mean of the feature over the clip.
+
+            :param features (dict): Feature name -> frames-first ndarray of shape (batch, frames, ...), see extract_features
+            :param random_state (RandomState): Random state of the batch
+            :param applied (ndarray): Whether every clip is masked, drawn with probability p if None
+            :return features (dict): The masked features
+            """
+
+        batch_size = len(next(iter(features.values())))
+        if applied is None:
+            applied = random_state.random_sample(batch_size) < self.p
+        starts = random_state.random_sample((self.time_masks, batch_size))
+        widths = random_state.random_sample((self.time_masks, batch_size)) * self.time_mask_width
+        bin_masks = {name: self._draw_masks(batch_size, features[name].shape[2], self.freq_masks, self.freq_mask_width, random_state)
+                     for name in MASKED_BINS_FEATURES}
+        for name, feature in features.items():
+            num_frames = feature.shape[1]
+            frames = np.arange(num_frames)
+            masked = np.zeros((batch_size, num_frames), dtype=bool)
+            for start, width in zip(starts * num_frames, widths * num_frames):
+                masked |= (frames >= start[:, np.newaxis]) & (frames < (start + width)[:, np.newaxis])
+            masked &= applied[:, np.newaxis]
+            means = np.mean(feature.reshape(batch_size, -1), axis=-1)
+            if feature.ndim == 2:
+                features[name] = np.where(masked, means[:, np.newaxis], feature)
+            else:
+                masked = masked[:, :, np.newaxis] | (bin_masks[name] & applied[:, np.newaxis])[:, np.newaxis, :]
+                features[name] = np.where(masked, means[:, np.newaxis, np.newaxis], feature)
+        return features
+
+    def mask_tensors(self, tensors, bins, random_state):
+        """Applies SpecAugment masks to a batch of stacked 2-D features, see TensorDataset.
+
+            Every clip is masked with probability p.
+
+            :param tensors (ndarray): Batch of shape (batch, frames, bins), not modified
+            :param bins (list): Slice of the bins axis of every feature, frequency masks stay within a feature
+            :param random_state (RandomState): Random state of the batch
+            :return tensors (ndarray): Masked copy of the batch
+            """
+
+        batch_size, num_frames = tensors.shape[:2]
+        tensors = np.array(tensors)
+        applied = random_state.random_sample(batch_size) < self.p
+        time_masks = self._draw_masks(batch_size, num_frames, self.time_masks, self.time_mask_width, random_state) & applied[:, np.newaxis]
+        for feature_bins in bins:
+            feature = tensors[..., feature_bins]
+            bin_masks = self._draw_masks(batch_size, feature.shape[-1], self.freq_masks, self.freq_mask_width, random_state) & applied[:, np.newaxis]
+            masked = time_masks[:, :, np.newaxis] | bin_masks[:, np.newaxis, :]
+            means = np.mean(feature, axis=(1, 2), keepdims=True)
+            tensors[..., feature_bins] = np.where(masked, means, feature)
+        return tensors
+
+    def _draw_masks(self, batch_size, size, num_masks, max_width, random_state):
+        # num_masks random intervals of up to max_width * size consecutive positions per clip
+        positions = np.arange(size)
+        masked = np.zeros((batch_size, size), dtype=bool)
+        for _ in range(num_masks):
+            widths = random_state.randint(0, int(max_width * size) + 1, batch_size)
+            starts = random_state.randint(0, size, batch_size)
+            masked |= (positions >= starts[:, np.newaxis]) & (positions < (starts + widths)[:, np.newaxis])
+        return masked
+
+    def extract(self, signals, sample_rate, num_mfcc=13, n_fft=2048, hop_length=512, random_state=None):
+        """Extracts the features of random variants of a batch of equal-length clips.
+
+            :param signals (ndarray): Stacked clips of shape (batch, samples)
+            :param random_state (RandomState): Random state of the batch, e.g. RandomState([seed, epoch, batch])
+            :return features (dict): Feature name -> ndarray, as returned by extract_features
+            """
+
+        signals = np.asarray(signals, dtype=np.float32)
+        random_state = random_state if random_state is not None else np.random.RandomState()
+        num_samples = signals.shape[-1]
+        params = self.sample(len(signals), num_samples, random_state)
+        noise_scales = self._noise_scales(signals, params)
+        signals = self.augment_signals(self.warp_signals(signals, params, n_fft, hop_length), params, noise_scales)
+        features = extract_features(signals, sample_rate, num_mfcc, n_fft, hop_length)
+        return self.mask(features, random_state, params["masked"])
+
+
+def read_clip(file_path, duration=CLIP_DURATION, decode_cache=None):
+    """Returns the first duration seconds of a clip at SAMPLE_RATE, padded with zeros.
+        """
+
+    signal, sample_rate = load_audio(file_path, sr=SAMPLE_RATE, duration=duration, cache=decode_cache)
+    return librosa.util.fix_length(np.asarray(signal, dtype=np.float32), size=int(duration * sample_rate))
+
+
+def featurize_clips(file_paths, augmenter=None, seed=None, num_mfcc=13, n_fft=2048, hop_length=512, feature_mode="frames",
+                    duration=CLIP_DURATION, decode_cache=None):
+    """Decodes a batch of clips and extracts the features of their variants, see get_features_batch.
+
+        :param file_paths (list): Paths to the clips
+        :param augmenter (Augmenter): Augmenter, None for the features of the clips themselves
+        :param seed (list): Seed of the random state of the batch, e.g. [seed, epoch, batch]
+        :param decode_cache (DecodeCache): Decode cache of the resampled clips, None to always decode
+        :return features (ndarray): float32 matrix of shape (batch, n_features)
+        """
+
+    signals = np.stack([read_clip(file_path, duration, decode_cache) for file_path in file_paths])
+    random_state = np.random.RandomState(seed) if augmenter else None
+    return get_features_batch(signals, SAMPLE_RATE, num_mfcc, n_fft, hop_length, feature_mode, augmenter, random_state)
+
+
+def _featurize_clips_args(args):
+    return featurize_clips(*args)
+
+
+class AugmentedClips:
+    """Clips of clean datasets featurized batch by batch, with new random variants of the training clips at every epoch.
+
+        Nothing is written to disk: every batch is decoded and featurized when it is needed, by a pool of worker
+        processes if workers > 1. It has the interface of incremental_training.ShardedFeatures, so
+        train_incremental trains on it directly, its seed + epoch seeding the variants of every epoch.
+        """
+
+    def __init__(self, dataset_paths, augmenter=None, num_mfcc=13, n_fft=2048, hop_length=512, feature_mode="frames",
+                 duration=CLIP_DURATION, test_size=0.0, seed=None, balance=False, workers=1, decode_cache=None):
+        """
+            :param dataset_paths (list): Paths to the clean datasets, see list_dataset_files
+            :param augmenter (Augmenter): Augmenter of the training clips, None to train on the clips themselves
+            :param feature_mode (str): "frames" or "pooled", see get_features_csv_row
+            :param duration (float): Duration the clips are padded or cut to
+            :param test_size (float): Share of the clips held out for testing, never augmented
+            :param seed (int): Seed of the held-out clips, and of the variants when batches is given no seed
+            :param balance (bool): Oversample the training clips of the smaller classes up to the largest one
+            :param workers (int): Number of worker processes
+            :param decode_cache (DecodeCache): Decode cache of the resampled clips, None to always decode
+            """
+
+        self.label_map, files = list_dataset_files(dataset_paths)
+        self.file_paths = [file_path for _, file_path in files]
+        self.labels = np.array([label_index for label_index, _ in files], dtype=np.int64)
+        self.augmenter = augmenter
+        self.params = (num_mfcc, n_fft, hop_length, feature_mode, duration, decode_cache)
+        self.seed = seed
+        self.balance = balance
+        self.workers = workers
+        self.test_mask = np.random.RandomState(seed).random_sample(len(files)) < test_size
+
+        # the features of a silent clip give the layout of the rows, librosa warns that it has no tuning
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            features = extract_features(np.zeros(int(duration * SAMPLE_RATE), dtype=np.float32), SAMPLE_RATE, num_mfcc, n_fft, hop_length)
+        if feature_mode == "pooled":
+            features = pool_features(features)
+        self.metadata = {
+            "label_map": self.label_map,
+            "sample_rate": SAMPLE_RATE,
+            "num_mfcc": num_mfcc,
+            "n_fft": n_fft,
+            "hop_length": hop_length,
+            "num_segments": 1,
+            "feature_mode": feature_mode,
+            "layout": feature_layout(features),
+            "num_features": int(sum(np.size(features[name]) for name in features)),
+        }
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def num_features(self):
+        return self.metadata["num_features"]
+
+    def classes(self):
+        return np.unique(self.labels)
+
+    def _rows(self, subset, random_state):
+        rows = np.arange(len(self)) if subset is None else np.flatnonzero(self.test_mask == (subset == "test"))
+        if self.balance and subset == "train" and len(rows):
+            counts = np.bincount(self.labels[rows])
+            extra = [random_state.choice(rows[self.labels[rows] == label], counts.max() - count)
+                     for label, count in enumerate(counts) if count]
+            rows = np.concatenate([rows] + extra)
+        return rows
+
+    def batches(self, batch_size=32, shuffle=True, subset="train", seed=None, prefetch=2):
+        """Yields mini-batches of (features, labels), featurized ahead while the previous ones are used.
+
+            Clips are featurized CHUNK_SIZE at a time whatever the batch size, the training ones being augmented
+            with the random state [seed, chunk index], so an epoch gives the same variants whatever the batch size
+            and the number of workers. The held-out clips are not augmented.
+
+            :param batch_size (int): Number of clips in a batch
+            :param shuffle (bool): Shuffle the clips
+            :param subset (str): "train" or "test" clips, None for all
+            :param seed (int): Seed of the shuffling, the oversampling and the variants, vary it between epochs
+            :param prefetch (int): Number of chunks featurized ahead of the one being used
+            :return: Iterator of (float32 array of shape (batch, features), int64 labels)
+            """
+
+        seed = self.seed if seed is None else seed
+        random_state = np.random.RandomState(seed)
+        rows = self._rows(subset, random_state)
+        if shuffle:
+            rows = random_state.permutation(rows)
+        augmenter = self.augmenter if subset == "train" else None
+        chunk_rows = [rows[start:start + CHUNK_SIZE] for start in range(0, len(rows), CHUNK_SIZE)]
+        args = [([self.file_paths[row] for row in chunk], augmenter, None if seed is None else [seed, index]) + self.params
+                for index, chunk in enumerate(chunk_rows)]
+
+        executor = ProcessPoolExecutor(max_workers=self.workers) if self.workers > 1 else ThreadPoolExecutor(max_workers=1)
+        with executor:
+            # rows left over from the previous chunk, so that every batch but the last one is full
+            features, labels = np.empty((0, self.num_features), dtype=np.float32), np.empty(0, dtype=np.int64)
+            for chunk, chunk_features in zip(chunk_rows, bounded_map(executor, _featurize_clips_args, args, self.workers + max(1, prefetch))):
+                features, labels = np.concatenate([features, chunk_features]), np.concatenate([labels, self.labels[chunk]])
+                stop = len(labels) - len(labels) % batch_size
+                for start in range(0, stop, batch_size):
+                    yield features[start:start + batch_size], labels[start:start + batch_size]
+                features, labels = features[stop:], labels[stop:]
+            if len(labels):
+                yield features, labels
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Featurizes augmented epochs of a clean dataset on the fly and reports the throughput.")
+    parser.add_argument("datasets", nargs="*", default=DETECTION_DATASET_PATHS, help="clean dataset directories")
+    parser.add_argument("--epochs", type=int, default=2, help="number of augmented passes over the clips")
+    parser.add_argument("--batch-size", type=int, default=32, help="number of clips of every batch")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to featurize the batches")
+    parser.add_argument("--feature-mode", choices=["frames", "pooled"], default="frames", help="every frame of the features, or their statistics over time")
+    parser.add_argument("--p", type=float, default=0.5, help="probability of every augmentation")
+    parser.add_argument("--seed", type=int, default=22, help="seed of the variants of the first epoch")
+    args = parser.parse_args()
+
+    clips = AugmentedClips(args.datasets, Augmenter(p=args.p), feature_mode=args.feature_mode, seed=args.seed, workers=args.workers)
+    for epoch in range(args.epochs):
+        started = time.perf_counter()
+        rows = sum(len(labels) for _, labels in clips.batches(args.batch_size, seed=args.seed + epoch))
+        seconds = time.perf_counter() - started
+        print(json.dumps({"epoch": epoch, "clips": rows, "seconds": round(seconds, 3), "clips_per_second": round(rows / seconds, 1)}))
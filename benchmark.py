@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+import librosa
+import soundfile as sf
+from audio_decode import read_audio
+from audio_preprocessing import list_dataset_files, save_features_in_CSV, save_features_in_JSON
+from clip_predictor import ClipFeaturizer
+from feature_cache import FeatureCache
+from features import extract_features, pool_features
+from segmentation import TOP_DB, segment_signal
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_RATE = 22050
+# clip duration of the datasets, features are extracted from clips of this length
+CLIP_DURATION = 5
+BENCHMARK_DATASET_PATHS = {
+    "detection": [os.path.join(BASE_DIR, "detection_dataset")],
+    "classification": [os.path.join(BASE_DIR, "classification_dataset")],
+}
+# relative slowdown of a stage reported as a regression by compare_results
+REGRESSION_THRESHOLD = 0.1
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of the process in MB, since the last reset_peak_rss on Linux.
+        """
+
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # kilobytes on Linux, bytes on macOS, and never reset
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size to the current one (Linux only, a no-op elsewhere).
+        """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except OSError:
+        pass
+
+
+def synthetic_signal(duration, sample_rate=SAMPLE_RATE, seed=0):
+    """Generates a signal of cough-like bursts of noise separated by near silence.
+
+        :param duration (float): Duration of the signal in seconds
+        :param seed (int): Seed of the noise and of the burst positions
+        :return signal (ndarray): Mono float32 signal
+        """
+
+    rng = np.random.RandomState(seed)
+    length = int(duration * sample_rate)
+    signal = 1e-4 * rng.randn(length)
+    start = int(rng.uniform(0.1, 0.5) * sample_rate)
+    while start < length:
+        burst_length = min(int(rng.uniform(0.2, 0.6) * sample_rate), length - start)
+        envelope = np.exp(-np.arange(burst_length) / (0.1 * sample_rate))
+        signal[start:start + burst_length] += rng.uniform(0.2, 0.8) * envelope * rng.randn(burst_length)
+        start += burst_length + int(rng.uniform(0.3, 1.5) * sample_rate)
+    return np.clip(signal, -1, 1).astype(np.float32)
+
+
+def _individual_features(num_mfcc=13, n_fft=2048, hop_length=512):
+    # the librosa.feature calls of get_features_csv_row before the features shared their STFT
+    return {
+        "mfcc": lambda clip: librosa.feature.mfcc(y=clip, sr=SAMPLE_RATE, n_mfcc=num_mfcc, n_fft=n_fft, hop_length=hop_length),
+        "spectral_centroid": lambda clip: librosa.feature.spectral_centroid(y=clip, sr=SAMPLE_RATE),
+        "spectral_rolloff": lambda clip: librosa.feature.spectral_rolloff(y=clip + 0.01, sr=SAMPLE_RATE),
+        "spectral_bandwidth_2": lambda clip: librosa.feature.spectral_bandwidth(y=clip + 0.01, sr=SAMPLE_RATE),
+        "spectral_bandwidth_3": lambda clip: librosa.feature.spectral_bandwidth(y=clip + 0.01, sr=SAMPLE_RATE, p=3),
+        "spectral_bandwidth_4": lambda clip: librosa.feature.spectral_bandwidth(y=clip + 0.01, sr=SAMPLE_RATE, p=4),
+        "zero_crossing_rate": lambda clip: librosa.feature.zero_crossing_rate(clip, pad=False),
+        "chroma": lambda clip: librosa.feature.chroma_stft(y=clip, sr=SAMPLE_RATE, hop_length=hop_length),
+    }
+
+
+def run_stage(fn, items, audio_seconds, repeat=3, clips=None):
+    """Times fn over every item, repeat times.
+
+        :param fn (callable): Stage, called with every item
+        :param items (list): Inputs of the stage
+        :param audio_seconds (float): Duration of the audio the items hold
+        :param clips (int): Number of clips the items hold, len(items) by default (an item may be a batch)
+        :return result (dict): Best and median wall time of a pass, throughputs of the best pass and peak RSS
+        """
+
+    times = []
+    peak = 0.0
+    for _ in range(repeat):
+        reset_peak_rss()
+        started = time.perf_counter()
+        for item in items:
+            fn(item)
+        times.append(time.perf_counter() - started)
+        peak = max(peak, peak_rss_mb())
+    seconds = min(times)
+    clips = len(items) if clips is None else clips
+    return {
+        "seconds": seconds,
+        "median_seconds": statistics.median(times),
+        "clips": clips,
+        "audio_seconds": audio_seconds,
+        "clips_per_second": clips / seconds if seconds else float("inf"),
+        "audio_seconds_per_second": audio_seconds / seconds if seconds else float("inf"),
+        "peak_rss_mb": peak,
+    }
+
+
+def run_benchmarks(datasets=("detection", "classification"), synthetic_count=20, synthetic_duration=30.0, limit=None,
+                   clip_duration=CLIP_DURATION, repeat=3, stages=None, verbose=1):
+    """Benchmarks the preprocessing and feature extraction stages on the bundled datasets and on synthetic signals.
+
+        Decoding stages run on the audio files, silence splitting on the whole decoded signals and the
+        feature stages on their first clip_duration seconds, padded like the clips of clean_dataset.
+        The writer stages save the features of all the clips at once.
+
+        :param datasets (list): Names of the BENCHMARK_DATASET_PATHS to include
+        :param synthetic_count (int): Number of synthetic signals to include
+        :param synthetic_duration (float): Duration of the synthetic signals in seconds
+        :param limit (int): Maximum number of files taken from every dataset, None for all
+        :param clip_duration (float): Duration of the clips features are extracted from
+        :param repeat (int): Number of passes of every stage, the best one is reported
+        :param stages (list): Names of the stages to run, all by default
+        :param verbose (int): Print every stage as it completes if > 0
+        :return results (dict): Environment, configuration and stage name -> result of run_stage
+        """
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "librosa": librosa.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {
+            "datasets": list(datasets),
+            "synthetic_count": synthetic_count,
+            "synthetic_duration": synthetic_duration,
+            "limit": limit,
+            "clip_duration": clip_duration,
+            "repeat": repeat,
+        },
+        "stages": {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = []
+        for name in datasets:
+            _, dataset_files = list_dataset_files(BENCHMARK_DATASET_PATHS[name])
+            files += [file_path for _, file_path in dataset_files[:limit]]
+        for i in range(synthetic_count):
+            file_path = os.path.join(tmp_dir, "synthetic_{}.wav".format(i))
+            sf.write(file_path, synthetic_signal(synthetic_duration, seed=i), SAMPLE_RATE)
+            files.append(file_path)
+
+        signals = [read_audio(file_path, sr=SAMPLE_RATE)[0] for file_path in files]
+        clip_length = int(clip_duration * SAMPLE_RATE)
+        clips = [librosa.util.fix_length(signal[:clip_length], size=clip_length) for signal in signals]
+        file_seconds = sum(len(signal) for signal in signals) / SAMPLE_RATE
+        clip_seconds = len(clips) * clip_duration
+        records = [(0, extract_features(clip, SAMPLE_RATE)) for clip in clips]
+        csv_path = os.path.join(tmp_dir, "features.csv")
+        json_path = os.path.join(tmp_dir, "features.json")
+        # the clips as a dataset for the writers, whose features are read from a feature cache warmed before timing
+        clips_dir = os.path.join(tmp_dir, "clips")
+        os.makedirs(os.path.join(clips_dir, "clip"))
+        for i, clip in enumerate(clips):
+            sf.write(os.path.join(clips_dir, "clip", "clip_{}.wav".format(i)), clip, SAMPLE_RATE)
+        cache = FeatureCache(os.path.join(tmp_dir, "feature_cache"))
+        if not stages or {"csv_writer", "json_writer"} & set(stages):
+            save_features_in_CSV([clips_dir], csv_path, num_segments=1, cache=cache)
+
+        # stage name -> (stage, inputs, duration of the inputs), the batch stages get all the clips as a single input
+        stage_specs = {
+            "librosa_load": (lambda file_path: librosa.load(file_path, sr=SAMPLE_RATE), files, file_seconds),
+            "read_audio": (lambda file_path: read_audio(file_path, sr=SAMPLE_RATE), files, file_seconds),
+            "librosa_split": (lambda signal: librosa.effects.split(signal, top_db=TOP_DB), signals, file_seconds),
+            "segment_signal": (lambda signal: segment_signal(signal, SAMPLE_RATE), signals, file_seconds),
+        }
+        for name, fn in _individual_features().items():
+            stage_specs["feature_" + name] = (fn, clips, clip_seconds)
+        stage_specs["extract_features"] = (lambda clip: extract_features(clip, SAMPLE_RATE), clips, clip_seconds)
+        stage_specs["extract_features_batch"] = (lambda batch: extract_features(batch, SAMPLE_RATE), [np.stack(clips)], clip_seconds)
+        clip_featurizer = ClipFeaturizer(SAMPLE_RATE)
+        stage_specs["clip_featurizer"] = (clip_featurizer.featurize, clips, clip_seconds)
+        stage_specs["pool_features"] = (lambda record: pool_features(record[1]), records, clip_seconds)
+        stage_specs["csv_writer"] = (lambda dataset_paths: save_features_in_CSV(dataset_paths, csv_path, num_segments=1, cache=cache), [[clips_dir]], clip_seconds)
+        stage_specs["json_writer"] = (lambda dataset_paths: save_features_in_JSON(dataset_paths, json_path, num_segments=1, cache=cache), [[clips_dir]], clip_seconds)
+
+        for name, (fn, items, audio_seconds) in stage_specs.items():
+            if stages and name not in stages:
+                continue
+            result = run_stage(fn, items, audio_seconds, repeat, clips=len(clips))
+            results["stages"][name] = result
+            if verbose:
+                print("{:<28} {:>9.3f}s {:>9.1f} clips/s {:>9.1f} audio s/s {:>8.1f} MB".format(
+                    name, result["seconds"], result["clips_per_second"], result["audio_seconds_per_second"], result["peak_rss_mb"]))
+    return results
+
+
+def compare_results(baseline, current, threshold=REGRESSION_THRESHOLD):
+    """Compares two runs of run_benchmarks stage by stage.
+
+        Stages are compared by their time per second of audio, so runs on different numbers of clips remain comparable.
+
+        :param baseline (dict): Results of the reference run
+        :param current (dict): Results of the new run
+        :param threshold (float): Relative slowdown above which a stage is a regression
+        :return comparison (list): {"stage", "baseline", "current", "ratio", "regression"} of every stage of both runs,
+            times in seconds per second of audio
+        """
+
+    comparison = []
+    for name, result in current["stages"].items():
+        if name not in baseline["stages"]:
+            continue
+        before = baseline["stages"][name]["seconds"] / baseline["stages"][name]["audio_seconds"]
+        after = result["seconds"] / result["audio_seconds"]
+        ratio = after / before if before else float("inf")
+        comparison.append({"stage": name, "baseline": before, "current": after, "ratio": ratio, "regression": ratio > 1 + threshold})
+    return comparison
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks the preprocessing and feature extraction stages.")
+    parser.add_argument("--datasets", nargs="*", choices=sorted(BENCHMARK_DATASET_PATHS), default=sorted(BENCHMARK_DATASET_PATHS), help="bundled datasets to benchmark on")
+    parser.add_argument("--limit", type=int, help="maximum number of files taken from every dataset")
+    parser.add_argument("--synthetic-count", type=int, default=20, help="number of synthetic signals")
+    parser.add_argument("--synthetic-duration", type=float, default=30.0, help="duration of the synthetic signals in seconds")
+    parser.add_argument("--clip-duration", type=float, default=CLIP_DURATION, help="duration of the clips features are extracted from")
+    parser.add_argument("--repeat", type=int, default=3, help="passes of every stage, the best one is reported")
+    parser.add_argument("--stages", nargs="*", help="stages to run, all by default")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file the results are saved to")
+    parser.add_argument("--compare", help="results of a previous run to check for regressions")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.datasets, args.synthetic_count, args.synthetic_duration, args.limit, args.clip_duration, args.repeat, args.stages)
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=1)
+
+    if args.compare:
+        with open(args.compare, "r") as fp:
+            baseline = json.load(fp)
+        if baseline["config"] != results["config"]:
+            print("Warning: the runs have different configurations, times are compared per second of audio")
+        regressions = 0
+        for entry in compare_results(baseline, results, args.threshold):
+            regressions += entry["regression"]
+            print("{:<28} {:>8.2f}x{}".format(entry["stage"], entry["ratio"], "  REGRESSION" if entry["regression"] else ""))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import numpy as np
+from feature_cache import file_content_hash
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# input and output digests of every stage of the last build, and the content hashes of the files seen
+BUILD_STATE_PATH = os.path.join(BASE_DIR, "build_state.json")
+# bump when the stages change in a way that invalidates their outputs
+BUILD_VERSION = 1
+# results of the stages that let the stages after them run
+SUCCESS = ("up to date", "built", "would build")
+
+
+class Stage:
+    """Step of the build, rerun when the digest of its inputs and parameters differs from the last build.
+
+        Inputs and outputs are files or directories. A dataset input (a directory with one sub-folder per label,
+        as read by list_dataset_files) is only digested over the files of its sub-folders, so the manifests kept
+        at the root of a clean dataset do not count. The stage itself is responsible for doing only the work its
+        changed files need, e.g. with the manifest of clean_dataset or the feature cache.
+        """
+
+    def __init__(self, name, run, inputs=(), outputs=(), params=None, deps=(), datasets=()):
+        """
+            :param name (str): Name of the stage, e.g. "features:detection"
+            :param run (callable): Called without arguments to build the outputs
+            :param inputs (list): Files and directories the stage reads
+            :param outputs (list): Files and directories the stage writes
+            :param params (dict): JSON-serializable parameters of the stage
+            :param deps (list): Names of the stages that must run before
+            :param datasets (list): Inputs digested as datasets, only over their label sub-folders
+            """
+
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.deps = list(deps)
+        self.datasets = set(datasets)
+
+
+class BuildState:
+    """Digests of the last build, saved as JSON.
+
+        Content hashes are remembered along with the size and modification time of every file, so a file is
+        only read again when its metadata changes.
+        """
+
+    def __init__(self, path=BUILD_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r") as fp:
+                state = json.load(fp)
+            if state.get("version") != BUILD_VERSION:
+                raise ValueError("build state version {}".format(state.get("version")))
+        except (OSError, ValueError):
+            state = {"version": BUILD_VERSION, "stages": {}, "files": {}}
+        self.stages = state["stages"]
+        self.files = state["files"]
+
+    def file_hash(self, file_path):
+        stat = os.stat(file_path)
+        with self._lock:
+            entry = self.files.get(file_path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        content_hash = file_content_hash(file_path)
+        with self._lock:
+            self.files[file_path] = [stat.st_size, stat.st_mtime_ns, content_hash]
+        return content_hash
+
+    def digest(self, path, dataset=False):
+        """Returns the digest of a file, or of the relative paths and contents of the files of a directory.
+
+            :param path (str): File or directory, None if it does not exist
+            :param dataset (bool): Only digest the files of the sub-folders of the directory
+            """
+
+        if not os.path.exists(path):
+            return None
+        if not os.path.isdir(path):
+            return self.file_hash(path)
+        digest = hashlib.blake2b(digest_size=20)
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            if dataset and dirpath == path:
+                continue
+            for f in sorted(filenames):
+                file_path = os.path.join(dirpath, f)
+                digest.update("{}\0{}\0".format(os.path.relpath(file_path, path), self.file_hash(file_path)).encode())
+        return digest.hexdigest()
+
+    def input_digest(self, stage):
+        inputs = {os.path.relpath(path, BASE_DIR): self.digest(path, path in stage.datasets) for path in stage.inputs}
+        key = json.dumps({"params": stage.params, "inputs": inputs}, sort_keys=True)
+        return hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+
+    def output_digest(self, stage):
+        return {os.path.relpath(path, BASE_DIR): self.digest(path) for path in stage.outputs}
+
+    def save(self):
+        with self._lock:
+            state = {"version": BUILD_VERSION, "stages": dict(self.stages), "files": dict(self.files)}
+        # files that are gone
+        state["files"] = {file_path: entry for file_path, entry in state["files"].items() if os.path.exists(file_path)}
+        with open(self.path + ".tmp", "w") as fp:
+            json.dump(state, fp, indent=1, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def _select_stages(stages, targets):
+    # the targets and every stage they depend on, in the given order
+    selected = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in stages:
+            raise KeyError("unknown stage {}".format(name))
+        if name not in selected:
+            selected.add(name)
+            pending.extend(stages[name].deps)
+    return [name for name in stages if name in selected]
+
+
+def run_build(stages, targets=None, jobs=2, force=(), state_path=BUILD_STATE_PATH, dry_run=False):
+    """Runs the stages whose inputs, parameters or outputs changed since the last build, dependencies first.
+
+        A stage is up to date when the digest of its inputs and parameters is the one of its last successful run
+        and its outputs are unchanged since then. Stages that do not depend on each other run concurrently in jobs
+        threads (the stages run their own worker processes). A stage that reruns but writes the same outputs
+        does not make the stages after it rerun. The state is saved after every stage, so an interrupted build
+        resumes from there.
+
+        :param stages (list): Stages of the build
+        :param targets (list): Names of the stages to bring up to date, all by default
+        :param jobs (int): Maximum number of stages run at a time
+        :param force (list): Names of the stages to run even if up to date
+        :param state_path (str): Path to the build state
+        :param dry_run (bool): Only report the stages that would run
+        :return results (dict): Stage name -> "up to date", "built", "would build", "skipped" or the error of the stage
+        """
+
+    stages = {stage.name: stage for stage in stages}
+    names = _select_stages(stages, targets or list(stages))
+    state = BuildState(state_path)
+    results = {}
+
+    def build(name):
+        # runs in a build thread, returns the result of the stage and its new state entry
+        stage = stages[name]
+        input_digest = state.input_digest(stage)
+        entry = state.stages.get(name)
+        # in a dry run, the inputs of the stages after a stage that would build are not known yet
+        stale = dry_run and any(results[dep] == "would build" for dep in stage.deps)
+        if name not in force and not stale and entry and entry["inputs"] == input_digest and entry["outputs"] == state.output_digest(stage):
+            return "up to date", None
+        if dry_run:
+            return "would build", None
+        started = time.perf_counter()
+        stage.run()
+        return "built", {"inputs": input_digest, "outputs": state.output_digest(stage), "seconds": time.perf_counter() - started}
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        running = {}
+        while len(results) < len(names):
+            skipped = False
+            for name in names:
+                if name in results or name in running.values():
+                    continue
+                if any(dep in results and results[dep] not in SUCCESS for dep in stages[name].deps):
+                    results[name] = "skipped"
+                    skipped = True
+                elif all(dep in results for dep in stages[name].deps):
+                    running[executor.submit(build, name)] = name
+            if not running:
+                if not skipped:
+                    # nothing can run and nothing will finish, the stages left depend on each other
+                    raise ValueError("dependency cycle between stages {}".format(", ".join(name for name in names if name not in results)))
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name], entry = future.result()
+                except Exception as e:
+                    results[name], entry = "{}: {}".format(type(e).__name__, e), None
+                if entry is not None:
+                    state.stages[name] = entry
+                    state.save()
+                print("{}: {}".format(name, results[name]))
+    if not dry_run:
+        state.save()
+    return results
+
+
+def train_model(store_path, artifact_path, task="detection", test_size=0.3, workers=None, random_state=22):
+    """Selects and fits a model on a feature store, as model_training.ipynb does, and saves it as an artifact.
+
+        The family with the best cross-validation accuracy (see model_selection.select_models) is fitted on the
+        training split and its test accuracy saved with the artifact.
+
+        :param store_path (str): Path to the feature store
+        :param artifact_path (str): Path to the model artifact
+        :param task (str): "detection" or "classification", the model families and grids searched
+        :param test_size (float): Share of the rows held out for testing
+        :param workers (int): Number of worker processes of the model selection
+        """
+
+    from sklearn.base import clone
+    from sklearn.model_selection import train_test_split
+    from sklearn.preprocessing import LabelEncoder, StandardScaler
+    from feature_store import load_feature_store
+    from model_artifact import save_model_artifact
+    from model_selection import CLASSIFICATION_CANDIDATES, DETECTION_CANDIDATES, select_models
+
+    features, labels, metadata = load_feature_store(store_path)
+    encoder = LabelEncoder()
+    y = encoder.fit_transform(np.asarray(labels))
+    scaler = StandardScaler()
+    X = scaler.fit_transform(np.array(features, dtype=float))
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, stratify=y, random_state=random_state)
+
+    candidates = DETECTION_CANDIDATES if task == "detection" else CLASSIFICATION_CANDIDATES
+    model_data, train_accuracies, _ = select_models(X_train, y_train, candidates, workers=workers, random_state=random_state, verbose=0)
+    family = list(model_data)[int(np.nanargmax(train_accuracies))]
+    model = clone(candidates[family][0]).set_params(**model_data[family])
+    model.fit(X_train, y_train)
+    metrics = {"family": family, "params": model_data[family], "cv_accuracy": float(np.nanmax(train_accuracies)), "test_accuracy": float(model.score(X_test, y_test))}
+    save_model_artifact(artifact_path, model, scaler, encoder, metadata, metrics=metrics)
+    return metrics
+
+
+def default_stages(workers=1, feature_mode="frames", dedupe=None, train_workers=None):
+    """Returns the stages of the datasets and models of this repository: clean, featurize and train, per task.
+        """
+
+    from audio_decode import DecodeCache
+    from audio_preprocessing import (CLASSIFICATION_DATASET_PATHS, CLASSIFICATION_STORE_PATH, DETECTION_DATASET_PATHS, DETECTION_STORE_PATH,
+                                     FEATURE_CACHE_PATH, save_features_in_store)
+    from clean_dataset import DATASET_AUDIO_DURATION, clean_datasets
+    from feature_cache import FeatureCache
+
+    def clean(dirty_dataset_path):
+        clean_datasets([dirty_dataset_path], max_duration=DATASET_AUDIO_DURATION, workers=workers, decode_cache=DecodeCache(), dedupe=dedupe)
+
+    # one feature cache shared by the stages running at the same time, so they account for each other's entries
+    feature_caches = []
+    feature_cache_lock = threading.Lock()
+
+    def featurize(dataset_paths, store_path):
+        with feature_cache_lock:
+            if not feature_caches:
+                feature_caches.append(FeatureCache(FEATURE_CACHE_PATH))
+        # unchanged files are read from the feature cache, only new ones are extracted
+        save_features_in_store(dataset_paths, store_path, num_segments=1, workers=workers, cache=feature_caches[0], feature_mode=feature_mode)
+
+    stages = []
+    for task, dataset_paths, store_path in [("detection", DETECTION_DATASET_PATHS, DETECTION_STORE_PATH), ("classification", CLASSIFICATION_DATASET_PATHS, CLASSIFICATION_STORE_PATH)]:
+        dirty_dataset_path = os.path.join(BASE_DIR, task + "_dataset")
+        clean_dataset_path = os.path.join(BASE_DIR, "clean_{}_dataset".format(task))
+        store_path = os.path.join(BASE_DIR, store_path)
+        artifact_path = os.path.join(BASE_DIR, task + "_model")
+        stages.append(Stage("clean:" + task, lambda path=dirty_dataset_path: clean(path),
+                            inputs=[dirty_dataset_path], outputs=[clean_dataset_path], datasets=[dirty_dataset_path],
+                            params={"max_duration": DATASET_AUDIO_DURATION, "dedupe": dedupe}))
+        stages.append(Stage("features:" + task, lambda paths=dataset_paths, store_path=store_path: featurize(paths, store_path),
+                            inputs=dataset_paths, outputs=[store_path], datasets=dataset_paths, deps=["clean:" + task],
+                            params={"num_segments": 1, "feature_mode": feature_mode}))
+        stages.append(Stage("train:" + task, lambda store_path=store_path, artifact_path=artifact_path, task=task: train_model(store_path, artifact_path, task, workers=train_workers),
+                            inputs=[store_path], outputs=[artifact_path], deps=["features:" + task], params={"test_size": 0.3}))
+    return stages
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Cleans the datasets, extracts their features and trains the models, only redoing what changed.")
+    parser.add_argument("targets", nargs="*", help="stages to bring up to date (with the ones they depend on), all by default")
+    parser.add_argument("--jobs", type=int, default=2, help="number of independent stages run at a time")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used by every cleaning and featurizing stage")
+    parser.add_argument("--train-workers", type=int, default=None, help="number of processes used by model selection, all CPUs by default")
+    parser.add_argument("--feature-mode", choices=["frames", "pooled"], default="frames", help="every frame of the features, or their statistics over time")
+    parser.add_argument("--dedupe", choices=["flag", "drop"], help="find the duplicate clips while cleaning, see clean_dataset.py")
+    parser.add_argument("--force", nargs="+", default=[], help="stages to run even if up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only list the stages that would run")
+    args = parser.parse_args()
+
+    stages = default_stages(args.workers, args.feature_mode, args.dedupe, args.train_workers)
+    if not args.targets:
+        print("Stages: {}".format(", ".join(stage.name for stage in stages)))
+    results = run_build(stages, args.targets, args.jobs, args.force, dry_run=args.dry_run)
+    failed = [name for name, result in results.items() if result not in SUCCESS]
+    if failed:
+        raise SystemExit("Failed: {}".format(", ".join("{} ({})".format(name, results[name]) for name in failed)))
@@ -1,59 +1,272 @@
-import soundfile as sf
-import numpy as np
-import librosa
 import os
+import json
 import shutil
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from feature_cache import file_content_hash
+from audio_decode import DECODE_CACHE_PATH, DecodeCache, load_audio
+from segmentation import TOP_DB, segment_signal, write_clips
+from instrumentation import LEVELS, NULL_INSTRUMENTATION, Instrumentation
+from fingerprint import GROUPS_FILE, DuplicateGroups, FingerprintIndex, deduplicate, fingerprint, fingerprint_file, load_groups, save_groups
 
 SAMPLE_RATE = 22050
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DIRTY_DATASET_PATHS = [os.path.join(BASE_DIR, "detection_dataset"), os.path.join(BASE_DIR, "classification_dataset")]
 DATASET_AUDIO_DURATION = 5
-curr_file_number = 0
+# records which clips every source file produced, kept at the root of the clean dataset
+MANIFEST_FILE = "manifest.json"
+# the manifest is saved every MANIFEST_SAVE_INTERVAL cleaned files, so an interrupted run resumes from there
+MANIFEST_SAVE_INTERVAL = 32
+# fingerprints of the kept clips, kept at the root of the clean dataset when deduplicating
+FINGERPRINT_INDEX_FILE = "fingerprints.npz"
 
-def clean_datasets(dirty_dataset_paths, min_duration=1.5, max_duration=5.0):
+
+def clip_name(source_name, interval_index, clip_index):
+    """Returns the file name of a clip, derived from its source file and position so reruns give the same names.
+        """
+
+    return "{}_{}_{}.wav".format(source_name, interval_index, clip_index)
+
+
+def clean_file(file_path, clean_dataset_dir_path, tmp_dir_path, min_duration=1.5, max_duration=5.0, decode_cache=None, fingerprint_clips=False):
+    """Splits an audio file on silences and saves the non-silent intervals as clips of max_duration seconds.
+
+        Intervals are cut into max_duration clips, the last one being padded with zeros. Clips shorter than
+        min_duration are dropped.
+
+        :param file_path (str): Path to the source audio file
+        :param clean_dataset_dir_path (str): Directory the clips are saved in
+        :param tmp_dir_path (str): Directory clips are written to before being moved in place
+        :param decode_cache (DecodeCache): Decode cache of the resampled sources, None to always decode
+        :param fingerprint_clips (bool): Also return the fingerprints of the clips (see fingerprint.fingerprint)
+        :return clips (list), metrics (dict), fingerprints (list): File names of the clips, in clean_dataset_dir_path,
+            the decode, split and write time, duration and number of clips of the file (see Instrumentation.record_file),
+            and the (hashes, frames) of every clip if fingerprint_clips, else None
+        """
+
+    started = time.perf_counter()
+    signal, sample_rate = load_audio(file_path, sr=SAMPLE_RATE, cache=decode_cache)
+    decoded = time.perf_counter()
+    fixed_signals, interval_indices, clip_indices = segment_signal(signal, sample_rate, min_duration, max_duration, TOP_DB)
+    split = time.perf_counter()
+    clips = [clip_name(os.path.basename(file_path), interval_index, clip_index) for interval_index, clip_index in zip(interval_indices, clip_indices)]
+    # write next to the dataset and move in place, so an interrupted run never leaves a truncated clip
+    write_clips(fixed_signals, [os.path.join(clean_dataset_dir_path, name) for name in clips], SAMPLE_RATE, tmp_dir_path)
+    metrics = {
+        "decode_seconds": decoded - started,
+        "split_seconds": split - decoded,
+        "write_seconds": time.perf_counter() - split,
+        "audio_seconds": len(signal) / sample_rate,
+        "clips": len(clips),
+    }
+    fingerprints = [fingerprint(fixed_signal, SAMPLE_RATE) for fixed_signal in fixed_signals] if fingerprint_clips else None
+    return clips, metrics, fingerprints
+
+
+def _clean_file_args(args):
+    return clean_file(*args)
+
+
+def _load_manifest(clean_dataset_path, params):
+    """Returns the sources recorded in the manifest of a clean dataset, empty if missing or made with other params.
+        """
+
+    try:
+        with open(os.path.join(clean_dataset_path, MANIFEST_FILE), "r") as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+    return manifest["sources"] if manifest.get("params") == params else {}
+
+
+def _save_manifest(clean_dataset_path, params, sources):
+    path = os.path.join(clean_dataset_path, MANIFEST_FILE)
+    with open(path + ".tmp", "w") as fp:
+        json.dump({"params": params, "sources": sources}, fp, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def _remove_clips(clean_dataset_path, source, entry):
+    label_dir_path = os.path.join(clean_dataset_path, os.path.dirname(source))
+    for name in entry["clips"]:
+        if os.path.exists(os.path.join(label_dir_path, name)):
+            os.remove(os.path.join(label_dir_path, name))
+
+
+def _load_fingerprints(clean_dataset_path, sources):
+    """Returns the fingerprint index and the groups of the clips of the current sources, from an earlier run.
+        """
+
+    names = {os.path.join(os.path.dirname(source), clip): source for source, entry in sources.items() for clip in entry["clips"]}
+    try:
+        index = FingerprintIndex.load(os.path.join(clean_dataset_path, FINGERPRINT_INDEX_FILE))
+        index.remove([name for name in index.names if name not in names])
+    except (OSError, ValueError, KeyError):
+        index = FingerprintIndex()
+    groups = DuplicateGroups()
+    try:
+        old_groups, _ = load_groups(os.path.join(clean_dataset_path, GROUPS_FILE))
+    except (OSError, ValueError, KeyError):
+        old_groups = {}
+    members = {}
+    for name in names:
+        groups.add(name)
+        if name in old_groups:
+            members.setdefault(old_groups[name], []).append(name)
+    for group in members.values():
+        for name in group[1:]:
+            groups.union(group[0], name)
+    return index, groups
+
+
+def _dedupe_clip(clean_dataset_path, index, groups, source, entry, clip, clip_fingerprints, dedupe, instrumentation):
+    # groups a clip with the other clips of its source and the clips it overlaps, and handles it if it is a duplicate
+    label = os.path.dirname(source)
+    name = os.path.join(label, clip)
+    groups.add(name)
+    for other in entry["clips"]:
+        if other != clip:
+            groups.union(name, os.path.join(label, other))
+            break
+    duplicate_of = deduplicate(index, groups, name, *clip_fingerprints)
+    if duplicate_of is None:
+        return
+    instrumentation.count("duplicates")
+    entry.setdefault("duplicates", {})[clip] = duplicate_of
+    if dedupe == "drop":
+        os.remove(os.path.join(clean_dataset_path, name))
+        entry["clips"].remove(clip)
+
+
+def clean_datasets(dirty_dataset_paths, min_duration=1.5, max_duration=5.0, workers=1, restart=False, decode_cache=None, instrumentation=NULL_INSTRUMENTATION,
+                   dedupe=None):
     """Creates a clean dataset from the existing datasets by cropping and extending the audio files to the max_duration
+
+        The manifest of every clean dataset maps each source file (label/file name) to its content hash and the
+        clips it produced. Sources whose content is unchanged are skipped, the clips of changed or removed
+        sources are removed, and new or changed sources are cleaned in a pool of worker processes.
+
+        With dedupe, every clip is fingerprinted (see fingerprint) and looked up among the clips kept so far.
+        Clips that repeat a kept clip are recorded under "duplicates" in the manifest entry of their source, and
+        deleted if dedupe is "drop". groups.json gives every clip a group id, shared by the clips of a source and
+        the clips that overlap, so that train/test splits can keep them together. The fingerprints of the kept
+        clips are saved in fingerprints.npz, so later runs only fingerprint the new clips.
+
+        :param dirty_dataset_paths (list): Paths to datasets
+        :param min_duration (float): Minimum duration of a clip in seconds
+        :param max_duration (float): Duration of the clips in seconds
+        :param workers (int): Number of worker processes
+        :param restart (bool): Delete the clean datasets and clean every source again
+        :param decode_cache (DecodeCache): Decode cache of the resampled sources, None to always decode
+        :param instrumentation (Instrumentation): Records the decode, split and write times of every cleaned file
+        :param dedupe (str): None to keep every clip, "flag" to record the duplicates, "drop" to also delete them
         """
 
-    global curr_file_number
+    params = {"min_duration": min_duration, "max_duration": max_duration, "top_db": TOP_DB, "sample_rate": SAMPLE_RATE}
 
     # loop through all the dataset paths
     for dataset_path in dirty_dataset_paths:
         dataset_name = dataset_path.split("/")[-1]
         clean_dataset_path = os.path.join(BASE_DIR, 'clean_'+dataset_name)
         print("Creating {}".format(clean_dataset_path))
-        if os.path.exists(clean_dataset_path):
+        if restart and os.path.exists(clean_dataset_path):
             shutil.rmtree(clean_dataset_path)
+        if not os.path.exists(clean_dataset_path):
+            os.makedirs(clean_dataset_path)
+        old_sources = _load_manifest(clean_dataset_path, params)
+        if not old_sources and os.path.exists(clean_dataset_path):
+            # no usable manifest (older layout or other params): the existing clips cannot be attributed
+            for entry in os.scandir(clean_dataset_path):
+                if entry.is_dir():
+                    shutil.rmtree(entry.path)
+
         # loop through all sub-folder
-        for i, (dirpath, dirnames, filenames) in enumerate(os.walk(dataset_path)):
+        sources = {}
+        tasks = []
+        for dirpath, dirnames, filenames in os.walk(dataset_path):
+            dirnames.sort()
             # ensure we're processing a sub-folder level
-            if dirpath is not dataset_path:
+            if dirpath != dataset_path:
                 # save label  mapping
                 semantic_label = dirpath.split("/")[-1]
                 clean_dataset_dir_path = os.path.join(clean_dataset_path, semantic_label)
                 if not os.path.exists(clean_dataset_dir_path):
                     os.makedirs(clean_dataset_dir_path)
                 # process all audio files in sub-dir
-                for f in filenames:
+                for f in sorted(filenames):
                     # audio file
                     file_path = os.path.join(dirpath, f)
-                    signal, sample_rate = librosa.load(file_path, sr=SAMPLE_RATE)
-                    threshold = 67
-                    cough_intevals = librosa.effects.split(signal, top_db=threshold)
-                    for interval in cough_intevals:
-                        int_st = interval[0]
-                        int_en = interval[1]
-                        step = sample_rate*max_duration
-                        for i in range(int_st, int_en, step):
-                            if int_en-i >= sample_rate*min_duration:
-                                fixed_signal = signal[i:min(i+step, int_en)]
-                                if int_en-i < step:
-                                    fixed_signal = librosa.util.fix_length(fixed_signal, step)
-                                if not os.path.exists(clean_dataset_dir_path):
-                                    os.makedirs(clean_dataset_dir_path)
-                                sf.write(os.path.join(clean_dataset_dir_path, str(curr_file_number)+'.wav'), fixed_signal, SAMPLE_RATE)
-                                curr_file_number += 1
+                    source = os.path.join(semantic_label, f)
+                    content_hash = file_content_hash(file_path)
+                    old_entry = old_sources.pop(source, None)
+                    if old_entry and old_entry["hash"] == content_hash:
+                        sources[source] = old_entry
+                        instrumentation.count("unchanged_files")
+                        continue
+                    if old_entry:
+                        _remove_clips(clean_dataset_path, source, old_entry)
+                    tasks.append((source, content_hash, (file_path, clean_dataset_dir_path, clean_dataset_path, min_duration, max_duration, decode_cache)))
+
+        # sources that are gone from the dataset
+        for source, entry in old_sources.items():
+            _remove_clips(clean_dataset_path, source, entry)
+        print("{} sources unchanged, {} to clean".format(len(sources), len(tasks)))
+
+        if dedupe:
+            index, groups = _load_fingerprints(clean_dataset_path, sources)
+            # unchanged clips the index does not know yet, e.g. cleaned by a run without dedupe
+            for source, entry in sources.items():
+                for clip in list(entry["clips"]):
+                    name = os.path.join(os.path.dirname(source), clip)
+                    if clip in entry.get("duplicates", {}):
+                        # flagged by an earlier run
+                        if dedupe == "drop":
+                            os.remove(os.path.join(clean_dataset_path, name))
+                            entry["clips"].remove(clip)
+                    elif name not in index:
+                        _dedupe_clip(clean_dataset_path, index, groups, source, entry, clip, fingerprint_file(os.path.join(clean_dataset_path, name)), dedupe, instrumentation)
+
+        def record(results):
+            for n, ((source, content_hash, (file_path, *_)), (clips, metrics, fingerprints)) in enumerate(zip(tasks, results), 1):
+                instrumentation.record_file(file_path, metrics)
+                entry = sources[source] = {"hash": content_hash, "clips": clips}
+                if dedupe:
+                    for clip, clip_fingerprints in zip(list(clips), fingerprints):
+                        _dedupe_clip(clean_dataset_path, index, groups, source, entry, clip, clip_fingerprints, dedupe, instrumentation)
+                if n % MANIFEST_SAVE_INTERVAL == 0:
+                    _save_manifest(clean_dataset_path, params, sources)
+
+        args = [task_args + (bool(dedupe),) for _, _, task_args in tasks]
+        if workers > 1 and len(args) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                record(executor.map(_clean_file_args, args))
+        else:
+            record(map(_clean_file_args, args))
+        _save_manifest(clean_dataset_path, params, sources)
+        if dedupe:
+            index.save(os.path.join(clean_dataset_path, FINGERPRINT_INDEX_FILE))
+            duplicates = {os.path.join(os.path.dirname(source), clip): duplicate_of
+                          for source, entry in sources.items() for clip, duplicate_of in entry.get("duplicates", {}).items()}
+            group_ids = {name: group for name, group in groups.group_ids().items() if dedupe != "drop" or name not in duplicates}
+            save_groups(os.path.join(clean_dataset_path, GROUPS_FILE), group_ids, duplicates)
+            print("{} duplicate clips{}".format(len(duplicates), " dropped" if dedupe == "drop" else ""))
         print("Done!")
-                    
+
 if __name__ == "__main__":
 
-    clean_datasets(DIRTY_DATASET_PATHS, max_duration=DATASET_AUDIO_DURATION)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Splits the raw datasets into clips of {} seconds.".format(DATASET_AUDIO_DURATION))
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to clean the source files")
+    parser.add_argument("--restart", action="store_true", help="clean every source file again instead of only the new and changed ones")
+    parser.add_argument("--decode-cache-dir", default=DECODE_CACHE_PATH, help="directory of the cache of resampled sources")
+    parser.add_argument("--no-decode-cache", action="store_true", help="decode every source file again")
+    parser.add_argument("--instrument-level", choices=LEVELS, default="summary", help="metrics recorded and saved as clean_metrics.json")
+    parser.add_argument("--dedupe", choices=["flag", "drop"], help="find the duplicate clips and record them in the manifests, or delete them")
+    args = parser.parse_args()
+    decode_cache = None if args.no_decode_cache else DecodeCache(args.decode_cache_dir)
+
+    with Instrumentation(args.instrument_level) as instrumentation:
+        clean_datasets(DIRTY_DATASET_PATHS, max_duration=DATASET_AUDIO_DURATION, workers=args.workers, restart=args.restart, decode_cache=decode_cache, instrumentation=instrumentation, dedupe=args.dedupe)
+    if instrumentation.enabled:
+        with open(os.path.join(BASE_DIR, "clean_metrics.json"), 'w') as fp:
+            instrumentation.write(fp)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import collections
+import json
+import sys
+import time
+import warnings
+import numpy as np
+
+# librosa, scipy and scikit-learn are imported when a featurizer or predictor is created, not with this module
+SAMPLE_RATE = 22050
+DATASET_AUDIO_DURATION = 5
+# number of clips the latency percentiles are computed over
+LATENCY_WINDOW = 1000
+
+
+class ClipFeaturizer:
+    """Extracts the feature row of one clip, as get_features_csv_row, for callers scoring one clip at a time.
+
+        Clips go through features.extract_features, so the rows are exactly the ones the models were trained on.
+        Its filterbanks are built once per parameters, by the first clip (see ClipPredictor's warm-up).
+        """
+
+    def __init__(self, sample_rate=SAMPLE_RATE, num_mfcc=13, n_fft=2048, hop_length=512, feature_mode="frames"):
+        """
+            :param sample_rate (int): Sample rate of the clips
+            :param num_mfcc, n_fft, hop_length, feature_mode: Extraction parameters, see get_features_csv_row
+            """
+
+        import features
+
+        self.sample_rate = sample_rate
+        self.num_mfcc = num_mfcc
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.feature_mode = feature_mode
+        self._features = features
+
+    def extract(self, signal):
+        """Extracts the features of a clip.
+
+            :param signal (ndarray): Mono float32 audio time series
+            :return features (dict): Feature name -> frames-first ndarray, as returned by extract_features
+            """
+
+        return self._features.extract_features(np.asarray(signal, dtype=np.float32), self.sample_rate, self.num_mfcc, self.n_fft, self.hop_length)
+
+    def featurize(self, signal):
+        """Returns the feature row of a clip, pooled over time if feature_mode is "pooled".
+            """
+
+        features = self.extract(signal)
+        if self.feature_mode == "pooled":
+            features = self._features.pool_features(features)
+        return self._features.features_to_row(features)
+
+
+class ClipPredictor:
+    """Long-lived predictor scoring one clip at a time with the lowest latency, e.g. behind a live input.
+
+        The featurizer is built once for the extraction parameters of the models and every stage is run once on a
+        silent clip at creation, so that no call pays for a filterbank, an FFT plan or a lazy import. The latency of
+        every stage of the last LATENCY_WINDOW clips is kept, see latency.
+        """
+
+    def __init__(self, predictor, duration=DATASET_AUDIO_DURATION, warm_up=True):
+        """
+            :param predictor (Predictor): Models to predict with, see predict.Predictor
+            :param duration (float): Duration the clips are padded or cut to, unless the features are pooled
+            :param warm_up (bool): Score a silent clip once, without recording its latency
+            """
+
+        import predict
+
+        self.predictor = predictor
+        self._decode_clip = predict.decode_clip
+        extraction = predictor.extraction
+        self.duration = None if extraction["feature_mode"] == "pooled" else duration
+        self.featurizer = ClipFeaturizer(extraction["sample_rate"], extraction["num_mfcc"], extraction["n_fft"], extraction["hop_length"], extraction["feature_mode"])
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_WINDOW))
+        if warm_up:
+            with warnings.catch_warnings():
+                # the tuning of a silent clip cannot be estimated
+                warnings.simplefilter("ignore")
+                self.predict(np.zeros(int((duration or DATASET_AUDIO_DURATION) * extraction["sample_rate"]), dtype=np.float32))
+            self.latencies.clear()
+
+    @classmethod
+    def from_artifacts(cls, detection_artifact_path, classification_artifact_path=None, **kwargs):
+        """Loads model artifacts (see model_artifact), see predict.Predictor.from_artifacts.
+            """
+
+        from predict import Predictor
+
+        return cls(Predictor.from_artifacts(detection_artifact_path, classification_artifact_path), **kwargs)
+
+    def predict(self, source):
+        """Scores a clip.
+
+            :param source: Mono float32 signal at the sample rate of the models, path to an audio file or its content as bytes
+            :return record (dict): Prediction (see predict.OUTPUT_FIELDS) with the decode, featurize, predict and total milliseconds
+            """
+
+        started = time.perf_counter()
+        sample_rate = self.featurizer.sample_rate
+        if isinstance(source, np.ndarray):
+            signal = source
+            if self.duration is not None:
+                length = int(self.duration * sample_rate)
+                signal = np.pad(signal[:length], (0, max(0, length - len(signal))))
+        else:
+            signal = self._decode_clip(source, sample_rate, self.duration)
+        decoded = time.perf_counter()
+        row = self.featurizer.featurize(signal)
+        featurized = time.perf_counter()
+        record = {"path": source if isinstance(source, str) else None}
+        record.update(self.predictor.predict(row[np.newaxis])[0])
+        predicted = time.perf_counter()
+
+        timings = {
+            "decode_ms": (decoded - started) * 1000,
+            "featurize_ms": (featurized - decoded) * 1000,
+            "predict_ms": (predicted - featurized) * 1000,
+            "total_ms": (predicted - started) * 1000,
+        }
+        for stage, ms in timings.items():
+            self.latencies[stage].append(ms)
+        record.update(timings)
+        return record
+
+    def latency(self):
+        """Returns the p50, p99 and maximum latency of every stage over the last LATENCY_WINDOW clips, in milliseconds.
+            """
+
+        return {stage: {"clips": len(values), "p50_ms": float(np.percentile(values, 50)), "p99_ms": float(np.percentile(values, 99)), "max_ms": float(np.max(values))}
+                for stage, values in self.latencies.items() if values}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Scores audio clips one at a time with a warm predictor and reports the latency per clip.")
+    parser.add_argument("paths", nargs="+", help="audio files and directories to score")
+    parser.add_argument("--detection-artifact", required=True, help="detection model artifact (see model_artifact)")
+    parser.add_argument("--classification-artifact", help="classification model artifact, applied to the detected coughs")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times every clip is scored")
+    parser.add_argument("--preload", action="store_true", help="decode the clips before scoring, to measure the featurize and predict latency only")
+    args = parser.parse_args()
+
+    import predict
+
+    started = time.perf_counter()
+    clip_predictor = ClipPredictor.from_artifacts(args.detection_artifact, args.classification_artifact)
+    print("Predictor ready in {:.2f}s".format(time.perf_counter() - started), file=sys.stderr)
+
+    files = predict.list_audio_files(args.paths)
+    sources = files
+    if args.preload:
+        sources = [clip_predictor._decode_clip(file_path, clip_predictor.featurizer.sample_rate, clip_predictor.duration) for file_path in files]
+    for _ in range(args.repeat):
+        for file_path, source in zip(files, sources):
+            record = clip_predictor.predict(source)
+            record["path"] = file_path
+            print(json.dumps(record))
+    print(json.dumps(clip_predictor.latency()), file=sys.stderr)
@@ -1,99 +1,287 @@
 # -*- coding: utf-8 -*-
 
-from pytube import YouTube
-import soundfile as sf
-import librosa
-import numpy as np
+import argparse
+import csv
 import json
 import os
+import shutil
+import sys
 import requests
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, as_completed
+from urllib.parse import urlparse
 from clear_yt_dataset import clear_yt_dataset, clear_yt_downloads
+from clean_dataset import clip_name
+from audio_decode import DECODE_CACHE_PATH, DecodeCache, load_audio
+from segmentation import MIN_DURATION, TOP_DB, segment_signal, write_clips
 
 SAMPLE_RATE = 22050
 DATASET_AUDIO_DURATION = 5
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-link_filename_map = {}
-curr_file_number = 0
-curr_link_number = 0
-try:
-    with open(os.path.join(BASE_DIR, 'link_filename_map.json'), 'r') as fp:
-        link_filename_map = json.load(fp)
-    curr_link_number = len(link_filename_map)
-except Exception as e:
-    pass
-
-def download_youtube_audio(label, link, start_time=0.0, duration = 5.0):
-    global link_filename_map
-    global curr_link_number
-    global curr_file_number
-    download_path=os.path.join(BASE_DIR, 'yt_downloads')
+LABELS = ['dry', 'wet', 'whooping', 'croup']
+SHEET_URL = 'https://spreadsheets.google.com/feeds/list/18BCme4ZxUIGwpzmzTnCSsAxV3kOm_OH8yAHJlDRDDMQ/{}/public/full?alt=json'
+DOWNLOAD_PATH = os.path.join(BASE_DIR, 'yt_downloads')
+YT_DATASET_PATH = os.path.join(BASE_DIR, 'yt_dataset')
+LINK_FILENAME_MAP_PATH = os.path.join(BASE_DIR, 'link_filename_map.json')
+# local copy of the sheet, used instead of fetching it unless it is refreshed
+MANIFEST_PATH = os.path.join(BASE_DIR, 'yt_manifest.json')
+DOWNLOAD_TIMEOUT = 60
 
+
+def load_link_filename_map(path=LINK_FILENAME_MAP_PATH):
+    """Returns the link -> downloaded file name map, empty if it does not exist yet.
+        """
+
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def save_link_filename_map(link_filename_map, path=LINK_FILENAME_MAP_PATH):
+    """Saves the link -> downloaded file name map, atomically so a crash never leaves it truncated.
+        """
+
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(link_filename_map, fp)
+    os.replace(path + '.tmp', path)
+
+
+def _parse_time(value):
     try:
-        # download file if not downloaded
-        filename = link_filename_map.get(link)
-        if filename == None:
-            filename = str(curr_link_number)
-            link_filename_map[link] = filename
-            curr_link_number += 1
-            
-            # download audio from youtube
-            yt = YouTube(link)
-            yt_audio = yt.streams.get_audio_only()
-            yt_audio.download(output_path=download_path, filename=filename)
-
-        # crop and save audio file
-        file_path = os.path.join(BASE_DIR, download_path, filename+'.mp4')
-        cur_dir = os.path.join(BASE_DIR, 'yt_dataset', label)
-        if not os.path.exists(cur_dir):
-            os.makedirs(cur_dir)
-
-        if start_time is None:
-            signal, sample_rate = librosa.load(file_path, sr=SAMPLE_RATE)
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def fetch_sheet_manifest(labels=LABELS):
+    """Fetches the (label, link, start_time, duration) entries of every label from the Google sheet.
+        """
+
+    entries = []
+    for i, label in enumerate(labels):
+        google_sheets_data = requests.get(SHEET_URL.format(i+1), timeout=DOWNLOAD_TIMEOUT)
+        google_sheets_data.raise_for_status()
+        for entry in google_sheets_data.json()['feed'].get('entry') or []:
+            start_time = _parse_time(entry['gsx$starttime']['$t'])
+            duration = _parse_time(entry['gsx$duration']['$t'])
+            if start_time is None or duration is None:
+                start_time = duration = None
+            entries.append({'label': label, 'link': entry['gsx$link']['$t'], 'start_time': start_time, 'duration': duration})
+    return entries
+
+
+def load_manifest(path):
+    """Loads (label, link, start_time, duration) entries from a JSON list or a CSV file with these columns.
+
+        An empty start_time or duration means the whole audio.
+        """
+
+    with open(path, 'r', newline='') as fp:
+        if path.endswith('.csv'):
+            rows = list(csv.DictReader(fp))
         else:
-            signal, sample_rate = librosa.load(file_path, sr=SAMPLE_RATE, offset=start_time, duration=duration)
-            
-        min_duration = 1.5
-        max_duration = DATASET_AUDIO_DURATION
-        threshold = 67
-        cough_intevals = librosa.effects.split(signal, top_db=threshold)
-        for interval in cough_intevals:
-            int_st = interval[0]
-            int_en = interval[1]
-            step = sample_rate*max_duration
-            for i in range(int_st, int_en, step):
-                if int_en-i >= sample_rate*min_duration:
-                    fixed_signal = signal[i:min(i+step, int_en)]
-                    if int_en-i < step:
-                        fixed_signal = librosa.util.fix_length(fixed_signal, step)
-                    sf.write(os.path.join(cur_dir, str(curr_file_number)+'.wav'), fixed_signal, SAMPLE_RATE)
-                    curr_file_number += 1
-
-    except Exception as e:
-        print(e)
+            rows = json.load(fp)
+    entries = []
+    for row in rows:
+        start_time = _parse_time(row.get('start_time'))
+        duration = _parse_time(row.get('duration'))
+        if start_time is None or duration is None:
+            start_time = duration = None
+        entries.append({'label': row['label'], 'link': row['link'], 'start_time': start_time, 'duration': duration})
+    return entries
+
+
+def save_manifest(entries, path=MANIFEST_PATH):
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(entries, fp, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def cached_sheet_manifest(path=MANIFEST_PATH, refresh=False):
+    """Returns the entries of the sheet from its local copy, fetching the sheet only if there is no copy yet or refresh is set.
+
+        Reruns are offline and use the same entries until the copy is refreshed.
+        """
+
+    if refresh or not os.path.exists(path):
+        save_manifest(fetch_sheet_manifest(), path)
+    return load_manifest(path)
+
+
+def find_download(filename, download_path=DOWNLOAD_PATH):
+    """Returns the path of the downloaded audio of a link, None if it is not downloaded.
+        """
+
+    if not os.path.isdir(download_path):
+        return None
+    for f in os.listdir(download_path):
+        if os.path.splitext(f)[0] == filename and not f.endswith('.tmp'):
+            return os.path.join(download_path, f)
+    return None
+
+
+def download_audio(link, filename, download_path=DOWNLOAD_PATH):
+    """Downloads the audio of a link to download_path/filename.<ext>.
+
+        YouTube links are downloaded with pytube, http(s) links directly and anything else is copied as a
+        local path, which lets the pipeline run against a local stand-in serving audio files.
+
+        :return file_path (str): Path to the downloaded file
+        """
+
+    if not os.path.exists(download_path):
+        os.makedirs(download_path)
+    url = urlparse(link)
+    from_youtube = url.netloc.endswith(('youtube.com', 'youtu.be'))
+    file_path = os.path.join(download_path, filename + ('.mp4' if from_youtube else os.path.splitext(url.path)[1] or '.mp4'))
+    # download to a temporary file first so an interrupted download is never taken for a complete one
+    tmp_path = file_path + '.tmp'
+    if from_youtube:
+        from pytube import YouTube
+        # download audio from youtube
+        yt = YouTube(link)
+        yt_audio = yt.streams.get_audio_only()
+        yt_audio.download(output_path=download_path, filename=os.path.basename(tmp_path))
+    elif url.scheme in ('http', 'https'):
+        with requests.get(link, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            with open(tmp_path, 'wb') as fp:
+                for chunk in response.iter_content(chunk_size=1 << 16):
+                    fp.write(chunk)
+    else:
+        shutil.copyfile(url.path if url.scheme == 'file' else link, tmp_path)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+def crop_audio(file_path, label_dir, clip_prefix, start_time=None, duration=None, decode_cache=None):
+    """Crops the downloaded audio of an entry and saves its non-silent parts as clips of DATASET_AUDIO_DURATION.
+
+        Runs in the worker processes.
+
+        :param file_path (str): Path to the downloaded audio
+        :param label_dir (str): Directory of the label of the entry
+        :param clip_prefix (str): Prefix of the clip file names, unique to the entry
+        :param start_time (float): Start of the entry in seconds, None for the whole audio
+        :param duration (float): Duration of the entry in seconds
+        :param decode_cache (DecodeCache): Decode cache of the downloaded audio, None to always decode
+        :return num_clips (int): Number of clips saved
+        """
+
+    if start_time is None:
+        signal, sample_rate = load_audio(file_path, sr=SAMPLE_RATE, cache=decode_cache)
+    else:
+        signal, sample_rate = load_audio(file_path, sr=SAMPLE_RATE, offset=start_time, duration=duration, cache=decode_cache)
+
+    clips, interval_indices, window_indices = segment_signal(signal, sample_rate, MIN_DURATION, DATASET_AUDIO_DURATION, TOP_DB)
+    paths = [os.path.join(label_dir, clip_name(clip_prefix, interval_index, window_index)) for interval_index, window_index in zip(interval_indices, window_indices)]
+    write_clips(clips, paths, SAMPLE_RATE)
+    return len(clips)
+
+
+def download_dataset(entries, download_workers=4, workers=1, download_path=DOWNLOAD_PATH, dataset_path=YT_DATASET_PATH,
+                     link_filename_map_path=LINK_FILENAME_MAP_PATH, decode_cache=None):
+    """Downloads the links of the entries and crops them into the clips of yt_dataset.
+
+        Links are downloaded by a bounded pool of threads, each at most once. As soon as a link is downloaded
+        its entries are cropped in a pool of worker processes, and the link -> file name map is saved.
+        Links already in the map whose file is still in yt_downloads are not downloaded again.
+
+        :param entries (list): (label, link, start_time, duration) dicts, see load_manifest
+        :param download_workers (int): Number of concurrent downloads
+        :param workers (int): Number of worker processes cropping the audio
+        :param download_path (str): Directory of the downloaded audio
+        :param dataset_path (str): Directory of the dataset, with a sub-folder per label
+        :param link_filename_map_path (str): Path to the link -> downloaded file name map
+        :param decode_cache (DecodeCache): Decode cache of the downloaded audio, None to always decode
+        :return num_clips (int), failures (list): Number of clips saved, (link, error message) of every failure
+        """
+
+    link_filename_map = load_link_filename_map(link_filename_map_path)
+    next_number = max([int(filename) for filename in link_filename_map.values() if filename.isdigit()] + [-1]) + 1
+    entries_by_link = {}
+    for entry_index, entry in enumerate(entries):
+        entries_by_link.setdefault(entry['link'], []).append((entry_index, entry))
+
+    failures = []
+    num_clips = 0
+    crop_executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    crops = []
+
+    def crop(file_path, link):
+        for entry_index, entry in entries_by_link[link]:
+            label_dir = os.path.join(dataset_path, entry['label'])
+            if not os.path.exists(label_dir):
+                os.makedirs(label_dir)
+            args = (file_path, label_dir, str(entry_index), entry['start_time'], entry['duration'], decode_cache)
+            if crop_executor:
+                future = crop_executor.submit(crop_audio, *args)
+            else:
+                future = Future()
+                try:
+                    future.set_result(crop_audio(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            crops.append((link, future))
+
+    with ThreadPoolExecutor(max_workers=download_workers) as download_executor:
+        downloads = {}
+        for link in entries_by_link:
+            filename = link_filename_map.get(link)
+            file_path = find_download(filename, download_path) if filename is not None else None
+            if file_path is not None:
+                crop(file_path, link)
+                continue
+            if filename is None:
+                filename = str(next_number)
+                next_number += 1
+            downloads[download_executor.submit(download_audio, link, filename, download_path)] = (link, filename)
+
+        for future in as_completed(downloads):
+            link, filename = downloads[future]
+            try:
+                file_path = future.result()
+            except Exception as e:
+                failures.append((link, 'download failed: {}: {}'.format(type(e).__name__, e)))
+                continue
+            link_filename_map[link] = filename
+            save_link_filename_map(link_filename_map, link_filename_map_path)
+            print('Downloaded', link)
+            crop(file_path, link)
+
+    for link, future in crops:
+        try:
+            num_clips += future.result()
+        except Exception as e:
+            failures.append((link, 'crop failed: {}: {}'.format(type(e).__name__, e)))
+    if crop_executor:
+        crop_executor.shutdown()
+    return num_clips, failures
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Downloads the audio of the links of the YouTube dataset and crops it into clips.")
+    parser.add_argument("--manifest", help="local CSV or JSON manifest of (label, link, start_time, duration) to use instead of the sheet")
+    parser.add_argument("--refresh-manifest", action="store_true", help="fetch the sheet again instead of using its local copy (yt_manifest.json)")
+    parser.add_argument("--download-workers", type=int, default=4, help="number of concurrent downloads")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes cropping the downloaded audio")
+    parser.add_argument("--decode-cache-dir", default=DECODE_CACHE_PATH, help="directory of the cache of resampled downloads")
+    parser.add_argument("--no-decode-cache", action="store_true", help="decode the downloaded audio of every entry again")
+    args = parser.parse_args()
+    decode_cache = None if args.no_decode_cache else DecodeCache(args.decode_cache_dir)
+
     clear_yt_dataset()
     # clear_yt_downloads()
 
-    labels_count = 4
-    labels = ['dry', 'wet', 'whooping', 'croup']
+    if args.manifest:
+        entries = load_manifest(args.manifest)
+    else:
+        entries = cached_sheet_manifest(refresh=args.refresh_manifest)
 
-    for i in range(labels_count):
-        google_sheets_data = requests.get('https://spreadsheets.google.com/feeds/list/18BCme4ZxUIGwpzmzTnCSsAxV3kOm_OH8yAHJlDRDDMQ/'+str(i+1)+'/public/full?alt=json')
-        google_sheets_data = google_sheets_data.json()['feed'].get('entry')
-        if google_sheets_data:
-            for entry in google_sheets_data:
-                try:
-                    start_time = float(entry['gsx$starttime']['$t'])
-                    duration = float(entry['gsx$duration']['$t'])
-                except Exception as e:
-                    start_time = None
-                    duration = None
-                
-                print(labels[i], entry['gsx$link']['$t'], start_time, duration)
-                download_youtube_audio(label=labels[i], link=entry['gsx$link']['$t'], start_time=start_time, duration=duration)
-
-    with open(os.path.join(BASE_DIR, 'link_filename_map.json'), 'w') as fp:
-        json.dump(link_filename_map, fp)
\ No newline at end of file
+    num_clips, failures = download_dataset(entries, args.download_workers, args.workers, decode_cache=decode_cache)
+    print("Saved {} clips from {} entries".format(num_clips, len(entries)))
+    for link, error in failures:
+        print("{}: {}".format(link, error), file=sys.stderr)
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import csv
+import json
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import librosa
+import scipy.ndimage
+import soundfile as sf
+from audio_decode import DecodeCache, load_audio
+from audio_preprocessing import SAMPLE_RATE, bounded_map, get_features_batch
+from predict import BATCH_SIZE, DATASET_AUDIO_DURATION, Predictor, list_audio_files
+from segmentation import clip_matrix, keep_windows
+from stream_detector import BLOCK_SIZE, read_blocks
+
+# seconds of audio segmented at a time, the memory used is about a chunk and an event whatever the recording length
+CHUNK_DURATION = 60.0
+# frames louder than the local noise floor by ENERGY_MARGIN_DB, and than SILENCE_DB, are active
+ENERGY_MARGIN_DB = 12.0
+SILENCE_DB = -60.0
+# the noise floor of a frame is the NOISE_PERCENTILE percentile of the frame energies within NOISE_WINDOW seconds around it
+NOISE_PERCENTILE = 10
+NOISE_WINDOW = 5.0
+# active regions closer than MERGE_GAP seconds are one event, events shorter than MIN_EVENT_DURATION seconds are dropped
+MERGE_GAP = 0.2
+MIN_EVENT_DURATION = 0.2
+# threshold of the spectral flux peaks splitting an active region into events, in decibels of mean log-mel flux
+ONSET_DELTA = 5.0
+# seconds of onset envelope around a frame librosa.onset.onset_detect picks its peaks from, with its default parameters
+ONSET_CONTEXT = 0.15
+EVENT_FIELDS = [
+    "path",
+    "start",
+    "end",
+    "peak_db",
+    "detection",
+    "detection_name",
+    "detection_score",
+    "classification",
+    "classification_name",
+    "classification_score",
+    "error",
+]
+
+
+class EventSegmenter:
+    """Finds the sound events of arbitrarily long recordings, read in chunks, and scores each one with the models.
+
+        Active frames are found on the frame energy, against a noise floor following the background of the recording,
+        and active regions closer than merge_gap are merged. The regions are split at the spectral flux onsets
+        inside them, so that the coughs of a bout are separate events, and cut to max_duration. Every event is
+        scored as a clip of DATASET_AUDIO_DURATION seconds starting at its onset, padded with zeros after its end
+        like the clips of clean_dataset.
+
+        Chunks overlap by the events not finished at their end, which are segmented again with the next chunk, and
+        by the frames the noise floor and onsets of their first frames depend on, so the events do not depend on the
+        chunk boundaries.
+        """
+
+    def __init__(self, predictor, chunk_duration=CHUNK_DURATION, min_duration=MIN_EVENT_DURATION, max_duration=DATASET_AUDIO_DURATION,
+                 merge_gap=MERGE_GAP, energy_margin_db=ENERGY_MARGIN_DB, silence_db=SILENCE_DB, noise_window=NOISE_WINDOW,
+                 onset_delta=ONSET_DELTA, batch_size=BATCH_SIZE):
+        """
+            :param predictor (Predictor): Models the events are scored with, None to only segment
+            :param chunk_duration (float): Seconds of audio segmented at a time
+            :param min_duration (float): Minimum duration of an event in seconds
+            :param max_duration (float): Maximum duration of an event in seconds, longer regions are cut
+            :param merge_gap (float): Longest silence within an event in seconds
+            :param energy_margin_db (float): Energy above the noise floor of active frames, in decibels
+            :param silence_db (float): Energy of the loudest silent frames, in decibels relative to full scale
+            :param noise_window (float): Seconds around a frame its noise floor is estimated from
+            :param onset_delta (float): Threshold of the onsets splitting the events, see librosa.onset.onset_detect
+            :param batch_size (int): Number of events scored together
+            """
+
+        self.predictor = predictor
+        extraction = predictor.extraction if predictor else {"sample_rate": SAMPLE_RATE, "n_fft": 2048, "hop_length": 512}
+        self.sample_rate = extraction["sample_rate"]
+        self.n_fft = extraction["n_fft"]
+        self.hop_length = extraction["hop_length"]
+        self.chunk_length = int(chunk_duration * self.sample_rate)
+        self.min_frames = max(1, int(round(min_duration * self.sample_rate / self.hop_length)))
+        self.gap_frames = int(round(merge_gap * self.sample_rate / self.hop_length))
+        self.max_length = int(max_duration * self.sample_rate)
+        self.clip_length = int(DATASET_AUDIO_DURATION * self.sample_rate)
+        self.noise_frames = 2 * int(noise_window * self.sample_rate / self.hop_length / 2) + 1
+        # an event ending within guard samples of the end of a chunk may go on in the next one, and the frames within
+        # guard samples of the start of a chunk depend on the samples before it
+        self.guard = (self.gap_frames + 1 + self.noise_frames // 2) * self.hop_length + self.n_fft + int(ONSET_CONTEXT * self.sample_rate)
+        self.energy_margin_db = energy_margin_db
+        self.silence_db = silence_db
+        self.onset_delta = onset_delta
+        self.batch_size = batch_size
+        self.extraction = extraction
+        # samples of context segmented again before every chunk, so its first frames are computed as in the previous one
+        self.context = -(-self.guard // self.hop_length) * self.hop_length
+
+    def _regions(self, active):
+        # [start, end) frames of the runs of active frames, the runs closer than gap_frames being merged
+        edges = np.flatnonzero(np.diff(np.concatenate([[False], active, [False]]).astype(np.int8)))
+        starts, ends = edges[0::2], edges[1::2]
+        if len(starts) > 1:
+            keep = np.concatenate([[True], starts[1:] - ends[:-1] > self.gap_frames])
+            starts, ends = starts[keep], np.concatenate([ends[np.flatnonzero(keep)[1:] - 1], ends[-1:]])
+        return starts, ends
+
+    def segment(self, signal, first=0, final=True):
+        """Finds the events of a chunk of signal.
+
+            :param signal (ndarray): Mono float32 samples, starting on the frame grid of the previous chunks
+            :param first (int): Samples of context before the chunk, the events are trimmed to start after them
+            :param final (bool): The stream ends with the chunk, otherwise the events that may go on are left out
+            :return starts (ndarray), lengths (ndarray), peaks_db (ndarray), keep_from (int): First sample and number of
+                samples of every finished event, its peak frame energy, and the first sample to keep for the next chunk
+            """
+
+        spectrogram = np.abs(librosa.stft(signal, n_fft=self.n_fft, hop_length=self.hop_length))
+        energy_db = librosa.amplitude_to_db(librosa.feature.rms(S=spectrogram, frame_length=self.n_fft)[0], top_db=None)
+        noise_floor_db = scipy.ndimage.percentile_filter(energy_db, NOISE_PERCENTILE, size=self.noise_frames, mode="nearest")
+        starts, ends = self._regions((energy_db > noise_floor_db + self.energy_margin_db) & (energy_db > self.silence_db))
+
+        # split the regions at the onsets at least min_frames from both of their ends
+        log_mel_spectrogram = librosa.power_to_db(librosa.feature.melspectrogram(S=spectrogram**2, sr=self.sample_rate), top_db=None)
+        onset_envelope = librosa.onset.onset_strength(S=log_mel_spectrogram, sr=self.sample_rate)
+        # not clipped or normalized per chunk, the log-mel flux does not depend on the gain of the recording
+        onsets = librosa.onset.onset_detect(onset_envelope=onset_envelope, sr=self.sample_rate, hop_length=self.hop_length,
+                                            delta=self.onset_delta, normalize=False)
+        regions = np.searchsorted(starts, onsets, side="right") - 1
+        splits = []
+        for onset, region in zip(onsets, regions):
+            if region < 0:
+                continue
+            previous = max(starts[region], splits[-1]) if splits else starts[region]
+            if onset - previous >= self.min_frames and ends[region] - onset >= self.min_frames:
+                splits.append(onset)
+        boundaries = np.sort(np.concatenate([starts, splits])).astype(np.int64)
+        # an event ends at the next onset of its region, or at the end of the region
+        regions = np.searchsorted(starts, boundaries, side="right") - 1
+        next_boundaries = np.concatenate([boundaries[1:], [len(energy_db)]])
+        next_regions = np.concatenate([regions[1:], [-1]])
+        frames = np.stack([boundaries, np.where(next_regions == regions, next_boundaries, ends[regions])], axis=1)
+        frames = frames[frames[:, 1] - frames[:, 0] >= self.min_frames]
+
+        intervals = np.clip(frames * self.hop_length, first, len(signal))
+        event_starts, lengths, _, _ = keep_windows(intervals, self.max_length, self.min_frames * self.hop_length)
+        finished = np.ones(len(event_starts), dtype=bool) if final else event_starts + lengths <= len(signal) - self.guard
+        keep_from = len(signal) if final else len(signal) - self.guard
+        if not finished.all():
+            keep_from = min(keep_from, int(event_starts[~finished].min()))
+        # keep the frame grid of the next chunk aligned with this one
+        keep_from -= keep_from % self.hop_length
+        peaks_db = np.array([energy_db[start // self.hop_length:-(-(start + length) // self.hop_length)].max()
+                             for start, length in zip(event_starts[finished], lengths[finished])])
+        return event_starts[finished], lengths[finished], peaks_db, max(first, keep_from)
+
+    def score(self, signal, starts, lengths):
+        """Scores the events of a chunk, each as a clip starting at its onset and padded with zeros after its end.
+
+            :return predictions (list): One dict per event, see predict.Predictor.predict
+            """
+
+        predictions = []
+        for i in range(0, len(starts), self.batch_size):
+            clips = clip_matrix(signal, starts[i:i + self.batch_size], lengths[i:i + self.batch_size], self.clip_length)
+            with warnings.catch_warnings():
+                # the tuning of an event without tonal peaks cannot be estimated
+                warnings.simplefilter("ignore")
+                # the rows of predict.predict_files, the models being trained on the ones of get_features_csv_row
+                features = get_features_batch(clips, self.sample_rate, self.extraction["num_mfcc"], self.n_fft, self.hop_length, self.extraction["feature_mode"])
+            predictions.extend(self.predictor.predict(features))
+        return predictions
+
+    def process(self, blocks):
+        """Consumes audio blocks and yields the events of the stream in order, a chunk at a time.
+
+            :param blocks: Iterable of mono float32 blocks at the sample rate of the models
+            :return: Iterator of events (dict with start, end and peak_db, and the prediction of the models if any)
+            """
+
+        # samples of the stream from sample buffer_start on, kept as blocks until a chunk is complete
+        pending = []
+        num_pending = 0
+        buffer = np.zeros(0, dtype=np.float32)
+        buffer_start = 0
+        # samples of buffer already segmented with the previous chunk
+        first = 0
+        blocks = iter(blocks)
+        final = False
+        while not final:
+            block = next(blocks, None)
+            final = block is None
+            if not final:
+                pending.append(np.asarray(block, dtype=np.float32))
+                num_pending += len(block)
+                if len(buffer) + num_pending < self.chunk_length:
+                    continue
+            buffer = np.concatenate([buffer] + pending)
+            pending, num_pending = [], 0
+            if len(buffer) <= first:
+                break
+            starts, lengths, peaks_db, keep_from = self.segment(buffer, first, final)
+            predictions = self.score(buffer, starts, lengths) if self.predictor else [{}] * len(starts)
+            for start, length, peak_db, prediction in zip(starts, lengths, peaks_db, predictions):
+                event = {
+                    "start": (buffer_start + start) / self.sample_rate,
+                    "end": (buffer_start + start + length) / self.sample_rate,
+                    "peak_db": float(peak_db),
+                }
+                event.update(prediction)
+                yield event
+            first = min(keep_from, self.context)
+            buffer = buffer[keep_from - first:]
+            buffer_start += keep_from - first
+
+
+def read_file_blocks(file_path, sample_rate, block_size=BLOCK_SIZE, decode_cache=None):
+    """Reads an audio file block by block, see stream_detector.read_blocks.
+
+        Formats soundfile cannot read (mp4, webm, ...) are decoded whole, once if a decode cache is given, and then
+        read from the memory-mapped signal.
+        """
+
+    try:
+        sf.info(file_path)
+    except RuntimeError:
+        signal, _ = load_audio(file_path, sr=sample_rate, cache=decode_cache)
+        for start in range(0, len(signal), block_size):
+            yield signal[start:start + block_size]
+        return
+    yield from read_blocks(file_path, block_size, sample_rate)
+
+
+def segment_file(file_path, segmenter, decode_cache=None):
+    """Returns the events of an audio file and the seconds of audio per second of processing.
+
+        Runs in the worker processes. A file that fails to decode is reported as a single event with an error.
+
+        :return events (list), metrics (dict): Events in order (see EventSegmenter.process), audio seconds and real-time factor
+        """
+
+    started = time.perf_counter()
+    audio_samples = 0
+
+    def counted(blocks):
+        nonlocal audio_samples
+        for block in blocks:
+            audio_samples += len(block)
+            yield block
+
+    try:
+        events = list(segmenter.process(counted(read_file_blocks(file_path, segmenter.sample_rate, decode_cache=decode_cache))))
+    except Exception as e:
+        events = [{"error": "{}: {}".format(type(e).__name__, e)}]
+    for event in events:
+        event["path"] = file_path
+    seconds = time.perf_counter() - started
+    audio_seconds = audio_samples / segmenter.sample_rate
+    return events, {"audio_seconds": audio_seconds, "seconds": seconds, "realtime_factor": audio_seconds / seconds if seconds else 0.0}
+
+
+def _segment_file_args(args):
+    return segment_file(*args)
+
+
+def segment_files(segmenter, files, workers=1, decode_cache=None):
+    """Segments audio files, several at a time in worker processes if workers > 1.
+
+        :return: Iterator of (file path, events, metrics) in the order of files
+        """
+
+    args = [(file_path, segmenter, decode_cache) for file_path in files]
+    if workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for file_path, (events, metrics) in zip(files, bounded_map(executor, _segment_file_args, args, workers * 2)):
+                yield file_path, events, metrics
+    else:
+        for file_path, (events, metrics) in zip(files, map(_segment_file_args, args)):
+            yield file_path, events, metrics
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Writes the table of the cough events of long recordings, with their onset, offset and scores.")
+    parser.add_argument("paths", nargs="+", help="audio files and directories to segment (e.g. yt_downloads)")
+    parser.add_argument("--detection-artifact", help="detection model artifact (see model_artifact), events are only segmented without it")
+    parser.add_argument("--classification-artifact", help="classification model artifact, applied to the events detected as coughs")
+    parser.add_argument("--coughs-only", action="store_true", help="only write the events detected as coughs")
+    parser.add_argument("--chunk-duration", type=float, default=CHUNK_DURATION, help="seconds of audio segmented at a time")
+    parser.add_argument("--min-duration", type=float, default=MIN_EVENT_DURATION, help="minimum duration of an event in seconds")
+    parser.add_argument("--merge-gap", type=float, default=MERGE_GAP, help="longest silence within an event in seconds")
+    parser.add_argument("--energy-margin", type=float, default=ENERGY_MARGIN_DB, help="decibels above the noise floor of active frames")
+    parser.add_argument("--silence", type=float, default=SILENCE_DB, help="decibels below full scale of the loudest silent frames")
+    parser.add_argument("--onset-delta", type=float, default=ONSET_DELTA, help="threshold of the onsets splitting the events")
+    parser.add_argument("--workers", type=int, default=1, help="number of files segmented at the same time")
+    parser.add_argument("--no-decode-cache", action="store_true", help="decode the files soundfile cannot read again at every run")
+    parser.add_argument("--output", help="output file, standard output by default")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="csv", help="output format")
+    args = parser.parse_args()
+
+    predictor = Predictor.from_artifacts(args.detection_artifact, args.classification_artifact) if args.detection_artifact else None
+    segmenter = EventSegmenter(predictor, args.chunk_duration, args.min_duration, merge_gap=args.merge_gap,
+                               energy_margin_db=args.energy_margin, silence_db=args.silence, onset_delta=args.onset_delta)
+    decode_cache = None if args.no_decode_cache else DecodeCache()
+
+    started = time.perf_counter()
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    writer = csv.DictWriter(output, fieldnames=EVENT_FIELDS) if args.format == "csv" else None
+    if writer:
+        writer.writeheader()
+    num_events = 0
+    audio_seconds = 0.0
+    for file_path, events, metrics in segment_files(segmenter, list_audio_files(args.paths), args.workers, decode_cache):
+        if args.coughs_only and predictor:
+            events = [event for event in events if event.get("detection") == predictor.cough_label]
+        for event in events:
+            if writer:
+                writer.writerow(event)
+            else:
+                output.write(json.dumps(event) + "\n")
+        num_events += len(events)
+        audio_seconds += metrics["audio_seconds"]
+        print("{}: {} events in {:.0f}s of audio, {:.0f}x real time".format(file_path, len(events), metrics["audio_seconds"], metrics["realtime_factor"]), file=sys.stderr)
+    if args.output:
+        output.close()
+    elapsed = time.perf_counter() - started
+    print("Found {} events in {:.0f}s of audio in {:.1f}s ({:.0f}x real time)".format(num_events, audio_seconds, elapsed, audio_seconds / elapsed if elapsed else 0), file=sys.stderr)
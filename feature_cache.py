@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+# bump when the feature extraction changes in a way that invalidates cached features
+CACHE_VERSION = 2
+CACHE_EXTENSION = ".npz"
+
+
+def file_content_hash(file_path, chunk_size=1 << 20):
+    """Returns the hex digest of the content of a file.
+
+        :param file_path (str): Path to file
+        :param chunk_size (int): Number of bytes read at a time
+        :return digest (str): blake2b hex digest
+        """
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FeatureCache:
+    """Persistent cache of the features of audio files, keyed by file content and extraction parameters.
+
+        Every entry is an .npz file in cache_dir. When the cache grows beyond max_bytes the least recently
+        used entries are evicted, except the ones found by probe that have not been read yet. An instance may be
+        shared by threads, and entries removed by another process are skipped.
+        """
+
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        """
+            :param cache_dir (str): Directory the entries are stored in
+            :param max_bytes (int): Maximum total size of the entries
+            """
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # entries found by probe and not read yet, never evicted
+        self._pinned = set()
+        self._lock = threading.RLock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._size = sum(entry.stat().st_size for entry in self._entries())
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def key(self, file_path, **params):
+        """Returns the cache key of a file for the given extraction parameters.
+
+            :param file_path (str): Path to audio file
+            :param params: Extraction parameters (num_mfcc, n_fft, hop_length, num_segments, sample_rate, ...)
+            :return key (str): Cache key
+            """
+
+        params = dict(params, cache_version=CACHE_VERSION, content=file_content_hash(file_path))
+        return hashlib.blake2b(json.dumps(params, sort_keys=True).encode(), digest_size=20).hexdigest()
+
+    def probe(self, key):
+        """Checks whether a key is cached, counting a hit or a miss.
+            """
+
+        with self._lock:
+            try:
+                # mark the entry as recently used
+                os.utime(self._path(key))
+            except OSError:
+                self.misses += 1
+                return False
+            self.hits += 1
+            self._pinned.add(self._path(key))
+            return True
+
+    def get(self, key):
+        """Returns the cached (segments, num_mfcc_vectors_per_segment, metrics) of a key, or None if it is not cached.
+
+            Statistics are counted by probe, a failed read after a successful probe counts as a miss.
+            """
+
+        path = self._path(key)
+        with self._lock:
+            self._pinned.discard(path)
+        try:
+            with np.load(path) as entry:
+                num_segments = int(entry["num_segments"])
+                segments = [{} for _ in range(num_segments)]
+                for name in entry.files:
+                    if "/" in name:
+                        index, feature_name = name.split("/", 1)
+                        segments[int(index)][feature_name] = entry[name]
+                result = segments, int(entry["num_mfcc_vectors_per_segment"]), json.loads(str(entry["metrics"]))
+        except (OSError, KeyError, ValueError):
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return result
+
+    def put(self, key, result):
+        """Stores the (segments, num_mfcc_vectors_per_segment, metrics) returned by extract_file_features.
+            """
+
+        segments, num_mfcc_vectors_per_segment, metrics = result
+        arrays = {"{}/{}".format(i, name): value for i, features in enumerate(segments) for name, value in features.items()}
+        path = self._path(key)
+        # write to a temporary file first so an interrupted run never leaves a truncated entry
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            np.savez(fp, num_segments=len(segments), num_mfcc_vectors_per_segment=num_mfcc_vectors_per_segment, metrics=json.dumps(metrics), **arrays)
+        with self._lock:
+            try:
+                self._size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            self._size += os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes.
+            """
+
+        with self._lock:
+            entries = []
+            for entry in self._entries():
+                try:
+                    entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+                except FileNotFoundError:
+                    # evicted by another process since the directory was listed
+                    continue
+            for _, size, path in sorted(entries):
+                if self._size <= self.max_bytes:
+                    break
+                if path in self._pinned:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                self._size -= size
+                self.evictions += 1
+
+    def stats(self):
+        """Returns the hit/miss statistics of the cache.
+            """
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "size_bytes": self._size,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_EXTENSION)
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(CACHE_EXTENSION)]
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import struct
+import numpy as np
+
+FEATURES_FILE = "features.npy"
+LABELS_FILE = "labels.npy"
+METADATA_FILE = "metadata.json"
+# written after every committed chunk and removed once the store is complete
+PROGRESS_FILE = "progress.json"
+FEATURES_DTYPE = np.float32
+LABELS_DTYPE = np.int32
+# fixed .npy header size, so the row count can be rewritten in place once all rows are written
+NPY_HEADER_LENGTH = 128
+
+
+def _npy_header(shape, dtype):
+    """Returns a version 1.0 .npy header of exactly NPY_HEADER_LENGTH bytes.
+        """
+
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(np.dtype(dtype).str, tuple(shape))
+    # magic string (6 bytes), version (2 bytes) and header length (2 bytes) come before the header
+    header = header.ljust(NPY_HEADER_LENGTH - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class _NpyRowWriter:
+    """Appends rows to a 2-D (or 1-D) .npy file without knowing the number of rows in advance.
+
+        With num_rows > 0 an existing file is reopened and truncated to its first num_rows rows.
+        """
+
+    def __init__(self, path, row_shape, dtype, num_rows=0):
+        self.path = path
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.num_rows = num_rows
+        if num_rows:
+            self.fp = open(path, "r+b")
+            self.fp.truncate(NPY_HEADER_LENGTH + num_rows * self.dtype.itemsize * int(np.prod(self.row_shape)))
+            self.fp.seek(0, os.SEEK_END)
+        else:
+            self.fp = open(path, "wb")
+            self.fp.write(_npy_header((0,) + self.row_shape, self.dtype))
+
+    def write(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        self.fp.write(rows.tobytes())
+        self.num_rows += len(rows)
+
+    def flush(self):
+        """Makes the rows written so far visible to readers by updating the header.
+            """
+
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        position = self.fp.tell()
+        self.fp.seek(0)
+        self.fp.write(_npy_header((self.num_rows,) + self.row_shape, self.dtype))
+        self.fp.seek(position)
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+
+class FeatureStoreWriter:
+    """Writes feature rows and labels into a feature store directory in chunks.
+
+        The store holds features.npy (float32, rows x features), labels.npy (int32) and a metadata.json sidecar.
+        Rows are buffered and committed to disk every chunk_size rows, at the end of a source file. After each
+        commit progress.json records how many rows and source files are on disk, so an interrupted run can
+        resume from the last committed chunk.
+        """
+
+    def __init__(self, store_path, metadata=None, chunk_size=256, resume=False):
+        """
+            :param store_path (str): Path to the store directory
+            :param metadata (dict): Extra metadata saved in the sidecar (extraction parameters, label map, ...)
+            :param chunk_size (int): Number of rows buffered before they are committed
+            :param resume (bool): Continue an interrupted store written with the same metadata
+            """
+
+        self.store_path = store_path
+        self.metadata = json.loads(json.dumps(metadata or {}))
+        self.chunk_size = chunk_size
+        # number of source files whose rows are committed
+        self.num_files = 0
+        self._pending_rows = []
+        self._pending_labels = []
+        self._pending_files = 0
+        self._features = None
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+        # the sidecar is only written once the store is complete
+        if os.path.exists(os.path.join(store_path, METADATA_FILE)):
+            os.remove(os.path.join(store_path, METADATA_FILE))
+
+        progress = self._read_progress() if resume else None
+        if progress and all(progress["metadata"].get(key) == value for key, value in self.metadata.items()):
+            self.metadata = progress["metadata"]
+            self.num_files = progress["num_files"]
+            if progress["num_rows"]:
+                self._features = _NpyRowWriter(os.path.join(store_path, FEATURES_FILE), progress["row_shape"], FEATURES_DTYPE, progress["num_rows"])
+            self._labels = _NpyRowWriter(os.path.join(store_path, LABELS_FILE), (), LABELS_DTYPE, progress["num_rows"])
+        else:
+            self._labels = _NpyRowWriter(os.path.join(store_path, LABELS_FILE), (), LABELS_DTYPE)
+            self._write_progress()
+
+    @property
+    def num_rows(self):
+        return self._labels.num_rows + len(self._pending_rows)
+
+    def write(self, rows, labels):
+        """Appends feature rows along with their labels.
+
+            :param rows (ndarray): Feature rows of shape (n, n_features)
+            :param labels (ndarray): Labels of shape (n,)
+            """
+
+        self._pending_rows.extend(np.atleast_2d(rows))
+        self._pending_labels.extend(np.atleast_1d(labels))
+
+    def end_file(self):
+        """Marks the end of the rows of a source file, committing them if a chunk is full.
+            """
+
+        self._pending_files += 1
+        if len(self._pending_rows) >= self.chunk_size:
+            self.commit()
+
+    def commit(self):
+        """Writes the buffered rows to disk and records the progress.
+            """
+
+        if self._pending_rows:
+            rows = np.stack(self._pending_rows)
+            if self._features is None:
+                self._features = _NpyRowWriter(os.path.join(self.store_path, FEATURES_FILE), rows.shape[1:], FEATURES_DTYPE)
+            self._features.write(rows)
+            self._labels.write(np.array(self._pending_labels))
+            self._features.flush()
+            self._labels.flush()
+        self.num_files += self._pending_files
+        self._pending_rows, self._pending_labels, self._pending_files = [], [], 0
+        self._write_progress()
+
+    def close(self):
+        self.commit()
+        if self._features is None:
+            self._features = _NpyRowWriter(os.path.join(self.store_path, FEATURES_FILE), (0,), FEATURES_DTYPE)
+        self._features.close()
+        self._labels.close()
+        metadata = dict(self.metadata, num_rows=self._features.num_rows, num_features=self._features.row_shape[0])
+        with open(os.path.join(self.store_path, METADATA_FILE), "w") as fp:
+            json.dump(metadata, fp)
+        os.remove(os.path.join(self.store_path, PROGRESS_FILE))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # leave the last committed chunk and its progress on disk to resume from
+            if self._features is not None:
+                self._features.fp.close()
+            self._labels.fp.close()
+
+    def _read_progress(self):
+        try:
+            with open(os.path.join(self.store_path, PROGRESS_FILE), "r") as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    def _write_progress(self):
+        progress = {
+            "num_rows": self._labels.num_rows,
+            "num_files": self.num_files,
+            "row_shape": list(self._features.row_shape) if self._features else None,
+            "metadata": self.metadata,
+        }
+        path = os.path.join(self.store_path, PROGRESS_FILE)
+        with open(path + ".tmp", "w") as fp:
+            json.dump(progress, fp)
+        os.replace(path + ".tmp", path)
+
+
+def load_feature_store(store_path):
+    """Opens a feature store without reading it, the arrays are memory-mapped.
+
+        :param store_path (str): Path to the store directory
+        :return features (ndarray), labels (ndarray), metadata (dict): Read-only memory maps and the sidecar
+        """
+
+    features = np.load(os.path.join(store_path, FEATURES_FILE), mmap_mode="r")
+    labels = np.load(os.path.join(store_path, LABELS_FILE), mmap_mode="r")
+    with open(os.path.join(store_path, METADATA_FILE), "r") as fp:
+        metadata = json.load(fp)
+    return features, labels, metadata
+
+
+def get_feature(features, metadata, name):
+    """Returns the columns of one feature, reshaped to (rows, frames, ...).
+
+        :param features (ndarray): Feature matrix as returned by load_feature_store
+        :param metadata (dict): Metadata as returned by load_feature_store
+        :param name (str): Feature name (see features.FEATURE_NAMES)
+        :return feature (ndarray): View of the feature columns
+        """
+
+    for entry in metadata["layout"]:
+        if entry["name"] == name:
+            size = int(np.prod(entry["shape"]))
+            return features[:, entry["offset"]:entry["offset"] + size].reshape((len(features),) + tuple(entry["shape"]))
+    raise KeyError(name)
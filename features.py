@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import numpy as np
+import librosa
+
+# librosa defaults used by the spectral features of get_features_csv_row
+DEFAULT_N_FFT = 2048
+DEFAULT_HOP_LENGTH = 512
+# constant added to the signal before computing rolloff and bandwidth
+SIGNAL_OFFSET = 0.01
+# dynamic range of the log-mel spectrogram (librosa.power_to_db default)
+TOP_DB = 80.0
+# number of chroma bins
+N_CHROMA = 12
+# order in which the features are flattened into a csv row
+FEATURE_NAMES = [
+    "mfcc",
+    "spectral_centroid",
+    "spectral_rolloff",
+    "spectral_bandwidth_2",
+    "spectral_bandwidth_3",
+    "spectral_bandwidth_4",
+    "zero_crossing_rate",
+    "chroma",
+]
+# number of dimensions of every feature of a single segment, frames first
+FEATURE_NDIM = {name: 2 if name in ("mfcc", "chroma") else 1 for name in FEATURE_NAMES}
+# "frames" flattens every frame of every feature, "pooled" summarizes every feature over time (see pool_features)
+FEATURE_MODES = ["frames", "pooled"]
+# statistics of pool_features, the delta ones are over the frame-to-frame differences
+POOLING_STATISTICS = ["mean", "std", "min", "max", "delta_mean", "delta_std"]
+
+def spectral_bandwidths(spectrogram, sample_rate, orders, n_fft=DEFAULT_N_FFT):
+    """Computes librosa.feature.spectral_bandwidth for several orders p.
+
+        The column-normalized spectrogram, the centroid and the deviation from it are shared by all orders.
+
+        :param spectrogram (ndarray): Magnitude spectrogram of shape (..., freqs, frames)
+        :param sample_rate (int): Sample rate of the signal
+        :param orders (tuple): Orders p of the bandwidths
+        :param n_fft (int): FFT size the spectrogram was computed with
+        :return: Iterator of (p, spectral bandwidth of shape (..., frames)) pairs
+        """
+
+    freq = librosa.fft_frequencies(sr=sample_rate, n_fft=n_fft).reshape(-1, 1)
+    normalized_spectrogram = librosa.util.normalize(spectrogram, norm=1, axis=-2)
+    centroid = np.sum(freq * normalized_spectrogram, axis=-2, keepdims=True)
+    deviation = np.abs(freq - centroid)
+    for p in orders:
+        yield p, np.sum(normalized_spectrogram * deviation**p, axis=-2) ** (1.0 / p)
+
+
+@functools.lru_cache(maxsize=32)
+def _mel_filterbank(sample_rate, n_fft, n_mels):
+    # librosa.filters.mel, built once per parameters and shared read-only
+    mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=n_fft, n_mels=n_mels)
+    mel_basis.flags.writeable = False
+    return mel_basis
+
+
+@functools.lru_cache(maxsize=128)
+def _chroma_filterbank(sample_rate, n_fft, tuning):
+    # tunings are estimated with a resolution of 0.01 bin, so few filterbanks are ever built
+    chroma_basis = librosa.filters.chroma(sr=sample_rate, n_fft=n_fft, tuning=tuning, n_chroma=N_CHROMA)
+    chroma_basis.flags.writeable = False
+    return chroma_basis
+
+
+def chroma_stft(power_spectrogram, sample_rate):
+    """Computes librosa.feature.chroma_stft of one or a batch of power spectrograms.
+
+        librosa estimates a single tuning for a whole batch, so the tuning is estimated per signal here and
+        the signals sharing a tuning are projected with one chroma filterbank, built once per tuning.
+
+        :param power_spectrogram (ndarray): Power spectrogram(s) of shape (..., freqs, frames)
+        :param sample_rate (int): Sample rate of the signal
+        :return chroma (ndarray): Chromagram(s) of shape (..., N_CHROMA, frames)
+        """
+
+    n_fft = 2 * (power_spectrogram.shape[-2] - 1)
+    if power_spectrogram.ndim == 2:
+        tuning = librosa.estimate_tuning(S=power_spectrogram, sr=sample_rate, bins_per_octave=N_CHROMA)
+        raw_chroma = np.einsum("cf,...ft->...ct", _chroma_filterbank(sample_rate, n_fft, tuning), power_spectrogram, optimize=True)
+        return librosa.util.normalize(raw_chroma, norm=np.inf, axis=-2)
+
+    tunings = [librosa.estimate_tuning(S=S, sr=sample_rate, bins_per_octave=N_CHROMA) for S in power_spectrogram]
+    raw_chroma = np.empty(power_spectrogram.shape[:-2] + (N_CHROMA, power_spectrogram.shape[-1]), dtype=power_spectrogram.dtype)
+    for tuning in set(tunings):
+        indices = [i for i, t in enumerate(tunings) if t == tuning]
+        raw_chroma[indices] = np.einsum("cf,...ft->...ct", _chroma_filterbank(sample_rate, n_fft, tuning), power_spectrogram[indices], optimize=True)
+    return librosa.util.normalize(raw_chroma, norm=np.inf, axis=-2)
+
+
+def log_mel_spectrogram(power_spectrogram, sample_rate, n_mels=128):
+    """Computes the log-mel spectrogram librosa.feature.mfcc derives the coefficients from.
+
+        :param power_spectrogram (ndarray): Power spectrogram(s) of shape (..., freqs, frames)
+        :param sample_rate (int): Sample rate of the signal
+        :param n_mels (int): Number of mel bands
+        :return log_mel_spectrogram (ndarray): Log-mel spectrogram(s) in dB of shape (..., n_mels, frames)
+        """
+
+    # librosa.feature.melspectrogram, with the filterbank of the parameters built once
+    mel_basis = _mel_filterbank(sample_rate, 2 * (power_spectrogram.shape[-2] - 1), n_mels)
+    mel_spectrogram = np.einsum("...ft,mf->...mt", power_spectrogram, mel_basis, optimize=True)
+    # power_to_db clips to TOP_DB below the maximum of the whole array, so clip per signal
+    log_mel = librosa.power_to_db(mel_spectrogram, top_db=None)
+    return np.maximum(log_mel, log_mel.max(axis=(-2, -1), keepdims=True) - TOP_DB)
+
+
+def required_stfts(n_fft=2048, hop_length=512):
+    """Returns the keys of the STFTs extract_features needs, see its stfts parameter.
+
+        :return keys (list): (offset, n_fft, hop_length) of every distinct STFT
+        """
+
+    keys = [(0.0, n_fft, hop_length), (0.0, DEFAULT_N_FFT, DEFAULT_HOP_LENGTH), (0.0, DEFAULT_N_FFT, hop_length),
+            (SIGNAL_OFFSET, DEFAULT_N_FFT, DEFAULT_HOP_LENGTH)]
+    return sorted(set(keys), key=keys.index)
+
+
+def extract_features(signal, sample_rate, num_mfcc=13, n_fft=2048, hop_length=512, stfts=None):
+    """Extracts all the features of a segment from a single shared STFT.
+
+        Gives the same values as calling the individual librosa.feature functions on the signal.
+        A batch of equal-length signals of shape (batch, samples) is processed in one pass (librosa >= 0.9).
+
+        :param signal (ndarray): Audio time series of the segment, or stacked segments of shape (batch, samples)
+        :param sample_rate (int): Sample rate of the signal
+        :param num_mfcc (int): Number of coefficients to extract
+        :param n_fft (int): Interval we consider to apply FFT. Measured in # of samples
+        :param hop_length (int): Sliding window for FFT. Measured in # of samples
+        :param stfts (dict): Already computed STFTs of signal+offset keyed by (offset, n_fft, hop_length), see required_stfts
+        :return features (dict): Feature name -> ndarray of shape (..., frames, ...) for every name in FEATURE_NAMES
+        """
+
+    # one STFT per distinct (offset, n_fft, hop_length), shared by all the features that use it
+    stfts = dict(stfts or {})
+
+    def stft(stft_n_fft, stft_hop_length, offset=0.0):
+        key = (offset, stft_n_fft, stft_hop_length)
+        if key not in stfts:
+            stfts[key] = librosa.stft(signal + offset if offset else signal, n_fft=stft_n_fft, hop_length=stft_hop_length)
+        return stfts[key]
+
+    features = {}
+
+    # extract mfcc
+    power_spectrogram = np.abs(stft(n_fft, hop_length))**2
+    mfcc = librosa.feature.mfcc(S=log_mel_spectrogram(power_spectrogram, sample_rate), n_mfcc=num_mfcc)
+    features["mfcc"] = np.swapaxes(mfcc, -1, -2)
+
+    # extract spectral centeroid
+    spectrogram = np.abs(stft(DEFAULT_N_FFT, DEFAULT_HOP_LENGTH))
+    features["spectral_centroid"] = librosa.feature.spectral_centroid(S=spectrogram, sr=sample_rate)[..., 0, :]
+
+    # extract spectral rolloff and bandwidth from the spectrogram of signal+SIGNAL_OFFSET
+    # (its own STFT: p=3,4 bandwidths of quiet frames are too sensitive to rounding to derive it from the STFT above)
+    offset_spectrogram = np.abs(stft(DEFAULT_N_FFT, DEFAULT_HOP_LENGTH, SIGNAL_OFFSET))
+    features["spectral_rolloff"] = librosa.feature.spectral_rolloff(S=offset_spectrogram, sr=sample_rate)[..., 0, :]
+    for p, spectral_bandwidth in spectral_bandwidths(offset_spectrogram, sample_rate, (2, 3, 4)):
+        features["spectral_bandwidth_{}".format(p)] = spectral_bandwidth
+
+    # extract zero-crossing rate
+    features["zero_crossing_rate"] = librosa.feature.zero_crossing_rate(signal, pad=False)[..., 0, :]
+
+    # extract croma features
+    chroma_power_spectrogram = np.abs(stft(DEFAULT_N_FFT, hop_length))**2
+    features["chroma"] = np.swapaxes(chroma_stft(chroma_power_spectrogram, sample_rate), -1, -2)
+
+    return features
+
+
+def extract_spectrograms(signal, sample_rate, num_mfcc=13, n_fft=2048, hop_length=512, n_mels=128):
+    """Extracts the 2-D time-frequency features of a segment, for models that take them as images.
+
+        MFCCs and chroma are the ones of extract_features. The log-mel spectrogram is the one the MFCCs are
+        computed from, with n_mels bands. A batch of equal-length signals is processed in one pass.
+
+        :param signal (ndarray): Audio time series of the segment, or stacked segments of shape (batch, samples)
+        :param n_mels (int): Number of mel bands of the log-mel spectrogram
+        :return features (dict): "mfcc", "log_mel" and "chroma" -> ndarray of shape (..., frames, bins)
+        """
+
+    power_spectrogram = np.abs(librosa.stft(signal, n_fft=n_fft, hop_length=hop_length))**2
+    log_mel = log_mel_spectrogram(power_spectrogram, sample_rate, n_mels)
+    if n_mels == 128:
+        mfcc = librosa.feature.mfcc(S=log_mel, n_mfcc=num_mfcc)
+    else:
+        # the mfcc of extract_features use librosa's default 128 mel bands
+        mfcc = librosa.feature.mfcc(S=log_mel_spectrogram(power_spectrogram, sample_rate), n_mfcc=num_mfcc)
+    # chroma is computed with the default n_fft
+    chroma_power_spectrogram = power_spectrogram if n_fft == DEFAULT_N_FFT else np.abs(librosa.stft(signal, n_fft=DEFAULT_N_FFT, hop_length=hop_length))**2
+    return {
+        "mfcc": np.swapaxes(mfcc, -1, -2),
+        "log_mel": np.swapaxes(log_mel, -1, -2),
+        "chroma": np.swapaxes(chroma_stft(chroma_power_spectrogram, sample_rate), -1, -2),
+    }
+
+
+def pool_features(features):
+    """Summarizes every feature over time, so that the features of a segment have the same size whatever its duration.
+
+        :param features (dict): Features of one segment, or a batch of segments, as returned by extract_features
+        :return pooled (dict): Feature name -> ndarray of shape (..., len(POOLING_STATISTICS), ...), the frames axis
+            being replaced by the POOLING_STATISTICS in order
+        """
+
+    pooled = {}
+    for name in FEATURE_NAMES:
+        # in double precision, so that the statistics do not depend on the memory layout of the batch
+        feature = np.asarray(features[name], dtype=np.float64)
+        frames_axis = feature.ndim - FEATURE_NDIM[name]
+        delta = np.diff(feature, axis=frames_axis)
+        if delta.shape[frames_axis] == 0:
+            # a single frame has no differences
+            delta = np.zeros_like(np.take(feature, [0], axis=frames_axis))
+        pooled[name] = np.stack([
+            np.mean(feature, axis=frames_axis),
+            np.std(feature, axis=frames_axis),
+            np.min(feature, axis=frames_axis),
+            np.max(feature, axis=frames_axis),
+            np.mean(delta, axis=frames_axis),
+            np.std(delta, axis=frames_axis),
+        ], axis=frames_axis)
+    return pooled
+
+
+def features_to_row(features):
+    """Flattens the output of extract_features into a single feature vector.
+
+        :param features (dict): Feature name -> ndarray
+        :return row (ndarray): Features concatenated in FEATURE_NAMES order, frames first
+        """
+
+    return np.concatenate([np.ravel(features[name]) for name in FEATURE_NAMES])
+
+
+def features_to_matrix(features):
+    """Flattens the output of extract_features for a batch of signals into one feature vector per signal.
+
+        :param features (dict): Feature name -> ndarray of shape (batch, ...)
+        :return matrix (ndarray): Matrix of shape (batch, n_features), rows as returned by features_to_row
+        """
+
+    batch_size = len(features[FEATURE_NAMES[0]])
+    return np.concatenate([np.reshape(features[name], (batch_size, -1)) for name in FEATURE_NAMES], axis=1)
+
+
+def feature_layout(features):
+    """Returns the position of every feature within a row, as saved in the feature store metadata.
+
+        :param features (dict): Features of one segment as returned by extract_features
+        :return layout (list): [{"name", "offset", "shape"}] in row order
+        """
+
+    layout = []
+    offset = 0
+    for name in FEATURE_NAMES:
+        shape = list(np.shape(features[name]))
+        layout.append({"name": name, "offset": offset, "shape": shape})
+        offset += int(np.prod(shape))
+    return layout
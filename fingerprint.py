@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import librosa
+from audio_decode import read_audio
+from audio_preprocessing import list_dataset_files, bounded_map
+
+SAMPLE_RATE = 22050
+# long frames with a small hop, so that fingerprints of clips cut at any sample still share frames
+FINGERPRINT_N_FFT = 4096
+FINGERPRINT_HOP_LENGTH = 128
+# 33 mel bands give 32 bits per frame
+FINGERPRINT_BANDS = 33
+FINGERPRINT_FMIN = 300
+FINGERPRINT_FMAX = 5000
+# frames quieter than this many dB below the loudest frame are left out, their bits are noise
+FINGERPRINT_TOP_DB = 40
+# every INDEX_STEP-th frame of a clip is indexed, the queries use all their frames
+INDEX_STEP = 4
+# fingerprints shared by more frames than this (e.g. steady noise) are too common to tell clips apart
+MAX_POSTINGS = 64
+# minimum number of matching frames, and share of the frames of a clip, for a match
+MIN_VOTES = 5
+GROUP_SCORE = 0.1
+DUPLICATE_SCORE = 0.5
+GROUPS_FILE = "groups.json"
+
+
+def fingerprint(signal, sample_rate=SAMPLE_RATE):
+    """Computes the 32-bit sub-fingerprint of every frame of a signal.
+
+        Every bit is the sign of the change over time of the energy difference of two adjacent mel bands
+        (Haitsma and Kalker), so fingerprints are unaffected by gain and robust to noise and small shifts.
+
+        :param signal (ndarray): Audio time series
+        :param sample_rate (int): Sample rate of the signal
+        :return hashes (ndarray), frames (ndarray): uint32 fingerprints of the frames that are not silent, and their indices
+        """
+
+    if len(signal) < FINGERPRINT_N_FFT:
+        signal = librosa.util.fix_length(signal, size=FINGERPRINT_N_FFT)
+    power_spectrogram = np.abs(librosa.stft(signal, n_fft=FINGERPRINT_N_FFT, hop_length=FINGERPRINT_HOP_LENGTH))**2
+    energy = librosa.feature.melspectrogram(S=power_spectrogram, sr=sample_rate, n_mels=FINGERPRINT_BANDS,
+                                            fmin=FINGERPRINT_FMIN, fmax=min(FINGERPRINT_FMAX, sample_rate / 2))
+    band_difference = energy[:-1] - energy[1:]
+    bits = (band_difference[:, 1:] - band_difference[:, :-1]) > 0
+    hashes = np.bitwise_or.reduce(bits.T.astype(np.uint32) << np.arange(FINGERPRINT_BANDS - 1, dtype=np.uint32), axis=1)
+    frame_energy = energy.sum(axis=0)[1:]
+    loud = frame_energy > frame_energy.max() * 10 ** (-FINGERPRINT_TOP_DB / 10)
+    return hashes[loud], np.flatnonzero(loud).astype(np.int32)
+
+
+def fingerprint_file(file_path, sample_rate=SAMPLE_RATE):
+    """Fingerprints an audio file, see fingerprint. Runs in the worker processes.
+        """
+
+    signal, sample_rate = read_audio(file_path, sr=sample_rate)
+    return fingerprint(signal, sample_rate)
+
+
+class FingerprintIndex:
+    """Inverted index of the sub-fingerprints of many clips, for finding the clips a new clip overlaps.
+
+        A query looks up each of its fingerprints in sorted arrays and lets the matching frames vote for
+        (clip, time offset) pairs, so its cost depends on the number of matches, not on the number of clips.
+        Clips added since the last query are sorted into a new run at the next one, and runs are merged while a
+        run is not at least twice as long as the next, so there are O(log n) runs and every posting is merged
+        O(log n) times, however queries and additions alternate.
+        """
+
+    def __init__(self):
+        self.names = []
+        self._name_ids = {}
+        # sorted (hashes, clips, frames) runs, from the longest to the shortest
+        self._runs = []
+        self._pending = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._name_ids
+
+    def add(self, name, hashes, frames):
+        """Indexes a clip.
+
+            :param name (str): Name of the clip, e.g. its path relative to the dataset
+            :param hashes (ndarray), frames (ndarray): Fingerprints of the clip, as returned by fingerprint
+            """
+
+        if name in self._name_ids:
+            raise ValueError("{} is already indexed".format(name))
+        self._name_ids[name] = len(self.names)
+        self.names.append(name)
+        hashes, frames = hashes[::INDEX_STEP], frames[::INDEX_STEP]
+        self._pending.append((hashes, np.full(len(hashes), self._name_ids[name], dtype=np.int32), frames))
+
+    @staticmethod
+    def _sorted_run(runs):
+        # one run holding the postings of several, sorted by hash, the postings of equal hashes in the order of the runs
+        hashes, clips, frames = (np.concatenate(arrays) for arrays in zip(*runs))
+        order = np.argsort(hashes, kind="stable")
+        return hashes[order], clips[order], frames[order]
+
+    def _merge(self):
+        if not self._pending:
+            return
+        self._runs.append(self._sorted_run(self._pending))
+        self._pending = []
+        while len(self._runs) > 1 and len(self._runs[-2][0]) <= 2 * len(self._runs[-1][0]):
+            self._runs[-2:] = [self._sorted_run(self._runs[-2:])]
+
+    def _compact(self):
+        # a single run holding all the postings
+        self._merge()
+        if len(self._runs) > 1:
+            self._runs = [self._sorted_run(self._runs)]
+        if not self._runs:
+            self._runs = [(np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32))]
+        return self._runs[0]
+
+    def remove(self, names):
+        """Removes clips from the index.
+            """
+
+        hashes, clips, frames = self._compact()
+        ids = [self._name_ids[name] for name in names if name in self._name_ids]
+        if not ids:
+            return
+        keep = ~np.isin(clips, ids)
+        # renumber the remaining clips
+        removed = set(ids)
+        kept_names = [name for i, name in enumerate(self.names) if i not in removed]
+        new_ids = np.full(len(self.names), -1, dtype=np.int32)
+        new_ids[[self._name_ids[name] for name in kept_names]] = np.arange(len(kept_names), dtype=np.int32)
+        self._runs = [(hashes[keep], new_ids[clips[keep]], frames[keep])]
+        self.names = kept_names
+        self._name_ids = {name: i for i, name in enumerate(kept_names)}
+
+    def query(self, hashes, frames, min_score=GROUP_SCORE, min_votes=MIN_VOTES):
+        """Finds the indexed clips that share audio with a clip.
+
+            :param hashes (ndarray), frames (ndarray): Fingerprints of the clip, as returned by fingerprint
+            :param min_score (float): Minimum share of the frames of the clip found in an indexed clip
+            :param min_votes (int): Minimum number of matching frames
+            :return matches (list): (name, score, offset in seconds of the clip within the indexed one), best first
+            """
+
+        self._merge()
+        if not len(hashes) or not self._runs:
+            return []
+        counts = np.zeros(len(hashes), dtype=np.int64)
+        bounds = []
+        for run_hashes, _, _ in self._runs:
+            starts = np.searchsorted(run_hashes, hashes, side="left")
+            ends = np.searchsorted(run_hashes, hashes, side="right")
+            counts += ends - starts
+            bounds.append((starts, ends - starts))
+        usable = (counts > 0) & (counts <= MAX_POSTINGS)
+        if not usable.any():
+            return []
+        matched_clips, offsets = [], []
+        for (_, run_clips, run_frames), (starts, run_counts) in zip(self._runs, bounds):
+            starts, run_counts, query_frames = starts[usable], run_counts[usable], frames[usable]
+            # positions of all the matching postings, without a python loop over the frames
+            repeats = np.repeat(np.arange(len(starts)), run_counts)
+            positions = starts[repeats] + np.arange(len(repeats)) - np.repeat(np.cumsum(run_counts) - run_counts, run_counts)
+            matched_clips.append(run_clips[positions].astype(np.int64))
+            # clips cut at any sample match with an offset off by one frame
+            offsets.append((run_frames[positions].astype(np.int64) - query_frames[repeats]) // 2)
+        keys, votes = np.unique(np.concatenate(matched_clips) << 32 | (np.concatenate(offsets) + (1 << 31)), return_counts=True)
+
+        best = {}
+        for key, count in zip(keys.tolist(), votes.tolist()):
+            clip = key >> 32
+            if count > best.get(clip, (0, 0))[0]:
+                best[clip] = (count, (key & 0xFFFFFFFF) - (1 << 31))
+        matches = []
+        for clip, (count, offset) in best.items():
+            # only every INDEX_STEP-th indexed frame can match
+            score = min(1.0, count * INDEX_STEP / len(hashes))
+            if count >= min_votes and score >= min_score:
+                matches.append((self.names[clip], score, offset * 2 * FINGERPRINT_HOP_LENGTH / SAMPLE_RATE))
+        return sorted(matches, key=lambda match: -match[1])
+
+    def save(self, path):
+        """Saves the index to an .npz file, written next to it and moved in place.
+            """
+
+        hashes, clips, frames = self._compact()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fp:
+            np.savez(fp, hashes=hashes, clips=clips, frames=frames, names=np.array(self.names, dtype=str))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        with np.load(path) as data:
+            index._runs = [(data["hashes"], data["clips"], data["frames"])]
+            index.names = [str(name) for name in data["names"]]
+        index._name_ids = {name: i for i, name in enumerate(index.names)}
+        return index
+
+
+class DuplicateGroups:
+    """Groups clips that share audio, or come from the same source, with union-find.
+
+        Clips of one group should land on the same side of a train/test split (e.g. GroupShuffleSplit).
+        """
+
+    def __init__(self):
+        self._parents = {}
+
+    def add(self, name):
+        self._parents.setdefault(name, name)
+
+    def find(self, name):
+        self.add(name)
+        root = name
+        while self._parents[root] != root:
+            root = self._parents[root]
+        while self._parents[name] != root:
+            self._parents[name], name = root, self._parents[name]
+        return root
+
+    def union(self, name, other):
+        root, other_root = self.find(name), self.find(other)
+        if root != other_root:
+            # the smallest name is the root, so group ids do not depend on the processing order
+            root, other_root = sorted((root, other_root))
+            self._parents[other_root] = root
+
+    def group_ids(self):
+        """Returns the group id of every clip, groups being numbered in the order of their smallest clip name.
+            """
+
+        roots = {name: self.find(name) for name in sorted(self._parents)}
+        numbers = {}
+        for root in roots.values():
+            numbers.setdefault(root, len(numbers))
+        return {name: numbers[root] for name, root in roots.items()}
+
+
+def deduplicate(index, groups, name, hashes, frames, duplicate_score=DUPLICATE_SCORE, group_score=GROUP_SCORE):
+    """Looks a new clip up in the index, groups it with the clips it overlaps and indexes it unless it is a duplicate.
+
+        :param index (FingerprintIndex): Index of the clips kept so far
+        :param groups (DuplicateGroups): Groups of the clips
+        :param name (str): Name of the clip
+        :param hashes (ndarray), frames (ndarray): Fingerprints of the clip
+        :param duplicate_score (float): Share of the frames found in a kept clip for the clip to be a duplicate of it
+        :param group_score (float): Share of the frames found in a kept clip for both to be in the same group
+        :return duplicate_of (str): Name of the clip it duplicates, None if it is kept
+        """
+
+    groups.add(name)
+    matches = index.query(hashes, frames, min_score=group_score)
+    for other, score, _ in matches:
+        groups.union(name, other)
+    if matches and matches[0][1] >= duplicate_score:
+        return matches[0][0]
+    index.add(name, hashes, frames)
+    return None
+
+
+def save_groups(path, group_ids, duplicates):
+    """Saves the group id of every clip and the duplicates found as JSON.
+        """
+
+    with open(path + ".tmp", "w") as fp:
+        json.dump({"groups": group_ids, "duplicates": duplicates}, fp, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def load_groups(path):
+    """Returns the group ids and the duplicates saved by save_groups.
+        """
+
+    with open(path, "r") as fp:
+        data = json.load(fp)
+    return data["groups"], data["duplicates"]
+
+
+def file_groups(files, dataset_path, groups_path=None):
+    """Returns the group id of every file, in order, e.g. for the rows of a feature store built from them.
+
+        :param files (list): [(label index, file path)] as returned by list_dataset_files
+        :param dataset_path (str): Dataset the file paths are relative to in the groups file
+        :param groups_path (str): Groups file, groups.json of the dataset by default
+        :return groups (ndarray): Group ids, files missing from the groups file get groups of their own
+        """
+
+    group_ids, _ = load_groups(groups_path or os.path.join(dataset_path, GROUPS_FILE))
+    next_group = max(group_ids.values(), default=-1) + 1
+    groups = []
+    for _, file_path in files:
+        name = os.path.relpath(file_path, dataset_path)
+        if name not in group_ids:
+            group_ids[name] = next_group
+            next_group += 1
+        groups.append(group_ids[name])
+    return np.array(groups)
+
+
+def find_duplicates(dataset_path, workers=1, duplicate_score=DUPLICATE_SCORE, group_score=GROUP_SCORE, drop=False):
+    """Fingerprints every clip of a dataset, groups the clips that share audio and finds the duplicates.
+
+        :param dataset_path (str): Path to a dataset (one sub-folder per label)
+        :param workers (int): Number of worker processes used to fingerprint
+        :param drop (bool): Delete the duplicates
+        :return group_ids (dict), duplicates (dict): Clip -> group id, duplicate clip -> clip it duplicates,
+            clips named by their path relative to dataset_path
+        """
+
+    _, files = list_dataset_files([dataset_path])
+    names = [os.path.relpath(file_path, dataset_path) for _, file_path in files]
+    file_paths = [file_path for _, file_path in files]
+    if workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            fingerprints = list(bounded_map(executor, fingerprint_file, file_paths, workers * 4))
+    else:
+        fingerprints = map(fingerprint_file, file_paths)
+
+    index = FingerprintIndex()
+    groups = DuplicateGroups()
+    duplicates = {}
+    for name, file_path, (hashes, frames) in zip(names, file_paths, fingerprints):
+        duplicate_of = deduplicate(index, groups, name, hashes, frames, duplicate_score, group_score)
+        if duplicate_of:
+            duplicates[name] = duplicate_of
+            if drop:
+                os.remove(file_path)
+    group_ids = groups.group_ids()
+    if drop:
+        group_ids = {name: group for name, group in group_ids.items() if name not in duplicates}
+    return group_ids, duplicates
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Finds the duplicate and overlapping clips of a dataset and groups them for source-aware splits.")
+    parser.add_argument("dataset", help="dataset directory (e.g. clean_detection_dataset)")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to fingerprint")
+    parser.add_argument("--duplicate-score", type=float, default=DUPLICATE_SCORE, help="share of frames found in another clip to be its duplicate")
+    parser.add_argument("--group-score", type=float, default=GROUP_SCORE, help="share of frames found in another clip to share its group")
+    parser.add_argument("--drop", action="store_true", help="delete the duplicates")
+    parser.add_argument("--output", help="groups file, groups.json in the dataset by default")
+    args = parser.parse_args()
+
+    group_ids, duplicates = find_duplicates(args.dataset, args.workers, args.duplicate_score, args.group_score, args.drop)
+    save_groups(args.output or os.path.join(args.dataset, GROUPS_FILE), group_ids, duplicates)
+    print("{} clips in {} groups, {} duplicates{}".format(len(group_ids), len(set(group_ids.values())), len(duplicates), " dropped" if args.drop else ""))
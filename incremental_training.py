@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from sklearn.linear_model import Perceptron, SGDClassifier
+from sklearn.naive_bayes import GaussianNB
+from sklearn.neural_network import MLPClassifier
+from sklearn.preprocessing import StandardScaler
+from feature_store import load_feature_store
+from model_artifact import FeatureSpecError, feature_spec, save_model_artifact
+
+# rows read from a shard at a time, shuffling permutes the blocks and then the rows of a few blocks
+BLOCK_SIZE = 1024
+# blocks whose rows are shuffled together, the memory used is about SHUFFLE_BLOCKS * BLOCK_SIZE rows per prefetched buffer
+SHUFFLE_BLOCKS = 16
+# estimators with partial_fit, the MLP being the one of CLASSIFICATION_CANDIDATES
+INCREMENTAL_MODELS = {
+    "sgd": lambda seed: SGDClassifier(loss="log_loss", alpha=1e-4, random_state=seed),
+    "perceptron": lambda seed: Perceptron(random_state=seed),
+    "mlp": lambda seed: MLPClassifier(random_state=seed),
+    "gnb": lambda seed: GaussianNB(),
+}
+
+
+class FeatureShard:
+    """Memory-mapped feature store read in blocks, see feature_store.
+
+        With label, every row of the shard gets that label, e.g. the rows of the classification store, which
+        are all coughs, merged into the detection training set as model_training.ipynb does.
+        """
+
+    def __init__(self, store_path, label=None):
+        """
+            :param store_path (str): Path to the feature store
+            :param label (int): Label index given to every row, None for the labels of the store
+            """
+
+        self.store_path = store_path
+        self.features, self.labels, self.metadata = load_feature_store(store_path)
+        self.label = label
+
+    def __len__(self):
+        return len(self.labels)
+
+    def read(self, start, stop):
+        """Returns the rows [start, stop) as a float32 array and their int64 labels, read from disk.
+            """
+
+        features = np.array(self.features[start:stop])
+        if self.label is None:
+            labels = np.array(self.labels[start:stop], dtype=np.int64)
+        else:
+            labels = np.full(len(features), self.label, dtype=np.int64)
+        return features, labels
+
+
+class ShardedFeatures:
+    """Training set spread over several feature stores, streamed in shuffled mini-batches with bounded memory.
+
+        Only a held-out mask of one byte per row is kept in memory. Blocks of rows are read from the shards by a
+        pool of threads, one per shard, so that reading scales with the number of shards, and shuffled together
+        in a buffer of shuffle_blocks blocks.
+        """
+
+    def __init__(self, shards, block_size=BLOCK_SIZE, test_size=0.0, seed=None):
+        """
+            :param shards (list): FeatureShard of every store, their rows having the same features
+            :param block_size (int): Number of rows read at a time
+            :param test_size (float): Share of the rows of every shard held out for testing
+            :param seed (int): Seed of the held-out rows
+            """
+
+        spec = {key: value for key, value in feature_spec(shards[0].metadata).items() if key != "label_map"}
+        for shard in shards[1:]:
+            other = {key: value for key, value in feature_spec(shard.metadata).items() if key != "label_map"}
+            if shard.features.shape[1:] != shards[0].features.shape[1:] or other != spec:
+                raise FeatureSpecError("{} was extracted with {}, {} with {}".format(shard.store_path, other, shards[0].store_path, spec))
+        self.shards = shards
+        self.block_size = block_size
+        random_state = np.random.RandomState(seed)
+        self.test_masks = [random_state.random_sample(len(shard)) < test_size for shard in shards]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def num_features(self):
+        return int(np.prod(self.shards[0].features.shape[1:]))
+
+    def classes(self):
+        """Returns the sorted label indices of all the rows, read block by block.
+            """
+
+        classes = set()
+        for shard in self.shards:
+            if shard.label is not None:
+                classes.add(shard.label)
+                continue
+            for start in range(0, len(shard), self.block_size):
+                classes.update(np.unique(shard.labels[start:start + self.block_size]).tolist())
+        return np.array(sorted(classes))
+
+    def _read_block(self, block, subset):
+        shard_index, start, stop = block
+        features, labels = self.shards[shard_index].read(start, stop)
+        if subset is not None:
+            keep = self.test_masks[shard_index][start:stop] == (subset == "test")
+            features, labels = features[keep], labels[keep]
+        return features, labels
+
+    def batches(self, batch_size=256, shuffle=True, subset="train", seed=None, shuffle_blocks=SHUFFLE_BLOCKS, prefetch=2):
+        """Yields mini-batches of (features, labels), read in background threads while the previous ones are used.
+
+            :param batch_size (int): Number of rows in a batch
+            :param shuffle (bool): Shuffle the blocks, and the rows of every shuffle_blocks blocks
+            :param subset (str): "train" or "test" rows, None for all
+            :param seed (int): Seed of the shuffling, vary it between epochs
+            :param shuffle_blocks (int): Number of blocks shuffled together
+            :param prefetch (int): Number of buffers read ahead
+            :return: Iterator of (float32 array of shape (batch, features), int64 labels)
+            """
+
+        blocks = [(shard_index, start, min(start + self.block_size, len(shard)))
+                  for shard_index, shard in enumerate(self.shards) for start in range(0, len(shard), self.block_size)]
+        random_state = np.random.RandomState(seed)
+        if shuffle:
+            blocks = [blocks[i] for i in random_state.permutation(len(blocks))]
+        groups = [blocks[i:i + shuffle_blocks] for i in range(0, len(blocks), shuffle_blocks)]
+
+        ready = queue.Queue(maxsize=max(1, prefetch))
+        done = object()
+        stopped = threading.Event()
+
+        def read():
+            try:
+                with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+                    for group in groups:
+                        if stopped.is_set():
+                            return
+                        features, labels = zip(*executor.map(lambda block: self._read_block(block, subset), group))
+                        ready.put((np.concatenate(features), np.concatenate(labels)))
+            except Exception as e:
+                ready.put(e)
+                return
+            ready.put(done)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        try:
+            # rows left over from the previous buffer, so that every batch but the last one is full
+            features, labels = np.empty((0,) + self.shards[0].features.shape[1:], dtype=np.float32), np.empty(0, dtype=np.int64)
+            while True:
+                item = ready.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                buffer_features, buffer_labels = item
+                if shuffle:
+                    order = random_state.permutation(len(buffer_labels))
+                    buffer_features, buffer_labels = buffer_features[order], buffer_labels[order]
+                features, labels = np.concatenate([features, buffer_features]), np.concatenate([labels, buffer_labels])
+                stop = len(labels) - len(labels) % batch_size
+                for start in range(0, stop, batch_size):
+                    yield features[start:start + batch_size], labels[start:start + batch_size]
+                features, labels = features[stop:], labels[stop:]
+            if len(labels):
+                yield features, labels
+        finally:
+            # the consumer may stop early, unblock the reader so it can exit
+            stopped.set()
+            while reader.is_alive():
+                try:
+                    ready.get_nowait()
+                except queue.Empty:
+                    reader.join(0.01)
+
+
+def fit_scaler(data, batch_size=4096, subset="train"):
+    """Fits a StandardScaler on the rows of a sharded training set with partial_fit, one batch in memory at a time.
+        """
+
+    scaler = StandardScaler()
+    for features, _ in data.batches(batch_size, shuffle=False, subset=subset):
+        scaler.partial_fit(features)
+    return scaler
+
+
+def evaluate(model, scaler, data, batch_size=4096, subset="test"):
+    """Returns the accuracy of a model on the rows of a sharded data set, None if there are none.
+        """
+
+    correct = total = 0
+    for features, labels in data.batches(batch_size, shuffle=False, subset=subset):
+        correct += int(np.sum(model.predict(scaler.transform(features)) == labels))
+        total += len(labels)
+    return correct / total if total else None
+
+
+def train_incremental(data, model, epochs=5, batch_size=256, seed=22, verbose=1):
+    """Trains a model with partial_fit on shuffled mini-batches streamed from the shards.
+
+        A first pass fits the scaler, then every epoch streams the training rows in a new order. The memory used
+        depends on the batch and buffer sizes, not on the number of rows.
+
+        :param data (ShardedFeatures): Training set, with its held-out rows
+        :param model: Estimator with partial_fit, e.g. one of INCREMENTAL_MODELS
+        :param epochs (int): Number of passes over the training rows
+        :param batch_size (int): Number of rows of every partial_fit
+        :param seed (int): Seed of the shuffling of the first epoch, the next ones use the following seeds
+        :param verbose (int): Print every epoch if > 0
+        :return model, scaler (StandardScaler), metrics (dict): Fitted model and scaler, rows per second of every
+            epoch and accuracy on the held-out rows
+        """
+
+    classes = data.classes()
+    started = time.perf_counter()
+    scaler = fit_scaler(data)
+    metrics = {"scaler_seconds": time.perf_counter() - started, "epochs": []}
+    for epoch in range(epochs):
+        started = time.perf_counter()
+        rows = 0
+        for features, labels in data.batches(batch_size, shuffle=True, seed=seed + epoch):
+            model.partial_fit(scaler.transform(features), labels, classes=classes)
+            rows += len(labels)
+        seconds = time.perf_counter() - started
+        metrics["epochs"].append({"rows": rows, "seconds": seconds, "rows_per_second": rows / seconds if seconds else 0.0})
+        if verbose:
+            print("Epoch {}/{}: {} rows in {:.1f}s ({:.0f} rows/s)".format(epoch + 1, epochs, rows, seconds, rows / seconds if seconds else 0.0))
+    metrics["test_accuracy"] = evaluate(model, scaler, data)
+    return model, scaler, metrics
+
+
+def parse_shard(spec, label_map):
+    """Returns the FeatureShard of "store_path" or "store_path:label", label being a name of label_map.
+        """
+
+    store_path, _, label = spec.partition(":")
+    return FeatureShard(store_path, label_map[label] if label else None)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Trains a model on feature stores larger than memory, streaming shuffled mini-batches to partial_fit.")
+    parser.add_argument("shards", nargs="+", help="feature stores, as store_path or store_path:label to give all its rows a label of the first store "
+                                                  "(e.g. detection_data classification_data:cough)")
+    parser.add_argument("--model", choices=sorted(INCREMENTAL_MODELS), default="sgd", help="estimator trained with partial_fit")
+    parser.add_argument("--epochs", type=int, default=5, help="number of passes over the training rows")
+    parser.add_argument("--batch-size", type=int, default=256, help="number of rows of every partial_fit")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE, help="number of rows read from a shard at a time")
+    parser.add_argument("--test-size", type=float, default=0.3, help="share of the rows held out for testing")
+    parser.add_argument("--seed", type=int, default=22, help="seed of the held-out rows and of the shuffling")
+    parser.add_argument("--artifact", help="model artifact directory to save the model to (see model_artifact)")
+    parser.add_argument("--augment", action="store_true", help="take clean dataset directories instead of feature stores, and train on "
+                                                               "augmented variants of their clips featurized at every epoch (see augmentation)")
+    parser.add_argument("--feature-mode", choices=["frames", "pooled"], default="frames", help="features of the clips with --augment")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes featurizing the clips with --augment")
+    args = parser.parse_args()
+
+    if args.augment:
+        from augmentation import Augmenter, AugmentedClips
+        data = AugmentedClips(args.shards, Augmenter(), feature_mode=args.feature_mode, test_size=args.test_size, seed=args.seed, workers=args.workers)
+        metadata = data.metadata
+        print("{} clips of {} features, augmented at every epoch".format(len(data), data.num_features))
+    else:
+        first_shard = FeatureShard(args.shards[0].partition(":")[0])
+        shards = [parse_shard(spec, first_shard.metadata["label_map"]) for spec in args.shards]
+        data = ShardedFeatures(shards, args.block_size, args.test_size, args.seed)
+        metadata = first_shard.metadata
+        print("{} rows of {} features in {} shards".format(len(data), data.num_features, len(shards)))
+    model, scaler, metrics = train_incremental(data, INCREMENTAL_MODELS[args.model](args.seed), args.epochs, args.batch_size, args.seed)
+    print(json.dumps(metrics))
+    if args.artifact:
+        # the models predict label indices, there is no label encoder
+        save_model_artifact(args.artifact, model, scaler, None, metadata, metrics={"test_accuracy": metrics["test_accuracy"]})
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+# "off" records nothing, "summary" the counters and stage timers, "files" also the metrics of every file,
+# "profile" also samples the stack of the main thread
+LEVELS = ["off", "summary", "files", "profile"]
+PROFILE_INTERVAL = 0.005
+
+
+class _NullTimer:
+    """Context manager that does nothing, shared by all the timers of a disabled Instrumentation.
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+
+    def __init__(self, instrumentation, stage):
+        self.instrumentation = instrumentation
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.add_time(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class SamplingProfiler:
+    """Samples the stack of a thread at a fixed interval from a background thread.
+
+        Only the innermost frame of every sample is counted, so the summary tells where the thread spends its time
+        (including inside the library calls) at the cost of a stack lookup every interval, whatever the workload.
+        """
+
+    def __init__(self, interval=PROFILE_INTERVAL, thread_id=None):
+        """
+            :param interval (float): Seconds between two samples
+            :param thread_id (int): Thread to sample, the thread calling start by default
+            """
+
+        self.interval = interval
+        self.thread_id = thread_id
+        self.samples = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples["{}:{} {}".format(os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name)] += 1
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def summary(self, top=20):
+        """Returns the most sampled locations with their share of the samples.
+            """
+
+        total = sum(self.samples.values())
+        return [{"location": location, "samples": count, "share": count / total} for location, count in self.samples.most_common(top)]
+
+
+class Instrumentation:
+    """Counters, stage timers and per-file metrics of a preprocessing run, summarized as JSON at its end.
+
+        Timers are context managers (with instrumentation.timer("write"): ...). At level "off" they are a shared
+        no-op and nothing is recorded, so instrumented loops cost about nothing when it is disabled. Work done in
+        worker processes is timed there and reported with record_file.
+        """
+
+    def __init__(self, level="summary", profiler=None):
+        """
+            :param level (str): One of LEVELS
+            :param profiler (SamplingProfiler): Profiler run between start and stop, a default one at level "profile"
+            """
+
+        if level not in LEVELS:
+            raise ValueError("unknown instrumentation level {!r}, expected one of {}".format(level, LEVELS))
+        self.level = level
+        self.enabled = level != "off"
+        self.record_files = LEVELS.index(level) >= LEVELS.index("files")
+        if profiler is None and level == "profile":
+            profiler = SamplingProfiler()
+        self.profiler = profiler
+        self.counters = collections.Counter()
+        # stage -> [calls, total seconds, max seconds]
+        self.stages = {}
+        self.files = []
+        self.started = None
+        self.wall_seconds = 0.0
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.start()
+        return self
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.started is not None:
+            self.wall_seconds += time.perf_counter() - self.started
+            self.started = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def timer(self, stage):
+        """Returns a context manager adding the time spent in its block to a stage.
+            """
+
+        return _Timer(self, stage) if self.enabled else _NULL_TIMER
+
+    def add_time(self, stage, seconds, calls=1):
+        if not self.enabled:
+            return
+        entry = self.stages.setdefault(stage, [0, 0.0, 0.0])
+        entry[0] += calls
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds / calls if calls else 0.0)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def record_file(self, file_path, metrics):
+        """Records the metrics of a file measured in a worker process.
+
+            Every "<stage>_seconds" metric is added to the timer of the stage, every other numeric metric to a counter.
+
+            :param file_path (str): Path to the file
+            :param metrics (dict): Metrics of the file (e.g. decode_seconds, audio_seconds, segments)
+            """
+
+        if not self.enabled:
+            return
+        self.counters["files"] += 1
+        for name, value in metrics.items():
+            if name.endswith("_seconds") and name != "audio_seconds":
+                self.add_time(name[:-len("_seconds")], value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.counters[name] += value
+            elif value is True:
+                self.counters[name] += 1
+        if self.record_files:
+            self.files.append(dict(metrics, path=file_path))
+
+    def summary(self):
+        """Returns the recorded metrics as a JSON-serializable dict.
+            """
+
+        wall_seconds = self.wall_seconds + (time.perf_counter() - self.started if self.started is not None else 0.0)
+        summary = {
+            "level": self.level,
+            "wall_seconds": wall_seconds,
+            "counters": dict(self.counters),
+            "stages": {stage: {"calls": calls, "seconds": seconds, "mean_ms": 1000 * seconds / calls if calls else 0.0, "max_ms": 1000 * max_seconds}
+                       for stage, (calls, seconds, max_seconds) in self.stages.items()},
+        }
+        if self.counters.get("audio_seconds") and wall_seconds:
+            summary["audio_seconds_per_second"] = self.counters["audio_seconds"] / wall_seconds
+        if self.record_files:
+            summary["files"] = self.files
+        if self.profiler is not None:
+            summary["profile"] = self.profiler.summary()
+        return summary
+
+    def write(self, fp):
+        """Writes the summary as JSON to an open file.
+            """
+
+        json.dump(self.summary(), fp, indent=1)
+        fp.write("\n")
+
+
+# shared by the functions called without instrumentation
+NULL_INSTRUMENTATION = Instrumentation("off")
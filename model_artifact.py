@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import os
+import pickle
+import shutil
+import numpy as np
+
+# bump when the layout of the artifact directory changes
+ARTIFACT_FORMAT_VERSION = 1
+ARTIFACT_FILE = "artifact.json"
+PREPROCESSING_FILE = "preprocessing.npz"
+MODEL_FILE = "model.pkl"
+# extraction parameters features must have been produced with, as saved in the feature store metadata
+FEATURE_SPEC_KEYS = ["sample_rate", "num_mfcc", "n_fft", "hop_length", "num_segments", "feature_mode", "layout", "num_features"]
+
+
+class FeatureSpecError(ValueError):
+    """Raised when features do not match the extraction parameters a model was trained with."""
+
+
+def feature_spec(metadata):
+    """Returns the extraction parameters of a feature store, from its metadata.json.
+        """
+
+    return {key: metadata[key] for key in FEATURE_SPEC_KEYS if key in metadata}
+
+
+def save_model_artifact(artifact_path, model, scaler, encoder, metadata, version=None, metrics=None):
+    """Saves a fitted model with its preprocessing, label map and feature extraction parameters.
+
+        The artifact is a directory holding artifact.json (versions, label map, feature spec), preprocessing.npz
+        (scaler statistics and encoder classes) and model.pkl. It is written next to artifact_path and moved in
+        place, so a reader never sees a partial artifact.
+
+        :param artifact_path (str): Path to the artifact directory
+        :param model: Fitted estimator, trained on scaled features and encoded labels
+        :param scaler (StandardScaler): Fitted scaler, None if the model takes raw features
+        :param encoder (LabelEncoder): Fitted label encoder, None if the model predicts label indices
+        :param metadata (dict): Metadata of the feature store the model was trained on
+        :param version (str): Version of the model, the UTC creation time by default
+        :param metrics (dict): Evaluation results saved along (e.g. test accuracy)
+        """
+
+    created = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    num_features = metadata.get("num_features")
+    if num_features is None and scaler is not None:
+        num_features = int(scaler.n_features_in_)
+    manifest = {
+        "format_version": ARTIFACT_FORMAT_VERSION,
+        "version": version or created,
+        "created": created,
+        "model_class": "{}.{}".format(type(model).__module__, type(model).__name__),
+        "label_map": metadata["label_map"],
+        "feature_spec": dict(feature_spec(metadata), num_features=num_features),
+        "metrics": metrics or {},
+    }
+    preprocessing = {}
+    if scaler is not None:
+        preprocessing["mean"] = scaler.mean_ if scaler.mean_ is not None else np.zeros(num_features)
+        preprocessing["scale"] = scaler.scale_ if scaler.scale_ is not None else np.ones(num_features)
+    if encoder is not None:
+        preprocessing["classes"] = encoder.classes_
+
+    tmp_path = artifact_path.rstrip(os.sep) + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    with open(os.path.join(tmp_path, ARTIFACT_FILE), "w") as fp:
+        json.dump(manifest, fp, indent=1)
+    np.savez(os.path.join(tmp_path, PREPROCESSING_FILE), **preprocessing)
+    with open(os.path.join(tmp_path, MODEL_FILE), "wb") as fp:
+        pickle.dump(model, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    if os.path.exists(artifact_path):
+        shutil.rmtree(artifact_path)
+    os.replace(tmp_path, artifact_path)
+
+
+class ModelArtifact:
+    """A model artifact saved by save_model_artifact.
+
+        The manifest and preprocessing arrays are read when opened, the model is only unpickled when first used.
+        Scoring refuses features of another size or, when their spec is given, produced with other parameters.
+        """
+
+    def __init__(self, artifact_path):
+        """
+            :param artifact_path (str): Path to the artifact directory
+            """
+
+        self.artifact_path = artifact_path
+        with open(os.path.join(artifact_path, ARTIFACT_FILE), "r") as fp:
+            self.manifest = json.load(fp)
+        if self.manifest["format_version"] > ARTIFACT_FORMAT_VERSION:
+            raise ValueError("{} has artifact format version {}, this code reads up to {}".format(
+                artifact_path, self.manifest["format_version"], ARTIFACT_FORMAT_VERSION))
+        with np.load(os.path.join(artifact_path, PREPROCESSING_FILE)) as preprocessing:
+            self.mean = preprocessing["mean"] if "mean" in preprocessing.files else None
+            self.scale = preprocessing["scale"] if "scale" in preprocessing.files else None
+            self.classes = preprocessing["classes"] if "classes" in preprocessing.files else None
+        self.label_map = self.manifest["label_map"]
+        self.feature_spec = self.manifest["feature_spec"]
+        self._model = None
+
+    @property
+    def version(self):
+        return self.manifest["version"]
+
+    @property
+    def model(self):
+        if self._model is None:
+            with open(os.path.join(self.artifact_path, MODEL_FILE), "rb") as fp:
+                self._model = pickle.load(fp)
+        return self._model
+
+    def check_features(self, features, spec=None):
+        """Raises FeatureSpecError if features cannot be scored by the model.
+
+            :param features (ndarray): Feature rows of shape (n, n_features)
+            :param spec (dict): Extraction parameters of the features (see feature_spec), only the size is checked if None
+            """
+
+        num_features = self.feature_spec.get("num_features")
+        if num_features is not None and np.shape(features)[-1] != num_features:
+            raise FeatureSpecError("{} expects {} features, got {}".format(self.artifact_path, num_features, np.shape(features)[-1]))
+        if spec is not None:
+            mismatched = sorted(key for key in FEATURE_SPEC_KEYS if key in spec and key in self.feature_spec and spec[key] != self.feature_spec[key])
+            if mismatched:
+                raise FeatureSpecError("{} was trained on features with other {}".format(self.artifact_path, ", ".join(mismatched)))
+
+    def transform(self, features):
+        """Scales feature rows like the scaler the model was trained with.
+            """
+
+        features = np.asarray(features, dtype=np.float64)
+        if self.mean is None:
+            return features
+        return (features - self.mean) / self.scale
+
+    def _decode(self, encoded):
+        return self.classes[encoded] if self.classes is not None else encoded
+
+    def predict(self, features, spec=None):
+        """Predicts the label index (as in label_map) of feature rows.
+
+            :param features (ndarray): Feature rows of shape (n, n_features)
+            :param spec (dict): Extraction parameters of the features (see feature_spec), checked against the model's
+            :return labels (ndarray): Label indices
+            """
+
+        self.check_features(features, spec)
+        return self._decode(self.model.predict(self.transform(features)))
+
+    def predict_proba(self, features, spec=None):
+        """Returns the probability of every label, columns in the order of the model's classes.
+
+            Raises AttributeError if the model does not predict probabilities.
+            """
+
+        self.check_features(features, spec)
+        return self.model.predict_proba(self.transform(features))
+
+
+def load_model_artifact(artifact_path):
+    """Opens a model artifact, see ModelArtifact.
+        """
+
+    return ModelArtifact(artifact_path)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import csv
+import json
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import ParameterGrid, StratifiedKFold
+from sklearn.naive_bayes import GaussianNB
+from sklearn.neighbors import KNeighborsClassifier
+from sklearn.neural_network import MLPClassifier
+from sklearn.svm import SVC, LinearSVC
+
+# estimator families and parameter grids of best_model in model_training.ipynb
+# ('auto' max_features is gone from scikit-learn, it meant 'sqrt' for classifiers)
+DETECTION_CANDIDATES = {
+    "rfc": (RandomForestClassifier(random_state=22), {
+        "n_estimators": [200, 400],
+        "max_features": ["sqrt", "log2"],
+        "max_depth": [4, 5, 6, 7, 8],
+        "criterion": ["gini", "entropy"],
+    }),
+    "lr": (LogisticRegression(), {
+        "C": [0.01, 0.1],
+        "max_iter": [500, 700],
+        "solver": ["sag", "saga", "lbfgs", "liblinear"],
+        "penalty": ["l2", "l1"],
+    }),
+    "svm": (SVC(), {
+        "C": [0.01, 0.1],
+        "kernel": ["linear", "poly", "rbf"],
+        "gamma": ["scale", "auto"],
+    }),
+    "knn": (KNeighborsClassifier(), {
+        "n_neighbors": [5, 7, 10, 13, 16],
+        "weights": ["uniform", "distance"],
+        "algorithm": ["ball_tree", "kd_tree"],
+    }),
+    "gnb": (GaussianNB(), {}),
+}
+# estimator families and parameter grids of find_best_model in model_training.ipynb
+CLASSIFICATION_CANDIDATES = {
+    "rfc": (RandomForestClassifier(), {
+        "n_estimators": [300, 500],
+        "max_depth": [5, 7, 9],
+        "max_features": ["sqrt", "log2"],
+        "criterion": ["gini", "entropy"],
+    }),
+    "knn": (KNeighborsClassifier(), {
+        "n_neighbors": [5, 7],
+        "weights": ["uniform", "distance"],
+        "algorithm": ["auto", "ball_tree", "kd_tree"],
+        "leaf_size": [30, 50],
+    }),
+    "lsvc": (LinearSVC(dual=True), {
+        "penalty": ["l1", "l2"],
+        "C": [0.01, 0.1],
+        "loss": ["hinge", "squared_hinge"],
+    }),
+    "mlp": (MLPClassifier(), {
+        "activation": ["tanh", "relu"],
+        "learning_rate": ["constant", "invscaling", "adaptive"],
+    }),
+}
+REPORT_FIELDS = ["family", "params", "status", "rounds", "n_resources", "mean_score", "std_score", "fit_time", "score_time", "error"]
+
+# training data of the worker processes, sent once by _init_worker instead of with every task
+_X = None
+_y = None
+
+
+def _init_worker(X, y):
+    global _X, _y
+    _X, _y = X, y
+
+
+def _fit_and_score(estimator, params, train_indices, test_indices):
+    """Fits a configuration on a training subset and returns its accuracy on the test fold.
+
+        :return score (float), fit_time (float), score_time (float), error (str): error is None if the fit succeeded
+        """
+
+    fit_time = 0.0
+    started = time.perf_counter()
+    try:
+        model = clone(estimator).set_params(**params)
+        model.fit(_X[train_indices], _y[train_indices])
+        fit_time = time.perf_counter() - started
+        started = time.perf_counter()
+        score = float(np.mean(model.predict(_X[test_indices]) == _y[test_indices]))
+    except Exception as e:
+        # scored like GridSearchCV with error_score=nan
+        return float("nan"), fit_time or time.perf_counter() - started, 0.0, "{}: {}".format(type(e).__name__, e)
+    return score, fit_time, time.perf_counter() - started, None
+
+
+def _fit_and_score_args(args):
+    return _fit_and_score(*args)
+
+
+def stratified_order(indices, y, random_state=None):
+    """Orders indices so that every prefix has about the class proportions of the whole, in random order within classes.
+        """
+
+    rng = np.random.RandomState(random_state)
+    indices = rng.permutation(indices)
+    labels = y[indices]
+    rank = np.empty(len(indices))
+    for label in np.unique(labels):
+        in_class = labels == label
+        rank[in_class] = (np.arange(in_class.sum()) + 0.5) / in_class.sum()
+    return indices[np.argsort(rank, kind="stable")]
+
+
+def select_models(X, y, candidates=DETECTION_CANDIDATES, cv=5, factor=3, min_resources=None, workers=None, random_state=22, verbose=1):
+    """Finds the best parameters of every estimator family by successive halving, like one GridSearchCV per family.
+
+        All configurations start on a small stratified subset of every training fold. After each round only the
+        best 1/factor configurations of every family are kept, and the training subsets grow factor times, the last
+        round using the whole training folds. The (configuration, fold) fits of all families in a round run in one
+        shared pool of worker processes. Folds (StratifiedKFold, as GridSearchCV) and their subsets are computed once.
+
+        :param X (ndarray): Feature matrix
+        :param y (ndarray): Labels
+        :param candidates (dict): Family name -> (estimator, parameter grid)
+        :param cv (int): Number of folds
+        :param factor (int): Fraction of configurations kept, and growth of the training subsets, at every round
+        :param min_resources (int): Training samples of the first round, by default 2 * cv * number of classes
+        :param workers (int): Number of worker processes, None for the number of CPUs
+        :param random_state (int): Seed of the training subsets
+        :param verbose (int): Print the progress of every round if > 0
+        :return model_data (dict), train_accuracies (list), report (list):
+            Best parameters of every family, their mean CV accuracy on the whole training folds (in family order)
+            and one dict per configuration (see REPORT_FIELDS)
+        """
+
+    X = np.asarray(X)
+    y = np.asarray(y)
+    folds = list(StratifiedKFold(n_splits=cv).split(X, y))
+    # training folds ordered so that any prefix is a stratified subset
+    train_orders = [stratified_order(train_indices, y, random_state) for train_indices, _ in folds]
+    n_samples = min(len(order) for order in train_orders)
+    if min_resources is None:
+        min_resources = 2 * cv * len(np.unique(y))
+
+    report = []
+    families = {}
+    for family, (estimator, param_grid) in candidates.items():
+        families[family] = []
+        for params in ParameterGrid(param_grid):
+            families[family].append(len(report))
+            report.append({"family": family, "params": params, "status": "pruned", "rounds": 0, "error": None})
+    n_rounds = 1 + max(math.ceil(math.log(len(indices), factor)) if len(indices) > 1 else 0 for indices in families.values())
+    # the last round uses the whole training folds
+    n_rounds = max(1, min(n_rounds, 1 + int(math.log(max(n_samples / min_resources, 1), factor))))
+
+    survivors = {family: list(indices) for family, indices in families.items()}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(X, y)) as executor:
+        for round_index in range(n_rounds):
+            last_round = round_index == n_rounds - 1
+            n_resources = n_samples if last_round else min(n_samples, min_resources * factor ** round_index)
+            # a family down to one configuration only needs the last round
+            evaluated = [i for indices in survivors.values() if len(indices) > 1 or last_round for i in indices]
+            tasks = [(i, fold_index) for i in evaluated for fold_index in range(cv)]
+            args = [(candidates[report[i]["family"]][0], report[i]["params"], train_orders[fold_index][:None if last_round else n_resources], folds[fold_index][1]) for i, fold_index in tasks]
+            started = time.perf_counter()
+            results = {}
+            for (i, fold_index), result in zip(tasks, executor.map(_fit_and_score_args, args)):
+                results.setdefault(i, []).append(result)
+            for i in evaluated:
+                scores, fit_times, score_times, errors = zip(*results[i])
+                errors = [error for error in errors if error]
+                report[i].update(rounds=round_index + 1, n_resources=n_resources, mean_score=float(np.mean(scores)), std_score=float(np.std(scores)),
+                                 fit_time=float(np.sum(fit_times)), score_time=float(np.sum(score_times)), error=errors[0] if errors else None)
+            if verbose:
+                print("Round {}/{}: {} configurations on {} samples per fold in {:.1f}s".format(round_index + 1, n_rounds, len(evaluated), n_resources, time.perf_counter() - started))
+
+            for family, indices in survivors.items():
+                if len(indices) > 1 and not last_round:
+                    ranked = sorted(indices, key=lambda i: -np.nan_to_num(report[i]["mean_score"], nan=-np.inf))
+                    survivors[family] = ranked[:max(1, math.ceil(len(indices) / factor))]
+
+    model_data = {}
+    train_accuracies = []
+    for family, indices in survivors.items():
+        best = max(indices, key=lambda i: np.nan_to_num(report[i]["mean_score"], nan=-np.inf))
+        for i in indices:
+            report[i]["status"] = "best" if i == best else "finalist"
+        model_data[family] = report[best]["params"]
+        train_accuracies.append(report[best]["mean_score"])
+    return model_data, train_accuracies, report
+
+
+def save_report(report, path):
+    """Saves the per-configuration report as CSV, or as JSON if path ends with .json.
+        """
+
+    with open(path, "w", newline="") as fp:
+        if path.endswith(".json"):
+            json.dump(report, fp, indent=1)
+            return
+        writer = csv.DictWriter(fp, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        for entry in report:
+            writer.writerow(dict(entry, params=json.dumps(entry["params"])))
+
+
+if __name__ == "__main__":
+
+    from sklearn.preprocessing import StandardScaler
+    from feature_store import load_feature_store
+
+    parser = argparse.ArgumentParser(description="Selects the best parameters of every model family on a feature store.")
+    parser.add_argument("store", help="feature store directory (e.g. detection_data)")
+    parser.add_argument("--task", choices=["detection", "classification"], default="detection", help="model families and grids to search")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, all CPUs by default")
+    parser.add_argument("--cv", type=int, default=5, help="number of folds")
+    parser.add_argument("--factor", type=int, default=3, help="fraction of configurations kept after every round")
+    parser.add_argument("--report", default="model_selection_report.csv", help="per-configuration report (.csv or .json)")
+    args = parser.parse_args()
+
+    features, labels, _ = load_feature_store(args.store)
+    X = StandardScaler().fit_transform(np.array(features, dtype=float))
+    candidates = DETECTION_CANDIDATES if args.task == "detection" else CLASSIFICATION_CANDIDATES
+    model_data, train_accuracies, report = select_models(X, np.array(labels), candidates, args.cv, args.factor, workers=args.workers)
+    save_report(report, args.report)
+    for (family, params), accuracy in zip(model_data.items(), train_accuracies):
+        print("{}: {:.4f} {}".format(family, accuracy, json.dumps(params)))
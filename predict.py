@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import csv
+import io
+import json
+import os
+import pickle
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import librosa
+from audio_decode import read_audio
+from audio_preprocessing import AUDIO_EXTENSIONS, SAMPLE_RATE, get_features_batch, bounded_map
+from model_artifact import load_model_artifact
+
+DATASET_AUDIO_DURATION = 5
+BATCH_SIZE = 32
+# longest time a request waits for others to fill its batch in server mode
+MAX_BATCH_WAIT = 0.02
+OUTPUT_FIELDS = [
+    "path",
+    "detection",
+    "detection_name",
+    "detection_score",
+    "classification",
+    "classification_name",
+    "classification_score",
+    "error",
+    "decode_ms",
+    "featurize_ms",
+    "predict_ms",
+]
+
+
+def load_pickle(path):
+    """Loads a pickled model or scaler, None if path is None.
+        """
+
+    if path is None:
+        return None
+    with open(path, "rb") as fp:
+        return pickle.load(fp)
+
+
+def load_label_map(metadata_path):
+    """Returns the label map saved in the metadata.json of a feature store, None if metadata_path is None.
+        """
+
+    if metadata_path is None:
+        return None
+    with open(metadata_path, "r") as fp:
+        return json.load(fp)["label_map"]
+
+
+def list_audio_files(paths):
+    """Expands directories into the audio files they contain, in sorted order.
+
+        :param paths (list): Paths to audio files and directories
+        :return files (list): Paths to audio files
+        """
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                files.extend(os.path.join(dirpath, f) for f in sorted(filenames) if f.lower().endswith(AUDIO_EXTENSIONS))
+        else:
+            files.append(path)
+    return files
+
+
+def decode_clip(source, sample_rate=SAMPLE_RATE, duration=DATASET_AUDIO_DURATION):
+    """Decodes the first duration seconds of an audio file, padded with zeros like the clips of clean_dataset.
+
+        :param source: Path to an audio file, or its content as bytes
+        :param duration (float): Duration of the clip, None to decode the whole file without padding
+        :return signal (ndarray): Mono float32 signal of duration * sample_rate samples
+        """
+
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    signal, _ = read_audio(source, sr=sample_rate, duration=duration)
+    if duration is None:
+        if not len(signal):
+            raise ValueError("empty audio")
+        return signal
+    return librosa.util.fix_length(signal, size=int(duration * sample_rate))
+
+
+def featurize_batch(sources, sample_rate=SAMPLE_RATE, duration=DATASET_AUDIO_DURATION, num_mfcc=13, n_fft=2048, hop_length=512, feature_mode="frames"):
+    """Decodes a batch of clips and extracts their feature vectors in one vectorized pass.
+
+        Runs in the worker processes. Clips that fail to decode are reported instead of raising.
+        With pooled features the clips are scored whole, whatever their duration, and the vectorized
+        passes group the clips of equal length.
+
+        :param sources (list): Paths to audio files, or their content as bytes
+        :param num_mfcc, n_fft, hop_length, feature_mode: Extraction parameters, see get_features_batch
+        :return features (ndarray), errors (list), decode_ms (list), featurize_ms (float):
+            Feature rows of the decoded clips, error message of every source (None if decoded),
+            decoding time of every source and featurization time of the whole batch
+        """
+
+    if feature_mode == "pooled":
+        duration = None
+    signals, errors, decode_ms = [], [], []
+    for source in sources:
+        started = time.perf_counter()
+        try:
+            signals.append(decode_clip(source, sample_rate, duration))
+            errors.append(None)
+        except Exception as e:
+            errors.append("{}: {}".format(type(e).__name__, e))
+        decode_ms.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    features = None
+    if signals:
+        groups = {}
+        for i, signal in enumerate(signals):
+            groups.setdefault(len(signal), []).append(i)
+        for indices in groups.values():
+            rows = get_features_batch(np.stack([signals[i] for i in indices]), sample_rate, num_mfcc, n_fft, hop_length, feature_mode)
+            if features is None:
+                features = np.empty((len(signals), rows.shape[1]), dtype=rows.dtype)
+            features[indices] = rows
+    featurize_ms = (time.perf_counter() - started) * 1000
+    return features, errors, decode_ms, featurize_ms
+
+
+def _featurize_batch_args(args):
+    return featurize_batch(*args)
+
+
+class Predictor:
+    """Detection model, and classification model for the clips detected as coughs, along with their scalers.
+
+        The models are the pickled final_detection_model and final_classification_model of model_training.ipynb,
+        the scalers the StandardScalers they were trained with.
+        """
+
+    def __init__(self, detection_model, detection_scaler=None, classification_model=None, classification_scaler=None,
+                 detection_label_map=None, classification_label_map=None):
+        """
+            :param detection_model: Fitted cough detection model
+            :param detection_scaler: Scaler applied to the features before detection_model, None for raw features
+            :param classification_model: Fitted cough classification model, None to only detect
+            :param classification_scaler: Scaler applied to the features before classification_model
+            :param detection_label_map (dict): Label -> label index of the detection dataset
+            :param classification_label_map (dict): Label -> label index of the classification dataset
+            """
+
+        self.detection_model = detection_model
+        self.detection_scaler = detection_scaler
+        self.classification_model = classification_model
+        self.classification_scaler = classification_scaler
+        self.detection_names = {index: label for label, index in (detection_label_map or {}).items()}
+        self.classification_names = {index: label for label, index in (classification_label_map or {}).items()}
+        # cough is the first label of the detection dataset unless the label map says otherwise
+        self.cough_label = (detection_label_map or {}).get("cough", 0)
+        # parameters the clips are featurized with
+        self.extraction = {"sample_rate": SAMPLE_RATE, "num_mfcc": 13, "n_fft": 2048, "hop_length": 512, "feature_mode": "frames"}
+
+    @classmethod
+    def load(cls, detection_model_path, detection_scaler_path=None, classification_model_path=None, classification_scaler_path=None,
+             detection_labels_path=None, classification_labels_path=None):
+        """Loads the pickled models and scalers, and the label maps from the feature store metadata.json files.
+            """
+
+        return cls(load_pickle(detection_model_path), load_pickle(detection_scaler_path),
+                   load_pickle(classification_model_path), load_pickle(classification_scaler_path),
+                   load_label_map(detection_labels_path), load_label_map(classification_labels_path))
+
+    @classmethod
+    def from_artifacts(cls, detection_artifact_path, classification_artifact_path=None):
+        """Loads model artifacts (see model_artifact), which bring their own preprocessing, labels and extraction parameters.
+            """
+
+        detection_artifact = load_model_artifact(detection_artifact_path)
+        classification_artifact = load_model_artifact(classification_artifact_path) if classification_artifact_path else None
+        predictor = cls(detection_artifact, None, classification_artifact, None, detection_artifact.label_map,
+                        classification_artifact.label_map if classification_artifact else None)
+        predictor.extraction.update((key, detection_artifact.feature_spec[key]) for key in predictor.extraction if key in detection_artifact.feature_spec)
+        if classification_artifact:
+            # both models score the same feature rows
+            classification_artifact.check_features(np.zeros((1, detection_artifact.feature_spec["num_features"])), predictor.extraction)
+        return predictor
+
+    @staticmethod
+    def _predict(model, scaler, features):
+        if scaler is not None:
+            features = scaler.transform(features)
+        labels = model.predict(features)
+        try:
+            scores = np.max(model.predict_proba(features), axis=1)
+        except AttributeError:
+            scores = [None] * len(labels)
+        return labels, scores
+
+    def predict(self, features):
+        """Predicts a batch of feature rows.
+
+            :param features (ndarray): Feature rows as returned by get_features_batch
+            :return predictions (list): One dict per row with the detection and, for coughs, the classification
+            """
+
+        labels, scores = self._predict(self.detection_model, self.detection_scaler, features)
+        predictions = []
+        for label, score in zip(labels, scores):
+            predictions.append({
+                "detection": int(label),
+                "detection_name": self.detection_names.get(int(label)),
+                "detection_score": None if score is None else float(score),
+            })
+
+        coughs = [i for i, label in enumerate(labels) if label == self.cough_label]
+        if self.classification_model is not None and coughs:
+            labels, scores = self._predict(self.classification_model, self.classification_scaler, features[coughs])
+            for i, label, score in zip(coughs, labels, scores):
+                predictions[i].update({
+                    "classification": int(label),
+                    "classification_name": self.classification_names.get(int(label)),
+                    "classification_score": None if score is None else float(score),
+                })
+        return predictions
+
+    def predict_batch(self, sources, featurized):
+        """Turns the output of featurize_batch into one record per source, with the per-stage timings.
+
+            The featurization and prediction times of the batch are shared equally by its clips.
+            """
+
+        features, errors, decode_ms, featurize_ms = featurized
+        started = time.perf_counter()
+        predictions = iter(self.predict(features) if features is not None else [])
+        predict_ms = (time.perf_counter() - started) * 1000
+
+        records = []
+        for source, error, source_decode_ms in zip(sources, errors, decode_ms):
+            record = {"path": source if isinstance(source, str) else None}
+            if error is None:
+                record.update(next(predictions))
+            else:
+                record["error"] = error
+            record.update(decode_ms=source_decode_ms, featurize_ms=featurize_ms / len(sources), predict_ms=predict_ms / len(sources))
+            records.append(record)
+        return records
+
+
+def predict_files(predictor, files, batch_size=BATCH_SIZE, workers=1):
+    """Scores audio files, decoding and featurizing the next batches in worker processes while a batch is predicted.
+
+        :param predictor (Predictor): Models to predict with
+        :param files (list): Paths to audio files
+        :param batch_size (int): Number of clips featurized and predicted together
+        :param workers (int): Number of worker processes
+        :return: Iterator of records (dict, see OUTPUT_FIELDS) in the order of files
+        """
+
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    args = [(batch, predictor.extraction["sample_rate"], DATASET_AUDIO_DURATION, predictor.extraction["num_mfcc"],
+             predictor.extraction["n_fft"], predictor.extraction["hop_length"], predictor.extraction["feature_mode"]) for batch in batches]
+    if workers > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for batch, featurized in zip(batches, bounded_map(executor, _featurize_batch_args, args, workers * 2)):
+                yield from predictor.predict_batch(batch, featurized)
+    else:
+        for batch, featurized in zip(batches, map(_featurize_batch_args, args)):
+            yield from predictor.predict_batch(batch, featurized)
+
+
+class MicroBatcher:
+    """Groups concurrent prediction requests into batches.
+
+        A batch is started as soon as batch_size clips are waiting, or max_wait seconds after its first clip.
+        With workers > 1 several batches are featurized at the same time in worker processes.
+        """
+
+    def __init__(self, predictor, batch_size=BATCH_SIZE, max_wait=MAX_BATCH_WAIT, workers=1):
+        self.predictor = predictor
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.extraction = dict(predictor.extraction)
+        self._requests = queue.Queue()
+        self._predict_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, source):
+        """Queues a clip (path or audio file content) and returns a Future of its record.
+            """
+
+        future = Future()
+        self._requests.put((source, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._requests.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            sources = [source for source, _ in batch]
+            futures = [future for _, future in batch]
+            if self.executor:
+                featurized = self.executor.submit(featurize_batch, sources, **self.extraction)
+                featurized.add_done_callback(lambda f, sources=sources, futures=futures: self._resolve(sources, futures, f))
+            else:
+                featurized = Future()
+                try:
+                    featurized.set_result(featurize_batch(sources, **self.extraction))
+                except Exception as e:
+                    featurized.set_exception(e)
+                self._resolve(sources, futures, featurized)
+
+    def _resolve(self, sources, futures, featurized):
+        try:
+            with self._predict_lock:
+                records = self.predictor.predict_batch(sources, featurized.result())
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, record in zip(futures, records):
+            future.set_result(record)
+
+
+def make_request_handler(batcher):
+    """Returns the HTTP request handler of the prediction server.
+
+        POST /predict with an audio file as body returns its record, POST /predict with a JSON body
+        {"paths": [...]} returns the records of audio files readable by the server. GET /health returns ok.
+        """
+
+    class RequestHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {"error": "not found"})
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    futures = [batcher.submit(path) for path in json.loads(body)["paths"]]
+                    self._send_json(200, [future.result() for future in futures])
+                else:
+                    self._send_json(200, batcher.submit(body).result())
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": str(e)})
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return RequestHandler
+
+
+def write_records(records, fp, output_format="jsonl"):
+    """Writes records as JSON lines or CSV rows as they come, returns the number of records written.
+        """
+
+    num_records = 0
+    if output_format == "csv":
+        writer = csv.DictWriter(fp, fieldnames=OUTPUT_FIELDS)
+        writer.writeheader()
+    for record in records:
+        if output_format == "csv":
+            writer.writerow(record)
+        else:
+            fp.write(json.dumps(record) + "\n")
+        num_records += 1
+    return num_records
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Detects and classifies coughs in audio files with the persisted models.")
+    parser.add_argument("paths", nargs="*", help="audio files and directories to score")
+    parser.add_argument("--detection-artifact", help="detection model artifact (see model_artifact), instead of the pickles below")
+    parser.add_argument("--classification-artifact", help="classification model artifact, applied to the detected coughs")
+    parser.add_argument("--detection-model", default="detection_model.sav", help="pickled detection model")
+    parser.add_argument("--detection-scaler", help="pickled StandardScaler fitted with the detection model")
+    parser.add_argument("--classification-model", help="pickled classification model, applied to the detected coughs")
+    parser.add_argument("--classification-scaler", help="pickled StandardScaler fitted with the classification model")
+    parser.add_argument("--detection-labels", help="metadata.json of the detection feature store, to name the labels")
+    parser.add_argument("--classification-labels", help="metadata.json of the classification feature store, to name the labels")
+    parser.add_argument("--feature-mode", choices=["frames", "pooled"], default="frames", help="features the pickled models were trained on")
+    parser.add_argument("--file-list", help="file with one audio path per line to score")
+    parser.add_argument("--output", help="output file, standard output by default")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl", help="output format")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="number of clips featurized together")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to decode and featurize")
+    parser.add_argument("--serve", action="store_true", help="run a local HTTP prediction server instead")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the HTTP server")
+    parser.add_argument("--port", type=int, default=8000, help="port of the HTTP server")
+    parser.add_argument("--max-wait", type=float, default=MAX_BATCH_WAIT * 1000, help="milliseconds a request waits to be batched")
+    args = parser.parse_args()
+
+    if args.detection_artifact:
+        predictor = Predictor.from_artifacts(args.detection_artifact, args.classification_artifact)
+    else:
+        predictor = Predictor.load(args.detection_model, args.detection_scaler, args.classification_model, args.classification_scaler,
+                                   args.detection_labels, args.classification_labels)
+        predictor.extraction["feature_mode"] = args.feature_mode
+
+    if args.serve:
+        batcher = MicroBatcher(predictor, args.batch_size, args.max_wait / 1000, args.workers)
+        server = ThreadingHTTPServer((args.host, args.port), make_request_handler(batcher))
+        print("Serving predictions on http://{}:{}/predict".format(args.host, args.port), file=sys.stderr)
+        server.serve_forever()
+
+    files = list_audio_files(args.paths)
+    if args.file_list:
+        with open(args.file_list, "r") as fp:
+            files.extend(line.strip() for line in fp if line.strip())
+
+    started = time.perf_counter()
+    output = open(args.output, "w", newline="") if args.output else sys.stdout
+    num_records = write_records(predict_files(predictor, files, args.batch_size, args.workers), output, args.format)
+    if args.output:
+        output.close()
+    elapsed = time.perf_counter() - started
+    print("Scored {} clips in {:.1f}s ({:.0f} clips per minute)".format(num_records, elapsed, num_records / elapsed * 60 if elapsed else 0), file=sys.stderr)
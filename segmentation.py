@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import librosa
+import soundfile as sf
+
+# intervals quieter than TOP_DB below the peak are treated as silence
+TOP_DB = 67
+# shortest part of an interval kept as a clip, in seconds
+MIN_DURATION = 1.5
+# duration of the clips, in seconds
+MAX_DURATION = 5.0
+
+
+def keep_windows(intervals, window_length, min_length):
+    """Cuts non-silent intervals into windows of window_length samples, without a loop over the windows.
+
+        Every interval is cut into consecutive windows starting at its first sample, the last one being cut
+        short by the end of the interval. Windows with less than min_length samples left in their interval
+        are dropped.
+
+        :param intervals (ndarray): [start, end) sample indices of shape (n, 2), as returned by librosa.effects.split
+        :param window_length (int): Length of the windows in samples
+        :param min_length (float): Minimum number of samples of a window
+        :return starts (ndarray), lengths (ndarray), interval_indices (ndarray), window_indices (ndarray):
+            First sample and number of signal samples of every kept window, index of its interval and
+            its position within that interval
+        """
+
+    intervals = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+    interval_starts, interval_ends = intervals[:, 0], intervals[:, 1]
+    counts = -(-(interval_ends - interval_starts) // window_length)
+    interval_indices = np.repeat(np.arange(len(intervals)), counts)
+    window_indices = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    starts = interval_starts[interval_indices] + window_indices * window_length
+    remaining = interval_ends[interval_indices] - starts
+    keep = remaining >= min_length
+    lengths = np.minimum(remaining, window_length)
+    return starts[keep], lengths[keep], interval_indices[keep], window_indices[keep]
+
+
+def window_view(signal, window_length):
+    """Returns the read-only view of all window_length windows of a signal, row i starting at sample i.
+
+        Nothing is copied, so only the windows ending within the signal are in the view.
+        """
+
+    return np.lib.stride_tricks.sliding_window_view(signal, window_length)
+
+
+def clip_matrix(signal, starts, lengths, window_length):
+    """Gathers windows of a signal into a (windows, window_length) matrix, zero padding the short windows.
+
+        Gives the same clips as slicing every window and calling librosa.util.fix_length on it, in one gather.
+        Windows running past the end of the signal are gathered from a zero padded copy of its last samples only.
+        """
+
+    tail = starts > len(signal) - window_length
+    if len(starts) and not tail.any():
+        clips = window_view(signal, window_length)[starts]
+    else:
+        clips = np.empty((len(starts), window_length), dtype=signal.dtype)
+        if not tail.all():
+            clips[~tail] = window_view(signal, window_length)[starts[~tail]]
+        offset = max(len(signal) - window_length, 0)
+        tail_signal = np.concatenate([signal[offset:], np.zeros(window_length, dtype=signal.dtype)])
+        clips[tail] = window_view(tail_signal, window_length)[starts[tail] - offset]
+    clips[np.arange(window_length) >= lengths[:, np.newaxis]] = 0
+    return clips
+
+
+def segment_signal(signal, sample_rate, min_duration=MIN_DURATION, max_duration=MAX_DURATION, top_db=TOP_DB):
+    """Splits a signal on silences and cuts the non-silent intervals into clips of max_duration seconds.
+
+        :param signal (ndarray): Audio time series
+        :param sample_rate (int): Sample rate of the signal
+        :param min_duration (float): Minimum duration of a clip in seconds, shorter ones are dropped
+        :param max_duration (float): Duration of the clips in seconds
+        :param top_db (float): Threshold (in decibels) below the peak to consider as silence
+        :return clips (ndarray), interval_indices (ndarray), window_indices (ndarray):
+            Clips of shape (n, max_duration * sample_rate), ready for features.extract_features, and the
+            position of every clip (see keep_windows)
+        """
+
+    window_length = int(sample_rate * max_duration)
+    intervals = librosa.effects.split(signal, top_db=top_db)
+    starts, lengths, interval_indices, window_indices = keep_windows(intervals, window_length, sample_rate * min_duration)
+    return clip_matrix(signal, starts, lengths, window_length), interval_indices, window_indices
+
+
+def write_clips(clips, paths, sample_rate, tmp_dir_path=None):
+    """Saves every clip of a clip matrix to its own wav file.
+
+        :param clips (ndarray): Clips of shape (n, samples)
+        :param paths (list): Destination path of every clip
+        :param sample_rate (int): Sample rate of the clips
+        :param tmp_dir_path (str): If given, clips are written to a directory of their own in it first and moved in
+            place, so an interrupted run never leaves a truncated clip and concurrent calls never swap same-named clips
+        """
+
+    if tmp_dir_path is None:
+        for clip, path in zip(clips, paths):
+            sf.write(path, clip, sample_rate)
+        return
+    staging_dir_path = tempfile.mkdtemp(dir=tmp_dir_path)
+    try:
+        for clip, path in zip(clips, paths):
+            tmp_path = os.path.join(staging_dir_path, os.path.basename(path))
+            sf.write(tmp_path, clip, sample_rate)
+            os.replace(tmp_path, path)
+    finally:
+        shutil.rmtree(staging_dir_path, ignore_errors=True)
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import math
+import pickle
+import sys
+import time
+import numpy as np
+import librosa
+import soundfile as sf
+from features import extract_features, pool_features, features_to_row, required_stfts
+
+SAMPLE_RATE = 22050
+DATASET_AUDIO_DURATION = 5
+BLOCK_SIZE = 4096
+DECISION_HOP = 1.0
+
+
+class IncrementalSTFT:
+    """STFT of fixed-length windows sliding over a stream, equal to librosa.stft(window + offset).
+
+        The frames that lie entirely inside a window do not depend on the window boundaries, so they are kept in
+        a ring of frames and computed once for the whole stream. Only the few padded frames at both ends of a
+        window are computed again for every window. Window starts must be multiples of hop_length.
+        """
+
+    def __init__(self, n_fft, hop_length, window_length, offset=0.0):
+        """
+            :param n_fft (int): Interval we consider to apply FFT. Measured in # of samples
+            :param hop_length (int): Sliding window for FFT. Measured in # of samples
+            :param window_length (int): Number of samples of the windows
+            :param offset (float): Constant added to the signal
+            """
+
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.window_length = window_length
+        self.offset = offset
+        self.num_frames = 1 + window_length // hop_length
+        # frames [first_inner, end_inner) of a window are not affected by the center padding
+        self.first_inner = -(-(n_fft // 2) // hop_length)
+        self.end_inner = (window_length - n_fft // 2) // hop_length + 1
+        # first frame of the chunk the tail frames are computed from (at least n_fft samples long)
+        self.tail_start = min(self.end_inner - self.first_inner, (window_length - n_fft) // hop_length)
+        self.capacity = self.end_inner - self.first_inner
+        self.ring = None
+        # stream frame indices [ring_start, ring_end) currently held in the ring
+        self.ring_start = self.ring_end = 0
+
+    def _stft(self, signal, center=True):
+        if self.offset:
+            signal = signal + self.offset
+        return librosa.stft(signal, n_fft=self.n_fft, hop_length=self.hop_length, center=center)
+
+    def __call__(self, window, start):
+        """Returns the STFT of a window of the stream.
+
+            :param window (ndarray): window_length samples of the stream
+            :param start (int): Index of the first sample of the window in the stream, a multiple of hop_length
+            :return stft (ndarray): Complex STFT of shape (1 + n_fft/2, num_frames)
+            """
+
+        first_frame = start // self.hop_length
+        inner_start = first_frame + self.first_inner
+        inner_end = first_frame + self.end_inner
+        if inner_start < self.ring_start or inner_start > self.ring_end:
+            # first window, or a jump past the frames in the ring
+            self.ring_start = self.ring_end = inner_start
+        self.ring_start = inner_start
+
+        # compute the inner frames not in the ring yet
+        if self.ring_end < inner_end:
+            t = self.ring_end - first_frame
+            chunk = window[t * self.hop_length - self.n_fft // 2:(self.end_inner - 1) * self.hop_length + self.n_fft // 2]
+            frames = self._stft(chunk, center=False)
+            if self.ring is None:
+                self.ring = np.empty((frames.shape[0], self.capacity), dtype=frames.dtype, order="F")
+            self.ring[:, np.arange(self.ring_end, inner_end) % self.capacity] = frames
+            self.ring_end = inner_end
+
+        # same memory layout as librosa.stft, so that reductions over frequencies round identically
+        stft = np.empty((self.ring.shape[0], self.num_frames), dtype=self.ring.dtype, order="F")
+        stft[:, :self.first_inner] = self._stft(window[:self.first_inner * self.hop_length + self.n_fft])[:, :self.first_inner]
+        stft[:, self.first_inner:self.end_inner] = self.ring[:, np.arange(inner_start, inner_end) % self.capacity]
+        tail = self._stft(window[self.tail_start * self.hop_length:])
+        stft[:, self.end_inner:] = tail[:, self.end_inner - self.tail_start:]
+        return stft
+
+
+class StreamingDetector:
+    """Scores windows of DATASET_AUDIO_DURATION seconds sliding over an audio stream with the detection model.
+
+        Windows are featurized exactly like get_features_csv_row, so a model trained on the feature datasets
+        applies unchanged.
+        """
+
+    def __init__(self, model, scaler=None, label_map=None, sample_rate=SAMPLE_RATE, window_duration=DATASET_AUDIO_DURATION,
+                 decision_hop=DECISION_HOP, num_mfcc=13, n_fft=2048, hop_length=512, feature_mode="frames"):
+        """
+            :param model: Fitted classifier (predict, and predict_proba if available)
+            :param scaler: Fitted scaler applied to the features before the model, None if the model takes raw features
+            :param label_map (dict): Label -> label index, used to name the predictions
+            :param sample_rate (int): Sample rate of the stream
+            :param window_duration (float): Duration of the scored windows in seconds
+            :param decision_hop (float): Time between two decisions in seconds, rounded to a multiple of the STFT hops
+            :param feature_mode (str): Features the model was trained on, "frames" or "pooled" (see features.pool_features)
+            """
+
+        self.model = model
+        self.scaler = scaler
+        self.label_names = {index: label for label, index in (label_map or {}).items()}
+        self.sample_rate = sample_rate
+        self.num_mfcc = num_mfcc
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.feature_mode = feature_mode
+        self.window_length = int(window_duration * sample_rate)
+        stft_keys = required_stfts(n_fft, hop_length)
+        step = 1
+        for _, _, stft_hop_length in stft_keys:
+            step = step * stft_hop_length // math.gcd(step, stft_hop_length)
+        self.hop = max(1, round(decision_hop * sample_rate / step)) * step
+        self.stfts = {key: IncrementalSTFT(key[1], key[2], self.window_length, offset=key[0]) for key in stft_keys}
+
+    def score(self, window, start):
+        """Returns the decision for the window starting at sample start.
+            """
+
+        started = time.perf_counter()
+        stfts = {key: stft(window, start) for key, stft in self.stfts.items()}
+        features = extract_features(window, self.sample_rate, self.num_mfcc, self.n_fft, self.hop_length, stfts=stfts)
+        if self.feature_mode == "pooled":
+            features = pool_features(features)
+        row = features_to_row(features).reshape(1, -1)
+        if self.scaler is not None:
+            row = self.scaler.transform(row)
+        label = int(self.model.predict(row)[0])
+        decision = {
+            "start": start / self.sample_rate,
+            "end": (start + self.window_length) / self.sample_rate,
+            "label": label,
+        }
+        if label in self.label_names:
+            decision["label_name"] = self.label_names[label]
+        if hasattr(self.model, "predict_proba"):
+            decision["score"] = float(np.max(self.model.predict_proba(row)))
+        decision["latency_ms"] = (time.perf_counter() - started) * 1000
+        return decision
+
+    def process(self, blocks):
+        """Consumes audio blocks and yields a decision every hop samples.
+
+            At the end of the stream the last window is padded with zeros, like the clips of clean_dataset.
+
+            :param blocks: Iterable of mono float32 blocks at sample_rate
+            :return: Iterator of decisions (dict with start, end, label, label_name, score, latency_ms)
+            """
+
+        # samples of the stream from sample buffer_start on, never more than a window and a block
+        buffer = np.zeros(0, dtype=np.float32)
+        buffer_start = 0
+        scored_end = 0
+        # samples between two windows not received yet, when the hop is longer than a window
+        skip = 0
+        for block in blocks:
+            if skip:
+                skipped = min(skip, len(block))
+                block = block[skipped:]
+                skip -= skipped
+            buffer = np.concatenate([buffer, block])
+            while len(buffer) >= self.window_length:
+                yield self.score(buffer[:self.window_length], buffer_start)
+                scored_end = buffer_start + self.window_length
+                skip = max(0, self.hop - len(buffer))
+                buffer = buffer[self.hop:]
+                buffer_start += self.hop
+        if len(buffer) and buffer_start + len(buffer) > scored_end:
+            yield self.score(librosa.util.fix_length(buffer, size=self.window_length), buffer_start)
+
+
+def read_blocks(source, block_size=BLOCK_SIZE, sample_rate=SAMPLE_RATE, raw=False):
+    """Reads a mono audio stream block by block.
+
+        :param source (str): Path to an audio file, or to a pipe of raw float32 samples if raw; "-" reads raw samples from stdin
+        :param block_size (int): Number of samples per block
+        :param sample_rate (int): Sample rate of the blocks, audio files at another rate are resampled
+        :param raw (bool): Source is raw mono float32 little-endian samples at sample_rate
+        :return: Iterator of float32 blocks
+        """
+
+    if raw or source == "-":
+        fp = sys.stdin.buffer if source == "-" else open(source, "rb")
+        with fp:
+            while True:
+                data = fp.read(block_size * 4)
+                if not data:
+                    break
+                yield np.frombuffer(data[:len(data) // 4 * 4], dtype="<f4")
+        return
+
+    resampler = None
+    source_rate = sf.info(source).samplerate
+    if source_rate != sample_rate:
+        import soxr
+        resampler = soxr.ResampleStream(source_rate, sample_rate, 1, dtype="float32")
+    for block in sf.blocks(source, blocksize=block_size, dtype="float32", always_2d=True):
+        block = block.mean(axis=1)
+        yield resampler.resample_chunk(block) if resampler else block
+    if resampler:
+        yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Detects coughs in a live or long audio stream.")
+    parser.add_argument("model", help="pickled detection model (e.g. detection_model.sav)")
+    parser.add_argument("source", help="audio file, pipe, or - for raw float32 samples on stdin")
+    parser.add_argument("--scaler", help="pickled StandardScaler fitted with the model")
+    parser.add_argument("--labels", help="metadata.json of the detection feature store, to name the labels")
+    parser.add_argument("--raw", action="store_true", help="source is raw mono float32 samples at {} Hz".format(SAMPLE_RATE))
+    parser.add_argument("--hop", type=float, default=DECISION_HOP, help="seconds between two decisions")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE, help="samples read at a time")
+    parser.add_argument("--feature-mode", choices=["frames", "pooled"], default="frames", help="features the model was trained on")
+    args = parser.parse_args()
+
+    with open(args.model, "rb") as fp:
+        model = pickle.load(fp)
+    scaler = None
+    if args.scaler:
+        with open(args.scaler, "rb") as fp:
+            scaler = pickle.load(fp)
+    label_map = None
+    if args.labels:
+        with open(args.labels, "r") as fp:
+            label_map = json.load(fp)["label_map"]
+
+    detector = StreamingDetector(model, scaler, label_map, decision_hop=args.hop, feature_mode=args.feature_mode)
+    for decision in detector.process(read_blocks(args.source, args.block_size, raw=args.raw)):
+        print(json.dumps(decision), flush=True)
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import librosa
+from audio_decode import read_audio
+from audio_preprocessing import BASE_DIR, DETECTION_DATASET_PATHS, CLASSIFICATION_DATASET_PATHS, SAMPLE_RATE, list_dataset_files, bounded_map
+from features import extract_spectrograms
+from instrumentation import LEVELS, NULL_INSTRUMENTATION, Instrumentation
+
+DETECTION_TENSORS_PATH = os.path.join(BASE_DIR, "detection_tensors")
+CLASSIFICATION_TENSORS_PATH = os.path.join(BASE_DIR, "classification_tensors")
+TENSOR_FEATURES = ["mfcc", "log_mel", "chroma"]
+SEGMENT_DURATION = 5
+DATA_FILE = "tensors.npy"
+INDEX_FILE = "index.npy"
+METADATA_FILE = "metadata.json"
+# one row per segment: its source file, its position in the file and its label
+INDEX_DTYPE = np.dtype([("file", np.int32), ("segment", np.int16), ("label", np.int16)])
+
+
+def extract_file_tensors(file_path, features=TENSOR_FEATURES, num_mfcc=13, n_fft=2048, hop_length=512, n_mels=128,
+                         num_segments=1, segment_duration=SEGMENT_DURATION):
+    """Loads an audio file, divides it into segments and extracts the time-frequency features of every segment.
+
+        Segments are padded or cut to segment_duration seconds, so that all have the same number of frames.
+        Runs in the worker processes.
+
+        :param file_path (str): Path to audio file
+        :param features (list): Features to extract, among TENSOR_FEATURES, concatenated along the bins in this order
+        :param n_mels (int): Number of mel bands of the log-mel spectrogram
+        :param num_segments (int): Number of segments we want to divide sample tracks into
+        :param segment_duration (float): Duration of every segment in seconds
+        :return tensors (ndarray), metrics (dict): float32 array of shape (num_segments, frames, bins), and the decode and
+            featurize time and duration of the file (see Instrumentation.record_file)
+        """
+
+    started = time.perf_counter()
+    signal, sample_rate = read_audio(file_path, sr=SAMPLE_RATE)
+    decoded = time.perf_counter()
+
+    samples_per_segment = len(signal) // num_segments
+    segment_length = int(segment_duration * sample_rate)
+    segments = np.stack([librosa.util.fix_length(signal[d * samples_per_segment:(d + 1) * samples_per_segment], size=segment_length)
+                         for d in range(num_segments)])
+    spectrograms = extract_spectrograms(segments, sample_rate, num_mfcc, n_fft, hop_length, n_mels)
+    tensors = np.concatenate([spectrograms[name] for name in features], axis=-1).astype(np.float32)
+
+    metrics = {
+        "decode_seconds": decoded - started,
+        "featurize_seconds": time.perf_counter() - decoded,
+        "audio_seconds": len(signal) / sample_rate,
+        "segments": num_segments,
+    }
+    return tensors, metrics
+
+
+def _extract_file_tensors_args(args):
+    return extract_file_tensors(*args)
+
+
+def export_tensor_dataset(dataset_paths, tensors_path, features=TENSOR_FEATURES, num_mfcc=13, n_fft=2048, hop_length=512, n_mels=128,
+                          num_segments=1, segment_duration=SEGMENT_DURATION, workers=1, instrumentation=NULL_INSTRUMENTATION):
+    """Extracts the time-frequency features of every segment of the datasets into one memory-mapped tensor.
+
+        The tensor directory holds tensors.npy, a float32 array of shape (segments, frames, bins) preallocated
+        on disk and filled as the files are processed, index.npy with the source file, segment and label of every
+        row (see INDEX_DTYPE), and metadata.json with the label map, the files, the extraction parameters and the
+        bins of every feature. It is written next to tensors_path and moved in place once complete.
+        Load with TensorDataset.
+
+        :param dataset_paths (list): Paths to datasets
+        :param tensors_path (str): Path to the tensor directory
+        :param features (list): Features to extract, among TENSOR_FEATURES
+        :param workers (int): Number of worker processes
+        :param instrumentation (Instrumentation): Records the decode, featurize and write times
+        :return label_map (dict): Label -> label index
+        """
+
+    label_map, files = list_dataset_files(dataset_paths)
+    segment_length = int(segment_duration * SAMPLE_RATE)
+    num_frames = 1 + segment_length // hop_length
+    bins = {"mfcc": num_mfcc, "log_mel": n_mels, "chroma": 12}
+    layout = []
+    offset = 0
+    for name in features:
+        layout.append({"name": name, "offset": offset, "bins": bins[name]})
+        offset += bins[name]
+
+    tmp_path = tensors_path.rstrip(os.sep) + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    tensors = np.lib.format.open_memmap(os.path.join(tmp_path, DATA_FILE), mode="w+", dtype=np.float32,
+                                        shape=(len(files) * num_segments, num_frames, offset))
+    index = np.zeros(len(files) * num_segments, dtype=INDEX_DTYPE)
+
+    args = [(file_path, features, num_mfcc, n_fft, hop_length, n_mels, num_segments, segment_duration) for _, file_path in files]
+    if workers > 1 and len(args) > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = bounded_map(executor, _extract_file_tensors_args, args, workers * 2)
+    else:
+        executor = None
+        results = map(_extract_file_tensors_args, args)
+    try:
+        for file_index, ((label_index, file_path), (file_tensors, metrics)) in enumerate(zip(files, results)):
+            instrumentation.record_file(file_path, metrics)
+            with instrumentation.timer("write"):
+                rows = slice(file_index * num_segments, (file_index + 1) * num_segments)
+                tensors[rows] = file_tensors
+                index["file"][rows] = file_index
+                index["segment"][rows] = np.arange(num_segments)
+                index["label"][rows] = label_index
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    tensors.flush()
+    del tensors
+    np.save(os.path.join(tmp_path, INDEX_FILE), index)
+    metadata = {
+        "label_map": label_map,
+        "files": [os.path.relpath(file_path, BASE_DIR) for _, file_path in files],
+        "sample_rate": SAMPLE_RATE,
+        "num_mfcc": num_mfcc,
+        "n_fft": n_fft,
+        "hop_length": hop_length,
+        "n_mels": n_mels,
+        "num_segments": num_segments,
+        "segment_duration": segment_duration,
+        "shape": [len(index), num_frames, offset],
+        "layout": layout,
+    }
+    with open(os.path.join(tmp_path, METADATA_FILE), "w") as fp:
+        json.dump(metadata, fp, indent=1)
+    if os.path.exists(tensors_path):
+        shutil.rmtree(tensors_path)
+    os.replace(tmp_path, tensors_path)
+    return label_map
+
+
+class TensorDataset:
+    """Memory-mapped tensor dataset written by export_tensor_dataset.
+
+        Rows are read from disk when accessed, so the dataset can be larger than the memory.
+        """
+
+    def __init__(self, tensors_path):
+        """
+            :param tensors_path (str): Path to the tensor directory
+            """
+
+        self.tensors_path = tensors_path
+        with open(os.path.join(tensors_path, METADATA_FILE), "r") as fp:
+            self.metadata = json.load(fp)
+        self.tensors = np.load(os.path.join(tensors_path, DATA_FILE), mmap_mode="r")
+        self.index = np.load(os.path.join(tensors_path, INDEX_FILE))
+        self.labels = self.index["label"].astype(np.int64)
+        self.label_map = self.metadata["label_map"]
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, rows):
+        return np.asarray(self.tensors[rows]), self.labels[rows]
+
+    @property
+    def shape(self):
+        return self.tensors.shape
+
+    def feature(self, name):
+        """Returns the slice of the bins axis holding a feature.
+            """
+
+        for entry in self.metadata["layout"]:
+            if entry["name"] == name:
+                return slice(entry["offset"], entry["offset"] + entry["bins"])
+        raise KeyError(name)
+
+    def _read_batch(self, rows, features):
+        # reading the rows in file order turns the random access into forward seeks
+        order = np.argsort(rows)
+        data = self.tensors[rows[order]]
+        if features:
+            data = np.concatenate([data[..., bins] for bins in features], axis=-1)
+        batch = np.empty_like(data)
+        batch[order] = data
+        return batch, self.labels[rows]
+
+    def batches(self, batch_size=32, shuffle=True, rows=None, features=None, prefetch=2, drop_last=False, seed=None, augmenter=None):
+        """Yields mini-batches of (tensors, labels), read in a background thread while the previous ones are used.
+
+            :param batch_size (int): Number of rows in a batch
+            :param shuffle (bool): Shuffle the rows (again at every call)
+            :param rows (ndarray): Rows to draw from (e.g. a training split), all by default
+            :param features (list): Names of the features to keep, all by default
+            :param prefetch (int): Number of batches read ahead, 0 to read in the calling thread
+            :param drop_last (bool): Drop the last batch if it is smaller than batch_size
+            :param seed (int): Seed of the shuffling, and of the masks of the batch with index i as [seed, i]
+            :param augmenter (Augmenter): Applies SpecAugment masks to every batch (see augmentation.Augmenter.mask_tensors)
+            :return: Iterator of (float32 array of shape (batch, frames, bins), int64 labels)
+            """
+
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        if shuffle:
+            rows = np.random.RandomState(seed).permutation(rows)
+        stop = len(rows) - len(rows) % batch_size if drop_last else len(rows)
+        batch_rows = [rows[start:min(start + batch_size, stop)] for start in range(0, stop, batch_size)]
+        slices = [self.feature(name) for name in features] if features else None
+        # bins of every feature within the batches, the kept features being concatenated
+        names = features or [entry["name"] for entry in self.metadata["layout"]]
+        offsets = np.cumsum([0] + [self.feature(name).stop - self.feature(name).start for name in names])
+        batch_bins = [slice(start, stop) for start, stop in zip(offsets[:-1], offsets[1:])]
+
+        def read_batch(index, batch):
+            tensors, labels = self._read_batch(batch, slices)
+            if augmenter is not None:
+                tensors = augmenter.mask_tensors(tensors, batch_bins, np.random.RandomState(None if seed is None else [seed, index]))
+            return tensors, labels
+
+        if prefetch <= 0:
+            for index, batch in enumerate(batch_rows):
+                yield read_batch(index, batch)
+            return
+
+        ready = queue.Queue(maxsize=prefetch)
+        done = object()
+        stopped = threading.Event()
+
+        def read():
+            try:
+                for index, batch in enumerate(batch_rows):
+                    if stopped.is_set():
+                        return
+                    ready.put(read_batch(index, batch))
+            except Exception as e:
+                ready.put(e)
+                return
+            ready.put(done)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # the consumer may stop early, unblock the reader so it can exit
+            stopped.set()
+            while reader.is_alive():
+                try:
+                    ready.get_nowait()
+                except queue.Empty:
+                    reader.join(0.01)
+
+
+def load_tensor_dataset(tensors_path):
+    """Opens a tensor dataset, see TensorDataset.
+        """
+
+    return TensorDataset(tensors_path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Exports the time-frequency features of the clean datasets as memory-mapped tensors.")
+    parser.add_argument("--task", choices=["detection", "classification"], default="detection", help="dataset to export")
+    parser.add_argument("--output", help="tensor directory, detection_tensors or classification_tensors by default")
+    parser.add_argument("--features", nargs="+", choices=TENSOR_FEATURES, default=TENSOR_FEATURES, help="features to export")
+    parser.add_argument("--n-mels", type=int, default=128, help="number of mel bands of the log-mel spectrogram")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to extract features")
+    parser.add_argument("--instrument-level", choices=LEVELS, default="summary", help="metrics recorded and printed as JSON")
+    args = parser.parse_args()
+
+    dataset_paths, tensors_path = (DETECTION_DATASET_PATHS, DETECTION_TENSORS_PATH) if args.task == "detection" else (CLASSIFICATION_DATASET_PATHS, CLASSIFICATION_TENSORS_PATH)
+    with Instrumentation(args.instrument_level) as instrumentation:
+        export_tensor_dataset(dataset_paths, args.output or tensors_path, args.features, n_mels=args.n_mels, workers=args.workers, instrumentation=instrumentation)
+    if instrumentation.enabled:
+        print(json.dumps(instrumentation.summary()))
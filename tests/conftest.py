@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import sys
+import warnings
+import numpy as np
+import pytest
+
+# the modules of the repository import each other by their top-level names
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+SAMPLE_RATE = 22050
+CLIP_DURATION = 5
+# bundled clips the regression tests run on, every few files of both classes of detection_dataset
+NUM_CLIPS = 8
+
+
+@pytest.fixture(scope="session")
+def clips():
+    # float32 clips of CLIP_DURATION seconds padded with zeros, as the rows of the feature datasets
+    import librosa
+
+    file_paths = sorted(glob.glob(os.path.join(BASE_DIR, "detection_dataset", "*", "*.wav")))
+    file_paths = file_paths[::max(1, len(file_paths) // NUM_CLIPS)][:NUM_CLIPS]
+    if not file_paths:
+        pytest.skip("detection_dataset is not available")
+    signals = [librosa.load(file_path, sr=SAMPLE_RATE)[0] for file_path in file_paths]
+    return np.stack([librosa.util.fix_length(signal, size=CLIP_DURATION * SAMPLE_RATE) for signal in signals]).astype(np.float32)
+
+
+@pytest.fixture(autouse=True)
+def no_tuning_warnings():
+    # librosa warns that the tuning of the silent or atonal frames of a clip cannot be estimated
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        yield
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import librosa
+from audio_preprocessing import SAMPLE_RATE, get_features_batch, get_features_csv_row
+from augmentation import Augmenter
+from clip_predictor import ClipFeaturizer
+from features import FEATURE_NAMES, SIGNAL_OFFSET, extract_features
+
+
+def librosa_features(signal, num_mfcc=13, n_fft=2048, hop_length=512):
+    # the librosa.feature calls of get_features_csv_row before the features shared their STFT, frames first
+    offset_signal = signal + SIGNAL_OFFSET
+    return {
+        "mfcc": librosa.feature.mfcc(y=signal, sr=SAMPLE_RATE, n_mfcc=num_mfcc, n_fft=n_fft, hop_length=hop_length).T,
+        "spectral_centroid": librosa.feature.spectral_centroid(y=signal, sr=SAMPLE_RATE)[0],
+        "spectral_rolloff": librosa.feature.spectral_rolloff(y=offset_signal, sr=SAMPLE_RATE)[0],
+        "spectral_bandwidth_2": librosa.feature.spectral_bandwidth(y=offset_signal, sr=SAMPLE_RATE)[0],
+        "spectral_bandwidth_3": librosa.feature.spectral_bandwidth(y=offset_signal, sr=SAMPLE_RATE, p=3)[0],
+        "spectral_bandwidth_4": librosa.feature.spectral_bandwidth(y=offset_signal, sr=SAMPLE_RATE, p=4)[0],
+        "zero_crossing_rate": librosa.feature.zero_crossing_rate(signal, pad=False)[0],
+        "chroma": librosa.feature.chroma_stft(y=signal, sr=SAMPLE_RATE, hop_length=hop_length).T,
+    }
+
+
+def assert_features_close(features, expected, rtol=1e-5):
+    assert sorted(features) == sorted(FEATURE_NAMES)
+    for name in FEATURE_NAMES:
+        np.testing.assert_allclose(features[name], expected[name], rtol=rtol, atol=1e-6, err_msg=name)
+
+
+def test_extract_features_matches_librosa(clips):
+    for clip in clips:
+        assert_features_close(extract_features(clip, SAMPLE_RATE), librosa_features(clip))
+
+
+def test_extract_features_matches_librosa_with_other_stft_parameters(clips):
+    features = extract_features(clips[0], SAMPLE_RATE, num_mfcc=20, n_fft=1024, hop_length=256)
+    assert_features_close(features, librosa_features(clips[0], num_mfcc=20, n_fft=1024, hop_length=256))
+
+
+def test_batch_matches_single_clips(clips):
+    batch = extract_features(clips, SAMPLE_RATE)
+    for i, clip in enumerate(clips):
+        assert_features_close({name: feature[i] for name, feature in batch.items()}, extract_features(clip, SAMPLE_RATE), rtol=1e-6)
+
+
+def test_clip_featurizer_matches_csv_rows(clips):
+    featurizer = ClipFeaturizer(SAMPLE_RATE)
+    for clip in clips:
+        np.testing.assert_array_equal(featurizer.featurize(clip), get_features_csv_row(clip, SAMPLE_RATE))
+
+
+def test_clip_featurizer_matches_pooled_csv_rows(clips):
+    featurizer = ClipFeaturizer(SAMPLE_RATE, feature_mode="pooled")
+    np.testing.assert_array_equal(featurizer.featurize(clips[0]), get_features_csv_row(clips[0], SAMPLE_RATE, feature_mode="pooled"))
+
+
+def test_augmenter_without_augmentations_matches_batch_rows(clips):
+    expected = get_features_batch(clips, SAMPLE_RATE)
+    for augmenter in (Augmenter(p=0, time_masks=0, freq_masks=0), Augmenter(p=0)):
+        rows = get_features_batch(clips, SAMPLE_RATE, augmenter=augmenter, random_state=np.random.RandomState(0))
+        np.testing.assert_array_equal(rows, expected)
+
+
+def test_augmenter_is_deterministic(clips):
+    augmenter = Augmenter(p=1.0)
+    rows = [get_features_batch(clips[:4], SAMPLE_RATE, augmenter=augmenter, random_state=np.random.RandomState([22, 0, 0])) for _ in range(2)]
+    np.testing.assert_array_equal(rows[0], rows[1])
+    assert np.isfinite(rows[0]).all()
+    assert not np.array_equal(rows[0], get_features_batch(clips[:4], SAMPLE_RATE))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import librosa
+from audio_preprocessing import SAMPLE_RATE, get_features_csv_row
+from event_detector import EventSegmenter
+from features import SIGNAL_OFFSET
+from stream_detector import IncrementalSTFT, StreamingDetector
+
+
+class RecordingModel:
+    # classifier stand-in keeping the rows it is given
+    def __init__(self):
+        self.rows = []
+
+    def predict(self, rows):
+        self.rows.extend(rows)
+        return np.zeros(len(rows), dtype=np.int64)
+
+
+def recording(clips, seed=0):
+    # the clips one after the other, separated by gaps of quiet noise of random lengths
+    random_state = np.random.RandomState(seed)
+    parts = []
+    for clip in clips:
+        parts += [clip, 0.003 * random_state.standard_normal(int(random_state.uniform(0.5, 3.0) * SAMPLE_RATE))]
+    return np.concatenate(parts).astype(np.float32)
+
+
+def blocks_of(signal, block_size=4096):
+    return [signal[start:start + block_size] for start in range(0, len(signal), block_size)]
+
+
+def test_incremental_stft_matches_offline_stft(clips):
+    signal = recording(clips[:3])
+    for n_fft, hop_length, offset in ((2048, 512, 0.0), (2048, 512, SIGNAL_OFFSET), (1024, 256, 0.0)):
+        window_length = 2 * SAMPLE_RATE
+        stft = IncrementalSTFT(n_fft, hop_length, window_length, offset=offset)
+        # overlapping windows, then a jump past the frames kept
+        for start in list(range(0, 8 * hop_length, 3 * hop_length)) + [window_length * 3]:
+            window = signal[start:start + window_length]
+            expected = librosa.stft(window + offset if offset else window, n_fft=n_fft, hop_length=hop_length)
+            np.testing.assert_allclose(stft(window, start), expected, rtol=1e-5, atol=1e-5)
+
+
+def test_streaming_windows_match_csv_rows(clips):
+    signal = recording(clips[:2])
+    model = RecordingModel()
+    detector = StreamingDetector(model, decision_hop=1.0)
+    decisions = list(detector.process(blocks_of(signal)))
+    assert len(decisions) == len(model.rows)
+    for decision, row in zip(decisions, model.rows):
+        start = int(round(decision["start"] * SAMPLE_RATE))
+        window = librosa.util.fix_length(signal[start:start + detector.window_length], size=detector.window_length)
+        np.testing.assert_allclose(row, get_features_csv_row(window, SAMPLE_RATE), rtol=1e-6, atol=1e-6)
+
+
+def test_event_segmenter_does_not_depend_on_chunks(clips):
+    # near and far coughs, so that the loudest sound of a chunk depends on the chunk boundaries
+    signal = recording(clips * np.where(np.arange(len(clips)) % 2, 0.01, 1.0)[:, np.newaxis].astype(np.float32), seed=1)
+
+    def events(chunk_duration):
+        segmenter = EventSegmenter(None, chunk_duration=chunk_duration)
+        return [(event["start"], event["end"]) for event in segmenter.process(blocks_of(signal))]
+
+    offline = events(len(signal) / SAMPLE_RATE + 1)
+    assert offline
+    assert events(20.0) == offline
+    assert events(13.0) == offline